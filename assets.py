@@ -0,0 +1,105 @@
+""" Process wide cache for images cut out of spritesheets.
+
+Every sprite that uses the same spritesheet shares one loaded copy of it, and
+every frame cut from it is converted once and then handed out to whoever asks
+for the same rect again.  Surfaces from the cache are shared, so don't draw on
+them.
+"""
+from collections import OrderedDict
+
+import pygame
+
+# how many bytes of pixel data the cache may hold before it starts to evict
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def surface_bytes(surface):
+    return surface.get_pitch() * surface.get_height()
+
+
+class AssetCache(object):
+    """ A least recently used cache of converted surfaces
+
+    Sheets are keyed by path, frames by (path, rect, colorkey, flip).  When the
+    pixel data held goes over max_bytes the least recently used entries are
+    dropped; anything still holding a dropped surface keeps working, the
+    cache just forgets about it.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        surface = self.entries.get(key)
+        if surface is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return surface
+
+    def _put(self, key, surface):
+        self.entries[key] = surface
+        self.bytes += surface_bytes(surface)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, old_surface = self.entries.popitem(last=False)
+            self.bytes -= surface_bytes(old_surface)
+            self.evictions += 1
+
+    def sheet(self, path):
+        """ Load an image file, converted to the display format
+        """
+        key = ('sheet', path)
+        surface = self._get(key)
+        if surface is None:
+            surface = pygame.image.load(path).convert()
+            self._put(key, surface)
+        return surface
+
+    def image_at(self, path, rectangle, colorkey=None, flip=False):
+        """ Cut rectangle out of the sheet at path, mirrored left to right
+        if flip
+
+        With a colorkey the image is converted to per pixel alpha with the
+        colorkey transparent.  A colorkey of -1 uses the colour of the top
+        left pixel of the rectangle.
+        """
+        rect = pygame.Rect(rectangle)
+        if isinstance(colorkey, list):
+            colorkey = tuple(colorkey)
+        key = (path, tuple(rect), colorkey, flip)
+        image = self._get(key)
+        if image is None:
+            if flip:
+                image = pygame.transform.flip(self.image_at(path, rect, colorkey), True, False)
+            else:
+                image = self.sheet(path).subsurface(rect).copy()
+                if colorkey is not None:
+                    if colorkey == -1:
+                        colorkey = image.get_at((0, 0))
+                    image.set_colorkey(colorkey)
+                    image = image.convert_alpha()
+            self._put(key, image)
+        return image
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# shared by everything in the process
+cache = AssetCache()
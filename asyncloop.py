@@ -0,0 +1,157 @@
+""" The game loop on asyncio, with work done in the background.
+
+QuestGame.run() waits in clock.tick() between frames, so anything else the
+game does, like writing frame stats or a recording, has to fit in a frame
+or makes it late.  run() here plays the same frames, QuestGame.frame(), from
+a coroutine.  Between frames it awaits a sleep until the next one is due,
+and background coroutines and jobs get that time.
+
+All drawing stays on the main thread, in frame().  Background coroutines run
+there too, between frames; jobs given to Background.offload() run on a thread
+pool and must not touch the display.
+
+A coroutine with a lot to do awaits Background.pause() between pieces of it.
+Once the frame's budget is spent, or the next frame is nearly due, pause()
+holds it until the next frame has been drawn.
+
+    background = Background(main.BACKGROUND_BUDGET)
+    background.start(write_frame_stats(game, background, 'frames.json'))
+    asyncio.run(run(game, background))
+"""
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from replay import Recording
+
+
+class Background(object):
+    """ Coroutines and jobs run between the frames of run(), and the time
+    they may take: budget seconds a frame
+    """
+
+    def __init__(self, budget, workers=2):
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='background')
+        self.tasks = []
+        # background work should be done by this perf_counter() time
+        self.deadline = 0.0
+        # resolved when the next frame has been drawn
+        self.drawn = None
+        # frames drawn, and pause() calls that came over a millisecond past
+        # the deadline: work that took longer than the budget allowed
+        self.frames = 0
+        self.overruns = 0
+
+    def start(self, coroutine):
+        """ Run coroutine between frames until it returns or the loop ends
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def offload(self, function, *args):
+        """ Call function on the thread pool, return a future of its result
+        """
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def pause(self):
+        """ Let the loop get on with the frames: returns straight away if
+        there is time left this frame, otherwise after the next one
+        """
+        if time.perf_counter() < self.deadline:
+            await asyncio.sleep(0)
+            return
+        self.overruns += time.perf_counter() > self.deadline + .001
+        await self.next_frame()
+
+    def next_frame(self):
+        """ A future resolved once the next frame has been drawn
+        """
+        if self.drawn is None:
+            self.drawn = asyncio.get_running_loop().create_future()
+        return self.drawn
+
+    def idle(self, next_frame):
+        """ Called by run() once a frame is drawn, with when the next is due
+        """
+        self.frames += 1
+        self.deadline = min(time.perf_counter() + self.budget, next_frame - .001)
+        if self.drawn is not None:
+            self.drawn.set_result(None)
+            self.drawn = None
+
+    async def close(self):
+        """ Stop the coroutines, and wait for the jobs already offloaded
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.executor.shutdown(wait=True)
+
+
+async def run(game, background, max_frames=None):
+    """ QuestGame.run() as a coroutine: play frames at game.frame_rate, or as
+    fast as possible if it is 0, for at most max_frames frames if given
+    """
+    game.running = True
+    game.accumulator = 0.0
+    frames = 0
+    last = next_frame = time.perf_counter()
+
+    try:
+        while game.running:
+            if max_frames is not None and frames >= max_frames:
+                break
+            frames += 1
+            now = time.perf_counter()
+            dt = now - last
+            last = now
+            if frames > 1:
+                game.frame_timer.end_frame(dt)
+            game.frame(dt)
+
+            # a frame that ran late moves the ones after it, they don't
+            # hurry to catch up
+            period = 1. / game.frame_rate if game.frame_rate else 0
+            next_frame = max(next_frame + period, time.perf_counter())
+            background.idle(next_frame)
+            await asyncio.sleep(max(next_frame - time.perf_counter(), 0))
+
+    except KeyboardInterrupt:
+        game.running = False
+    finally:
+        await background.close()
+
+    if game.profiler is not None:
+        game.stop_profile()
+
+
+async def write_frame_stats(game, background, path, interval=5.0):
+    """ Export the frame timer to path every interval seconds
+
+    The numbers are taken between frames, the file is written on the pool.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await background.offload(write_json, path, game.frame_timer.summary())
+
+
+async def save_recording(game, background, path, interval=5.0):
+    """ Save the recording in progress to path every interval seconds, so a
+    crash doesn't lose the session
+    """
+    while True:
+        await asyncio.sleep(interval)
+        recording = game.recording
+        if recording is None:
+            continue
+        copy = Recording(recording.map_filename, recording.dts[:], recording.masks[:])
+        await background.offload(copy.save, path)
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1)
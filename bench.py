@@ -0,0 +1,761 @@
+""" Benchmarks for the hot paths of the game.
+
+Run from the project root:
+
+    python bench.py [spatial] [maps] [mapcache] [npcs] [levels] [dirty] [zoom] [sweep] [walls] [sim] [navigation] [alloc] [snapshot] [loop] [quality]
+
+Nothing here opens a window; the numbers are meant to be compared between
+revisions on the same machine.
+"""
+import argparse
+import glob
+import os.path
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+import pygame
+from pygame.locals import K_LEFT, K_RIGHT, K_SPACE, K_UP
+
+from collision import Block, SpatialHash, merge_rects
+
+# held keys for the map benchmarks: walk both ways, jump and try the stairs
+WALK_SCRIPT = [
+    (60, [K_RIGHT]),
+    (20, [K_RIGHT, K_SPACE]),
+    (60, [K_LEFT]),
+    (20, []),
+    (30, [K_UP]),
+]
+
+
+def make_walls(count, tile=16, seed=0):
+    """ Scatter count tile sized walls over a map that grows with the count,
+    so the number of walls near any point stays about the same.
+    """
+    rng = random.Random(seed)
+    side = int((count * 8) ** .5) + 1
+    return [Block(pygame.Rect(rng.randrange(side) * tile, rng.randrange(side) * tile, tile * rng.randint(1, 4), tile))
+            for _ in range(count)]
+
+
+def bench_spatial(counts=(100, 1000, 10000, 50000), queries=2000):
+    """ Compare a floor sensor query against a plain list and the spatial hash
+    """
+    print("spatial hash: sensor query cost vs wall count")
+    print("{:>8} {:>14} {:>14}".format("walls", "list us/query", "hash us/query"))
+    rng = random.Random(1)
+    for count in counts:
+        walls = make_walls(count)
+        index = SpatialHash(walls)
+        span = max(wall.rect.right for wall in walls)
+        sensors = [pygame.Rect(rng.randrange(span), rng.randrange(span), 24, 34) for _ in range(queries)]
+
+        def linear():
+            for sensor in sensors:
+                sensor.collidelist(walls)
+
+        def hashed():
+            for sensor in sensors:
+                index.collide_any(sensor)
+
+        linear_time = min(timeit.repeat(linear, number=1, repeat=3)) / queries * 1e6
+        hashed_time = min(timeit.repeat(hashed, number=1, repeat=3)) / queries * 1e6
+        print("{:>8} {:>14.2f} {:>14.2f}".format(count, linear_time, hashed_time))
+
+
+def bench_maps(ticks=600, frames=120, size=(800, 600)):
+    """ Load every map headless, then time simulation ticks and drawn frames
+    """
+    from headless import init_headless, ScriptedInput
+    surface = init_headless(size)
+    import main as game_module
+
+    print("maps: load time, simulation throughput and draw time")
+    print("{:<24} {:>10} {:>12} {:>12}".format("map", "load ms", "ticks/sec", "draw ms"))
+    for path in sorted(glob.glob(os.path.join(game_module.RESOURCES_DIR, 'maps', '*.tmx'))):
+        name = os.path.basename(path)
+        start = time.perf_counter()
+        try:
+            game = game_module.QuestGame(surface, path, ScriptedInput(WALK_SCRIPT, loop=True))
+        except Exception as e:
+            print("{:<24} failed to load: {}".format(name, e))
+            continue
+        load_time = time.perf_counter() - start
+
+        dt = game.timestep or 1 / 60.
+        start = time.perf_counter()
+        for _ in range(ticks):
+            game.step(dt)
+        sim_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(frames):
+            game.draw(surface, .5)
+        draw_time = time.perf_counter() - start
+
+        print("{:<24} {:>10.1f} {:>12.0f} {:>12.3f}".format(
+            name, load_time * 1000, ticks / sim_time, draw_time / frames * 1000))
+
+
+def bench_mapcache(size=(800, 600), repeat=5):
+    """ Compare parsing every map with pytmx against loading its compiled cache
+    """
+    from headless import init_headless
+    from pytmx.util_pygame import load_pygame
+    init_headless(size)
+    import main as game_module
+    import mapcache
+
+    print("map cache: startup time per map")
+    print("{:<24} {:>10} {:>10} {:>10} {:>8}".format("map", "tmx ms", "build ms", "cache ms", "speedup"))
+    for path in sorted(glob.glob(os.path.join(game_module.RESOURCES_DIR, 'maps', '*.tmx'))):
+        name = os.path.basename(path)
+        try:
+            tmx_time = min(timeit.repeat(lambda: load_pygame(path), number=1, repeat=repeat))
+            build_time = min(timeit.repeat(lambda: mapcache.build(path), number=1, repeat=repeat))
+            cache_time = min(timeit.repeat(lambda: mapcache.load_map(path), number=1, repeat=repeat))
+        except Exception as e:
+            print("{:<24} failed to load: {}".format(name, e))
+            continue
+        print("{:<24} {:>10.1f} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            name, tmx_time * 1000, build_time * 1000, cache_time * 1000, tmx_time / cache_time))
+
+
+def bench_npcs(counts=(10, 100, 1000, 10000, 100000), ticks=200):
+    """ Time a crowd update as the number of guards grows
+    """
+    import numpy
+    from npcs import Crowd
+    from tilegrid import TileGrid
+
+    print("npcs: crowd update cost vs guard count")
+    print("{:>8} {:>12} {:>14}".format("guards", "ms/tick", "us/guard/tick"))
+    for count in counts:
+        # rows of platforms with gaps in them, wide enough for everyone
+        width = max(64, count // 4)
+        solid = numpy.zeros((64, width), dtype=bool)
+        solid[8::8, :] = True
+        solid[8::8, ::13] = False
+        crowd = Crowd(TileGrid(solid, 16, 16))
+        rng = random.Random(2)
+        for _ in range(count):
+            crowd.add(rng.randrange(width * 16), rng.randrange(8) * 128)
+
+        start = time.perf_counter()
+        for _ in range(ticks):
+            crowd.update(1 / 120.)
+        elapsed = (time.perf_counter() - start) / ticks
+        print("{:>8} {:>12.3f} {:>14.3f}".format(count, elapsed * 1000, elapsed / count * 1e6))
+
+
+def bench_levels(size=(800, 600), repeat=5):
+    """ How long the main loop stalls changing maps, with and without prefetching
+
+    A cold switch loads the level on the spot, a prefetched one only builds
+    the renderer and the guards.  One 60 fps frame is 16.7 ms.
+    """
+    from headless import init_headless, KeyState
+    surface = init_headless(size)
+    import main as game_module
+
+    game = game_module.QuestGame(surface, get_pressed=lambda: KeyState([]))
+    print("levels: main loop time to switch to each map")
+    print("{:<24} {:>10} {:>12}".format("map", "cold ms", "prefetched ms"))
+    for path in sorted(glob.glob(os.path.join(game_module.RESOURCES_DIR, 'maps', '*.tmx'))):
+        name = os.path.basename(path)
+        try:
+            cold = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                game.enter_level(game_module.load_level(path))
+                game.draw(surface)
+                cold.append(time.perf_counter() - start)
+            level = game_module.load_level(path)
+            warm = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                game.enter_level(level)
+                game.draw(surface)
+                warm.append(time.perf_counter() - start)
+        except Exception as e:
+            print("{:<24} failed to load: {}".format(name, e))
+            continue
+        print("{:<24} {:>10.1f} {:>12.1f}".format(name, min(cold) * 1000, min(warm) * 1000))
+    game.levels.close()
+
+
+def bench_dirty(sizes=((800, 600), (1920, 1080)), ticks=1200):
+    """ Draw and present time per frame, flipping the whole screen against
+    dirty rects, while the hero idles and while they walk about
+    """
+    from headless import init_headless, ScriptedInput
+    import dirty
+    import main as game_module
+
+    scripts = [('idle', [(ticks, [])]), ('walking', WALK_SCRIPT)]
+    print("dirty rects: draw + present time per frame, two ticks per frame")
+    print("{:<10} {:<8} {:>9} {:>9} {:>8} {:>24}".format(
+        "size", "script", "flip ms", "dirty ms", "pixels", "skipped/partial/full"))
+    for size in sizes:
+        surface = init_headless(size)
+        for name, script in scripts:
+            results = []
+            for use_dirty in (False, True):
+                game = game_module.QuestGame(surface, get_pressed=ScriptedInput(script, loop=True))
+                if use_dirty:
+                    game.dirty = dirty.DirtyRects()
+                pixels = 0
+                elapsed = 0.0
+                for tick in range(ticks):
+                    game.step(game.timestep)
+                    if tick % 2:
+                        continue
+                    start = time.perf_counter()
+                    rects = game.draw(surface, .5)
+                    if rects is None:
+                        pygame.display.flip()
+                        pixels += size[0] * size[1]
+                    elif rects:
+                        pygame.display.update(rects)
+                        pixels += sum(rect.w * rect.h for rect in rects)
+                    elapsed += time.perf_counter() - start
+                results.append((elapsed / (ticks // 2), pixels / float(size[0] * size[1] * (ticks // 2))))
+            frames = game.dirty.frames
+            print("{:<10} {:<8} {:>9.3f} {:>9.3f} {:>7.0%} {:>24}".format(
+                "{}x{}".format(*size), name, results[0][0] * 1000, results[1][0] * 1000, results[1][1],
+                "{skipped}/{partial}/{full}".format(**frames)))
+
+
+def bench_zoom(size=(800, 600), other_size=(1280, 720), rounds=5):
+    """ Time switching zoom levels and window sizes, the first time and again
+    once the renderers are cached
+    """
+    from headless import init_headless, ScriptedInput
+    surface = init_headless(size)
+    import main as game_module
+
+    game = game_module.QuestGame(surface, get_pressed=ScriptedInput(WALK_SCRIPT, loop=True))
+    views = [(size, zoom) for zoom in game_module.ZOOM_LEVELS] + [(other_size, 2), (size, 2)]
+    print("zoom: time to switch view and draw a frame, ms")
+    print("{:<20} {:>10} {:>10}".format("view", "first", "cached"))
+    for view_size, zoom in views:
+        times = []
+        for i in range(rounds):
+            for tick in range(20):
+                game.step(game.timestep)
+            start = time.perf_counter()
+            game.set_view(size=view_size, zoom=zoom)
+            game.draw(game.surface)
+            times.append(time.perf_counter() - start)
+            # go somewhere else, so the next round switches back
+            game.set_view(size=size, zoom=2 if zoom != 2 else 1)
+        print("{:<20} {:>10.2f} {:>10.2f}".format(
+            "{}x{} zoom {}".format(view_size[0], view_size[1], zoom), times[0] * 1000, min(times[1:]) * 1000))
+    print("renderer cache: {}".format(game.level.renderers.stats()))
+
+
+def bench_sweep(dts=(1 / 120., 1 / 30., .1, .25), seconds=3, size=(800, 600)):
+    """ Drop the hero onto a 16 pixel thick platform with ever bigger
+    timesteps, and check that it lands on it instead of passing through
+    """
+    from headless import init_headless, KeyState
+    surface = init_headless(size)
+    import main as game_module
+
+    # the upper platform of dungeon_0's second room, x 128-384, y 384-400
+    platform_top = 384
+    print("sweep: hero dropped from 200 px above a 16 px platform")
+    print("{:>8} {:>10} {:>10} {:>8} {:>12}".format("dt", "final y", "expected", "landed", "moves/sec"))
+    for dt in dts:
+        game = game_module.QuestGame(surface, get_pressed=lambda: KeyState([]))
+        hero = game.hero
+        hero.position = (320, platform_top - hero.rect.height - 200)
+        hero.velocity = [0, 0]
+        hero.update_contacts(game)
+        ticks = int(seconds / dt)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            game.step(dt)
+        elapsed = time.perf_counter() - start
+        expected = platform_top - hero.rect.height
+        print("{:>8.4f} {:>10.1f} {:>10} {:>8} {:>12.0f}".format(
+            dt, hero.position[1], expected, 'yes' if hero.position[1] == expected else 'NO', ticks / elapsed))
+
+
+def tile_walls(columns=200, rows=200, tile=16, seed=0):
+    """ A map drawn a tile at a time: rooms of one tile wide wall objects,
+    the way a map is drawn with the tile object tool
+    """
+    rng = random.Random(seed)
+    rects = []
+    for top in range(0, rows, 10):
+        for left in range(0, columns, 10):
+            if rng.random() < .3:
+                continue
+            for x in range(left, left + 10):
+                rects.append((x * tile, (top + 9) * tile, tile, tile))
+            for y in range(top, top + 9):
+                rects.append((left * tile, y * tile, tile, tile))
+    return rects
+
+
+def bench_walls(queries=20000):
+    """ Wall rects before and after merging, and what that does to a sensor query
+    """
+    maps = []
+    for path in sorted(glob.glob(os.path.join('data', 'maps', '*.tmx'))):
+        # straight from the XML, so maps with missing tilesets count too
+        rects = [tuple(int(float(node.get(key, 0))) for key in ('x', 'y', 'width', 'height'))
+                 for node in ElementTree.parse(path).getroot().iter('object') if node.get('type') == 'wall']
+        if rects:
+            maps.append((os.path.basename(path), rects))
+    maps.append(('tiles 200x200 (synthetic)', tile_walls()))
+
+    print("walls: merging wall rects at load time")
+    print("{:<26} {:>7} {:>7} {:>10} {:>12} {:>12}".format(
+        "map", "before", "after", "merge ms", "us/q before", "us/q after"))
+    rng = random.Random(1)
+    for name, rects in maps:
+        start = time.perf_counter()
+        merged = merge_rects(rects)
+        elapsed = time.perf_counter() - start
+        before = SpatialHash([Block(pygame.Rect(rect)) for rect in rects])
+        after = SpatialHash([Block(rect) for rect in merged])
+        span = pygame.Rect(rects[0]).unionall([pygame.Rect(rect) for rect in rects])
+        sensors = [pygame.Rect(rng.randrange(span.left, span.right), rng.randrange(span.top, span.bottom), 24, 34)
+                   for _ in range(queries)]
+
+        def query(index):
+            for sensor in sensors:
+                index.query(sensor)
+
+        times = [min(timeit.repeat(lambda: query(index), number=1, repeat=3)) / queries * 1e6
+                 for index in (before, after)]
+        print("{:<26} {:>7} {:>7} {:>10.2f} {:>12.2f} {:>12.2f}".format(
+            name, len(rects), len(merged), elapsed * 1000, times[0], times[1]))
+
+
+def bench_sim(count=64, steps=100, ticks=4, filename=os.path.join('data', 'maps', 'dungeon_0.tmx')):
+    """ Hero ticks per second of a batch of headless simulations with random
+    actions, in process and over more and more worker processes
+    """
+    import numpy
+    import sim
+
+    cores = os.cpu_count() or 1
+    workers = [0, 1]
+    while workers[-1] < max(cores, 2):
+        workers.append(workers[-1] * 2)
+    print("sim: {} instances of {}, {} ticks per step, {} cores".format(
+        count, os.path.basename(filename), ticks, cores))
+    print("{:>8} {:>14} {:>12}".format("workers", "ticks/sec", "vs 1 worker"))
+    rng = numpy.random.default_rng(0)
+    actions = rng.integers(0, sim.ACTION_COUNT, (steps, count))
+    baseline = None
+    for worker_count in workers:
+        batch = sim.BatchSimulation(filename, count, workers=worker_count)
+        batch.reset()
+        start = time.perf_counter()
+        for step_actions in actions:
+            batch.step(step_actions, ticks)
+        elapsed = time.perf_counter() - start
+        batch.close()
+        rate = count * steps * ticks / elapsed
+        if worker_count == 1:
+            baseline = rate
+        print("{:>8} {:>14.0f} {:>12}".format(
+            worker_count or 'none', rate, "{:.2f}x".format(rate / baseline) if baseline else ''))
+
+
+def bench_navigation(queries=200):
+    """ Building, loading and querying the navigation graph of every map
+    """
+    from headless import init_headless
+    init_headless((1, 1))
+    import main as game_module
+    import navigation
+
+    print("navigation: graph build and cached load, A* and flow field cost")
+    print("{:<24} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+        "map", "nodes", "edges", "build ms", "load ms", "A* us", "field us"))
+    rng = random.Random(1)
+    for path in sorted(glob.glob(os.path.join(game_module.RESOURCES_DIR, 'maps', '*.tmx'))):
+        name = os.path.basename(path)
+        try:
+            level = game_module.load_level(path, graphics=False)
+        except Exception as e:
+            print("{:<24} failed to load: {}".format(name, e))
+            continue
+        if os.path.exists(navigation.nav_path(path)):
+            os.remove(navigation.nav_path(path))
+        start = time.perf_counter()
+        graph = navigation.load(level)
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        navigation.load(level)
+        loaded = time.perf_counter() - start
+        if not len(graph):
+            print("{:<24} {:>6} {:>6} {:>10.1f} {:>10.1f}".format(name, 0, 0, built * 1000, loaded * 1000))
+            continue
+        pairs = [(rng.randrange(len(graph)), rng.randrange(len(graph))) for _ in range(queries)]
+        start = time.perf_counter()
+        for a, b in pairs:
+            graph.path(a, b)
+        path_time = (time.perf_counter() - start) / queries
+        start = time.perf_counter()
+        for a, b in pairs[:20]:
+            graph.flow_field(b)
+        field_time = (time.perf_counter() - start) / 20
+        print("{:<24} {:>6} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, len(graph), graph.edge_count(), built * 1000, loaded * 1000, path_time * 1e6, field_time * 1e6))
+
+
+# most bytes a steady state hero tick may have allocated at once.  CPython
+# boxes every int above 256 and map coordinates are mostly bigger, so pure
+# Python can't get to nothing; this is room for a handful of those.  a tick
+# used to build about 700 bytes of sensor rects, lists and contacts
+TICK_ALLOCATION_BUDGET = 320
+
+
+def measure_alloc(ticks=240, filename=os.path.join('data', 'maps', 'dungeon_0.tmx')):
+    """ Run the hero standing, walking and jumping around, and return
+    (name, ticks, lookups, peak bytes, kept bytes) for each
+
+    Measures everything this process allocates, so run it on its own, see
+    alloc_report().  Ticks where the hero looks the walls up again, having
+    moved out of the area it looked up last time, are counted apart: they
+    make a list.  What a run keeps is measured over the whole run, single
+    ticks are thrown off by the free lists filling up, and only counts
+    memory allocated with the hero's code on the stack.
+    """
+    from headless import init_headless
+    init_headless((1, 1))
+    import hero as hero_module
+    import levels
+    import sim
+
+    simulation = sim.Simulation(levels.load_level(filename, graphics=False))
+    dt = simulation.dt
+    scenarios = [
+        ('standing', 0),
+        ('walking right', sim.RIGHT),
+        ('walking left', sim.LEFT),
+        ('jumping right', sim.JUMP | sim.RIGHT),
+        ('jumping left', sim.JUMP | sim.LEFT),
+    ]
+    hero_code = [tracemalloc.Filter(True, hero_module.__file__, all_frames=True)]
+
+    def measure(tick):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        tick()
+        return tracemalloc.get_traced_memory()[1] - before
+
+    def hero_bytes():
+        return sum(stat.size for stat in tracemalloc.take_snapshot().filter_traces(hero_code).statistics('filename'))
+
+    results = []
+    simulation.reset()
+    hero = simulation.hero
+    tracemalloc.start(16)
+    try:
+        # what measuring an empty call costs, taken off every tick
+        overhead = max(measure(lambda: None) for _ in range(10))
+        for name, action in scenarios:
+            pressed = sim.ACTION_KEYS[action]
+
+            def tick():
+                hero.control(pressed, dt, simulation)
+                hero.update(dt, simulation)
+
+            # warm up the free lists, and whatever the action first needs
+            for _ in range(ticks // 4):
+                tick()
+            start = hero_bytes()
+            lookups = 0
+            peak = 0
+            for _ in range(ticks):
+                area = hero.nearby_area
+                used = measure(tick) - overhead
+                if hero.nearby_area is not area:
+                    lookups += 1
+                else:
+                    peak = max(peak, used)
+            results.append((name, ticks, lookups, peak, hero_bytes() - start))
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def alloc_report(ticks=240, filename=os.path.join('data', 'maps', 'dungeon_0.tmx')):
+    """ measure_alloc() in a fresh process, away from anything earlier
+    benchmarks left running, like level loader threads
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    # the new process imports pygame again, keep its banner out of the table
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(measure_alloc, ticks, filename).result()
+
+
+def bench_alloc(ticks=240, filename=os.path.join('data', 'maps', 'dungeon_0.tmx')):
+    """ Check with tracemalloc that hero ticks keep nothing and allocate
+    next to nothing, standing, walking and jumping around
+
+    Exits with an error if a run keeps more than the budget, anything kept
+    every tick soon would, or a tick goes over it.  tests/test_alloc.py
+    checks the same.
+    """
+    print("alloc: bytes allocated by a hero tick on {}, budget {}".format(
+        os.path.basename(filename), TICK_ALLOCATION_BUDGET))
+    print("{:<16} {:>8} {:>10} {:>12} {:>12}".format("", "ticks", "lookups", "peak bytes", "kept bytes"))
+    failed = False
+    for name, count, lookups, peak, kept in alloc_report(ticks, filename):
+        print("{:<16} {:>8} {:>10} {:>12} {:>12}".format(name, count, lookups, peak, kept))
+        if kept > TICK_ALLOCATION_BUDGET or peak > TICK_ALLOCATION_BUDGET:
+            failed = True
+    if failed:
+        print("alloc: hero ticks kept memory or went over the budget")
+        raise SystemExit(1)
+
+
+def bench_snapshot(maps=('dungeon_0.tmx', 'world_map.tmx'), ticks=1200, size=(800, 600)):
+    """ Cost of packing and restoring a tick's state, how much a second of
+    rewind history takes, and a check that a replay jumped back to its middle
+    plays on the same as the first time
+    """
+    from headless import init_headless, ScriptedInput
+    surface = init_headless(size)
+    import main as game_module
+    import replay
+    import snapshot
+
+    print("snapshot: pack and restore cost, history size, replay seek over {} ticks".format(ticks))
+    print("{:<16} {:>7} {:>8} {:>9} {:>11} {:>11} {:>12} {:>8}".format(
+        "map", "guards", "bytes", "pack us", "restore us", "capture us", "history/sec", "seek"))
+    for name in maps:
+        path = os.path.join(game_module.RESOURCES_DIR, 'maps', name)
+        game = game_module.QuestGame(surface, path, ScriptedInput(WALK_SCRIPT, loop=True))
+        game.recording = replay.Recording(game.filename)
+        game.wait_for_levels = True
+        history = game.history
+        for _ in range(ticks):
+            game.step(game.timestep)
+
+        blob = snapshot.pack(game)
+        pack_time = min(timeit.repeat(lambda: snapshot.pack(game), number=1000, repeat=3)) / 1000
+        restore_time = min(timeit.repeat(lambda: snapshot.unpack(game, blob), number=1000, repeat=3)) / 1000
+        capture_time = min(timeit.repeat(lambda: history.capture(game), number=1000, repeat=3)) / 1000
+        # what the ring holds per snapshot: the bytes object and its two slots
+        per_tick = sum(sys.getsizeof(packed) + 16 for packed in history.snapshots) / float(history.capacity)
+        per_second = per_tick * game.ticks_per_second
+
+        # play the session back, then jump to the middle and play the rest again
+        replayed = replay.replay_game(game.recording, surface)
+        positions = replay.play(game.recording, surface, game=replayed)
+        middle = ticks // 2
+        replay.seek(replayed, middle)
+        again = replay.play(game.recording, surface, game=replayed)
+        matches = replay.first_difference(again, positions[middle:]) is None
+
+        print("{:<16} {:>7} {:>8} {:>9.2f} {:>11.2f} {:>11.2f} {:>10.1f}KB {:>8}".format(
+            name, game.npcs.count, len(blob), pack_time * 1e6, restore_time * 1e6, capture_time * 1e6,
+            per_second / 1024, 'same' if matches else 'DIFFERS'))
+        if not matches:
+            raise SystemExit(1)
+
+
+def bench_loop(frames=300, stall=.03, every=15, size=(800, 600)):
+    """ Frame time jitter of QuestGame.run() and of the asyncio loop, idle and
+    with background work: a job blocking for stall seconds every few frames,
+    like a slow file write, and a coroutine chewing through CPU work
+    """
+    import asyncio
+    import numpy
+    from headless import init_headless, ScriptedInput
+    surface = init_headless(size)
+    import main as game_module
+    import asyncloop
+
+    class StallingGame(game_module.QuestGame):
+        """ Does the blocking job in the frame, as the plain loop has to
+        """
+
+        def frame(self, dt):
+            game_module.QuestGame.frame(self, dt)
+            if self.frame_timer.frames % every == 0:
+                time.sleep(stall)
+
+    async def stalls(background):
+        while True:
+            await background.next_frame()
+            if background.frames % every == 0:
+                await background.offload(time.sleep, stall)
+
+    async def crunch(background, done):
+        # pieces of about half a millisecond each
+        while True:
+            sum(range(20000))
+            done[0] += 1
+            await background.pause()
+
+    def run_async(game, load):
+        async def play():
+            background = asyncloop.Background(game_module.BACKGROUND_BUDGET)
+            done = [0]
+            if load:
+                background.start(stalls(background))
+                background.start(crunch(background, done))
+            await asyncloop.run(game, background, frames)
+            return done[0], background.overruns
+        return asyncio.run(play())
+
+    print("loop: {} frames at {} fps, background stalls of {:.0f} ms every {} frames".format(
+        frames, game_module.FRAME_RATE, stall * 1000, every))
+    print("{:<30} {:>9} {:>8} {:>11} {:>9} {:>8} {:>10} {:>9}".format(
+        "", "frame ms", "p99 ms", "jitter ms", "p99 off", "std ms", "bg pieces", "overruns"))
+    runs = [
+        ('run(), idle', game_module.QuestGame, None),
+        ('run(), stalls in the frame', StallingGame, None),
+        ('asyncio, idle', game_module.QuestGame, False),
+        ('asyncio, stalls and crunching', game_module.QuestGame, True),
+    ]
+    for name, game_class, load in runs:
+        game = game_class(surface, get_pressed=ScriptedInput(WALK_SCRIPT, loop=True))
+        pieces = overruns = ''
+        if load is None:
+            game.run(frames)
+        else:
+            pieces, overruns = run_async(game, load)
+        frame_times = game.frame_timer.recent()[:, -1] * 1000
+        jitter = game.frame_timer.jitter(1. / game_module.FRAME_RATE)
+        print("{:<30} {:>9.2f} {:>8.2f} {:>11.3f} {:>9.3f} {:>8.3f} {:>10} {:>9}".format(
+            name, frame_times.mean(), numpy.percentile(frame_times, 99), jitter['mean'], jitter['p99'],
+            jitter['std'], pieces if load else '', overruns if load else ''))
+
+
+def bench_quality(frames=240, size=(1920, 1080), filename=os.path.join('data', 'maps', 'dungeon_0.tmx'),
+                  phases=((300, .004), (600, .018), (900, .004)), seed=0):
+    """ Draw cost at each quality level, then the governor against a load that
+    goes up and comes down again, and a check that the hero moves the same
+    with and without it
+    """
+    import numpy
+    from headless import init_headless, ScriptedInput
+    surface = init_headless(size)
+    import main as game_module
+    import quality
+
+    timer_class = game_module.instrument.FrameTimer
+    period = 1. / game_module.FRAME_RATE
+
+    print("quality: draw cost per level on {} at {}x{}, {} frames".format(filename, size[0], size[1], frames))
+    print("{:<16} {:>9} {:>9} {:>9} {:>7}".format("level", "draw ms", "p90 ms", "flip ms", "fps"))
+    for index, level in enumerate(quality.LEVELS):
+        game = game_module.QuestGame(surface, filename, ScriptedInput(WALK_SCRIPT, loop=True))
+        # never looks at the frame times, stays on the level it is given
+        governor = quality.QualityGovernor(game_module.FRAME_RATE, window=frames + 1)
+        governor.index = index
+        game.governor = governor
+        governor.apply(game)
+        game.running = True
+        for _ in range(frames):
+            game.frame_timer.end_frame(1. / game.frame_rate)
+            game.frame(1. / game.frame_rate)
+        samples = game.frame_timer.recent() * 1000
+        print("{:<16} {:>9.2f} {:>9.2f} {:>9.2f} {:>7}".format(
+            level.name, samples[:, timer_class.DRAW].mean(), numpy.percentile(samples[:, timer_class.DRAW], 90),
+            samples[:, timer_class.FLIP].mean(), game.frame_rate))
+
+    # the load is extra draw time a frame, which each level cuts down a bit
+    costs = (1.0, .85, .7, .7)
+    rng = random.Random(seed)
+
+    class LoadedGame(game_module.QuestGame):
+        """ Draws slower when there's more load, and keeps where the hero was
+        after every tick
+        """
+        load = 0.0
+
+        def frame(self, dt):
+            index = self.governor.index if self.governor is not None else 0
+            self.frame_timer.add(timer_class.DRAW, max(self.load * costs[index] + rng.gauss(0, .001), 0))
+            game_module.QuestGame.frame(self, dt)
+
+        def step(self, dt):
+            game_module.QuestGame.step(self, dt)
+            self.positions.append(tuple(self.hero.position))
+
+    surface = init_headless((800, 600))
+    game = LoadedGame(surface, get_pressed=ScriptedInput(WALK_SCRIPT, loop=True))
+    game.positions = []
+    game.governor = quality.QualityGovernor(game_module.FRAME_RATE)
+    game.governor.apply(game)
+    game.running = True
+    print("quality: governor against extra draw time of {}".format(
+        ", then ".join("{:.0f} ms for {} frames".format(load * 1000, count) for count, load in phases)))
+    # a change of direction before the last load phase is flapping
+    boundaries = []
+    for count, load in phases:
+        game.load = load
+        boundaries.append(game.frame_timer.frames)
+        for _ in range(count):
+            game.frame_timer.end_frame(1. / game.frame_rate)
+            game.frame(1. / game.frame_rate)
+
+    changes = game.governor.changes
+    names = [level.name for level in quality.LEVELS]
+    flaps = 0
+    for (frame, old, new, busy), previous in zip(changes[1:], changes):
+        went_down = names.index(new) > names.index(old)
+        was_down = names.index(previous[2]) > names.index(previous[1])
+        same_phase = sum(frame >= start for start in boundaries) == sum(previous[0] >= start for start in boundaries)
+        flaps += went_down != was_down and same_phase
+    print("{} changes, {} flaps, ended on {}".format(len(changes), flaps, game.governor.level.name))
+
+    # the same input without the governor, a tick per 60th of a second
+    plain = game_module.QuestGame(surface, get_pressed=ScriptedInput(WALK_SCRIPT, loop=True))
+    positions = []
+    for _ in range(len(game.positions)):
+        plain.step(plain.timestep)
+        positions.append(tuple(plain.hero.position))
+    same = positions == game.positions
+    print("hero over {} ticks: {}".format(len(positions), 'same' if same else 'DIFFERS'))
+    if flaps or not same:
+        raise SystemExit(1)
+
+
+SUITES = {
+    'spatial': bench_spatial,
+    'maps': bench_maps,
+    'mapcache': bench_mapcache,
+    'npcs': bench_npcs,
+    'levels': bench_levels,
+    'dirty': bench_dirty,
+    'zoom': bench_zoom,
+    'sweep': bench_sweep,
+    'walls': bench_walls,
+    'sim': bench_sim,
+    'navigation': bench_navigation,
+    'alloc': bench_alloc,
+    'snapshot': bench_snapshot,
+    'loop': bench_loop,
+    'quality': bench_quality,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the game benchmarks.')
+    parser.add_argument('suites', nargs='*', choices=sorted(SUITES), help='suites to run, default all')
+    args = parser.parse_args()
+    for name in args.suites or sorted(SUITES):
+        SUITES[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+""" Collision helpers for level geometry.
+
+The walls and stairs of a map never move, so they are indexed once when the
+map is loaded and every sensor query only looks at the few rects near it.
+
+Moving boxes are swept against the walls rather than moved and then pushed
+back out: sweep() finds the earliest time along the move that the box
+touches a wall, so a fast box can't pass through a thin wall whatever the
+frame time, and slide() follows the walls it hits.
+
+Maps are often drawn with many small, touching or overlapping wall objects.
+merge_rects() replaces them with a few larger rects covering exactly the
+same area, so every query has fewer of them to test.
+"""
+import numpy
+import pygame
+
+INFINITY = float('inf')
+
+# how close a wall has to be to count as floor under, or ceiling over, a box
+CONTACT_MARGIN = 2
+
+
+class Block(object):
+    """ A piece of static geometry that is nothing but a rect
+    """
+
+    def __init__(self, rect):
+        self.rect = rect
+
+
+class SpatialHash(object):
+    """ A uniform grid broadphase for static sprites
+
+    Every sprite added is stored in each grid cell its rect overlaps.  A query
+    only visits the cells under the query rect, so the cost of a sensor check
+    depends on how crowded the neighbourhood is, not on how big the map is.
+
+    Results are always returned in the order the sprites were added, so code
+    that used to walk the whole list behaves the same with the index.
+
+    generation goes up every time a sprite is added, so results kept from an
+    earlier query can be told apart from current ones.
+    """
+
+    def __init__(self, sprites=(), cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.sprites = []
+        self.generation = 0
+        for sprite in sprites:
+            self.add(sprite)
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def __iter__(self):
+        return iter(self.sprites)
+
+    def _cell_range(self, rect):
+        size = self.cell_size
+        left = rect.left // size
+        top = rect.top // size
+        right = max(rect.right - 1, rect.left) // size
+        bottom = max(rect.bottom - 1, rect.top) // size
+        return left, top, right, bottom
+
+    def add(self, sprite):
+        """ Index a sprite by its rect.  Sprites are expected not to move
+        """
+        index = len(self.sprites)
+        self.sprites.append(sprite)
+        self.generation += 1
+        left, top, right, bottom = self._cell_range(sprite.rect)
+        cells = self.cells
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    cells[(cx, cy)] = cell = []
+                cell.append((index, sprite))
+
+    def query(self, rect):
+        """ Return every sprite whose rect collides with rect
+        """
+        left, top, right, bottom = self._cell_range(rect)
+        cells = self.cells
+        if left == right and top == bottom:
+            cell = cells.get((left, top))
+            if cell is None:
+                return []
+            return [sprite for index, sprite in cell if rect.colliderect(sprite.rect)]
+
+        found = {}
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    continue
+                for index, sprite in cell:
+                    if index not in found and rect.colliderect(sprite.rect):
+                        found[index] = sprite
+        return [found[index] for index in sorted(found)]
+
+    def collide_any(self, rect):
+        """ Return the first sprite colliding with rect, or None
+
+        This is the indexed version of rect.collidelist(sprites).  It is
+        called for every sensor every tick, so unlike query it builds no list.
+        """
+        left, top, right, bottom = self._cell_range(rect)
+        cells = self.cells
+        first = None
+        first_index = -1
+        # while loops, a range would be allocated for every row
+        cy = top
+        while cy <= bottom:
+            cx = left
+            while cx <= right:
+                cell = cells.get((cx, cy))
+                cx += 1
+                if cell is None:
+                    continue
+                # cells are in the order sprites were added, so the first
+                # hit is the earliest sprite in this cell
+                for index, sprite in cell:
+                    if first_index >= 0 and index >= first_index:
+                        break
+                    if rect.colliderect(sprite.rect):
+                        first = sprite
+                        first_index = index
+                        break
+            cy += 1
+        return first
+
+
+def sweep(box, dx, dy, rects):
+    """ Sweep box, (x, y, width, height), by (dx, dy) against rects
+
+    Returns (time, normal, rect) for the first rect hit: time is the fraction
+    of the move done before touching it and normal the side of it that was
+    hit, (-1, 0) for its left side and so on.  Returns (1, None, None) if the
+    way is clear.
+
+    A box can start out overlapping a rect, the stairs leave the hero half
+    in the floor.  If it is moving along the axis it overlaps the rect least
+    on, it hits the side it is moving away from at time 0 and is pushed back
+    out there, otherwise the rect is ignored so the box can move out of it.
+    """
+    x, y, w, h = box
+    first = 1.0
+    normal = None
+    hit = None
+    for rect in rects:
+        left, top, right, bottom = rect.left, rect.top, rect.right, rect.bottom
+        if x < right and x + w > left and y < bottom and y + h > top:
+            if first == 0:
+                continue
+            overlap_x = min(x + w, right) - max(x, left)
+            overlap_y = min(y + h, bottom) - max(y, top)
+            if overlap_y <= overlap_x:
+                if not dy:
+                    continue
+                normal = (0, -1 if dy > 0 else 1)
+            else:
+                if not dx:
+                    continue
+                normal = (-1 if dx > 0 else 1, 0)
+            first = 0
+            hit = rect
+            continue
+
+        if dx > 0:
+            x_entry = (left - x - w) / dx
+            x_exit = (right - x) / dx
+        elif dx < 0:
+            x_entry = (right - x) / dx
+            x_exit = (left - x - w) / dx
+        elif x + w <= left or x >= right:
+            continue
+        else:
+            x_entry = -INFINITY
+            x_exit = INFINITY
+
+        if dy > 0:
+            y_entry = (top - y - h) / dy
+            y_exit = (bottom - y) / dy
+        elif dy < 0:
+            y_entry = (bottom - y) / dy
+            y_exit = (top - y - h) / dy
+        elif y + h <= top or y >= bottom:
+            continue
+        else:
+            y_entry = -INFINITY
+            y_exit = INFINITY
+
+        entry = max(x_entry, y_entry)
+        if entry < 0 or entry >= first or entry > min(x_exit, y_exit):
+            continue
+        first = entry
+        hit = rect
+        # on a tie the floor or ceiling wins, so boxes slide over the seams
+        # between blocks instead of catching on them
+        if x_entry > y_entry:
+            normal = (-1 if dx > 0 else 1, 0)
+        else:
+            normal = (0, -1 if dy > 0 else 1)
+    return first, normal, hit
+
+
+class Contact(object):
+    """ Where a slide() ended and what the box touched on the way
+
+    time and normal are those of the first wall hit, (1, None) if nothing
+    was.  blocked_x and blocked_y are True if a wall stopped the box along
+    that axis; along an axis that wasn't blocked the box moved all the way.
+    grounded and ceiling are True if there's a wall right under or right
+    over the box where it stopped.
+
+    slide() fills in the Contact it is given, so a moving body can keep one
+    for all its moves.
+    """
+
+    __slots__ = ('x', 'y', 'time', 'normal', 'blocked_x', 'blocked_y', 'grounded', 'ceiling')
+
+    def __init__(self, x=0, y=0, time=1.0, normal=None, blocked_x=False, blocked_y=False,
+                 grounded=False, ceiling=False):
+        self.x = x
+        self.y = y
+        self.time = time
+        self.normal = normal
+        self.blocked_x = blocked_x
+        self.blocked_y = blocked_y
+        self.grounded = grounded
+        self.ceiling = ceiling
+
+
+def sweep_area(box, dx, dy, out=None):
+    """ The pygame rect covering box along the whole of a move, and the
+    contact margin above and below, for querying an index once
+
+    The rect is written to out if given.
+    """
+    x, y, w, h = box
+    left = min(x, x + dx)
+    top = min(y, y + dy) - CONTACT_MARGIN
+    right = max(x, x + dx) + w
+    bottom = max(y, y + dy) + h + CONTACT_MARGIN
+    if out is None:
+        out = pygame.Rect(0, 0, 0, 0)
+    out.update(int(left) - 1, int(top) - 1, int(right - left) + 3, int(bottom - top) + 3)
+    return out
+
+
+def slide(box, dx, dy, rects, iterations=3, contact=None):
+    """ Move box by (dx, dy), stopping at the first wall in the way and
+    sliding along it with what is left of the move
+
+    rects should hold every wall in sweep_area(box, dx, dy).  Returns the
+    Contact, contact itself if given.
+    """
+    x, y, w, h = box
+    # where each axis is headed, a wall in the way moves its target
+    target_x = x + dx
+    target_y = y + dy
+    blocked_x = False
+    blocked_y = False
+    time = 1.0
+    normal = None
+    # a while loop, a range would be allocated every move
+    while iterations > 0:
+        iterations -= 1
+        if x == target_x and y == target_y:
+            break
+        t, n, rect = sweep((x, y, w, h), target_x - x, target_y - y, rects)
+        if n is None:
+            x = target_x
+            y = target_y
+            break
+        if normal is None:
+            time = t
+            normal = n
+        # stop flush against the side that was hit, then carry on along it
+        if n[0]:
+            y += (target_y - y) * t
+            x = target_x = rect.left - w if n[0] < 0 else rect.right
+            blocked_x = True
+        else:
+            x += (target_x - x) * t
+            y = target_y = rect.top - h if n[1] < 0 else rect.bottom
+            blocked_y = True
+
+    grounded = False
+    ceiling = False
+    for rect in rects:
+        if x < rect.right and x + w > rect.left:
+            if y + CONTACT_MARGIN < rect.bottom and y + h + CONTACT_MARGIN > rect.top:
+                grounded = True
+            if y - CONTACT_MARGIN < rect.bottom and y + h - CONTACT_MARGIN > rect.top:
+                ceiling = True
+    if contact is None:
+        return Contact(x, y, time, normal, blocked_x, blocked_y, grounded, ceiling)
+    contact.x = x
+    contact.y = y
+    contact.time = time
+    contact.normal = normal
+    contact.blocked_x = blocked_x
+    contact.blocked_y = blocked_y
+    contact.grounded = grounded
+    contact.ceiling = ceiling
+    return contact
+
+
+def _strips(solid):
+    """ Cover the True cells of a 2d array with rects, as (x, y, w, h) in cells
+
+    Each row is split into runs, and a run carries on the rect above it if
+    that rect spans exactly the same columns.
+    """
+    found = []
+    # (start, end) of a run -> [x, y, w, h] of the rect still growing under it
+    growing = {}
+    for y, row in enumerate(solid):
+        runs = {}
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], row.view(numpy.int8), [0]))))
+        for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            rect = growing.pop((start, end), None)
+            if rect is None:
+                rect = [start, y, end - start, 0]
+            rect[3] += 1
+            runs[(start, end)] = rect
+        found.extend(growing.values())
+        growing = runs
+    found.extend(growing.values())
+    return found
+
+
+def merge_rects(rects):
+    """ Return pygame rects covering exactly the area of rects, usually far
+    fewer of them
+
+    Rects with no area never collide with anything and are dropped, and so
+    are rects inside other rects.  The area is then cut into strips that
+    don't overlap; when the rects overlapped each other a lot that can take
+    more rects than there were, and then the rects that are left are kept
+    as they are.
+    """
+    rects = [pygame.Rect(rect) for rect in rects]
+    rects = [rect for rect in rects if rect.width > 0 and rect.height > 0]
+    # unique, and not inside another
+    rects = sorted(set(tuple(rect) for rect in rects), key=lambda rect: -rect[2] * rect[3])
+    kept = SpatialHash()
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        if not any(block.rect.contains(rect) for block in kept.query(rect)):
+            kept.add(Block(rect))
+    rects = [block.rect for block in kept]
+    if not rects:
+        return []
+
+    # only the edges of the rects matter, so the area is cut into a grid of
+    # cells between consecutive edges
+    xs = sorted(set([rect.left for rect in rects] + [rect.right for rect in rects]))
+    ys = sorted(set([rect.top for rect in rects] + [rect.bottom for rect in rects]))
+    column = dict((x, i) for i, x in enumerate(xs))
+    row = dict((y, i) for i, y in enumerate(ys))
+    solid = numpy.zeros((len(ys) - 1, len(xs) - 1), dtype=bool)
+    for rect in rects:
+        solid[row[rect.top]:row[rect.bottom], column[rect.left]:column[rect.right]] = True
+
+    # strips along rows or along columns, whichever needs fewer
+    by_rows = _strips(solid)
+    by_columns = [(y, x, h, w) for x, y, w, h in _strips(solid.T)]
+    cells = by_rows if len(by_rows) <= len(by_columns) else by_columns
+    if len(cells) >= len(rects):
+        return rects
+    return [pygame.Rect(xs[x], ys[y], xs[x + w] - xs[x], ys[y + h] - ys[y]) for x, y, w, h in cells]
@@ -0,0 +1,134 @@
+""" Drawing and presenting only the parts of the screen that changed.
+
+pyscroll redraws the whole view every frame, and the game then flips the
+whole window.  With software rendering most of that is filling pixels that
+are the same as last frame.  DirtyRects keeps what was on screen last frame
+and works out what has to be redrawn:
+
+- nothing, if the camera, the tiles and every sprite are where they were:
+  the frame isn't drawn or presented at all
+- the whole screen, if the camera scrolled or a tile changed (animations,
+  streamed chunks arriving)
+- otherwise just the old and new rects of the sprites that moved or
+  changed image
+
+Partial frames still render the map into pyscroll's zoom buffer, which at
+zoom 2 is a quarter of the screen, but only the dirty rects are scaled up to
+the screen and handed to pygame.display.update().
+"""
+import time
+
+import pygame
+
+
+def tiles_due(data):
+    """ True if the pyscroll data source has tile changes waiting for the renderer
+    """
+    pending = getattr(data, 'tiles_pending', None)
+    if pending is not None and pending():
+        return True
+    queue = data._animation_queue
+    return bool(queue) and queue[0].next <= time.time() * 1000
+
+
+class DirtyRects(object):
+    """ Draws a CrowdGroup, returning the screen rects that changed
+    """
+
+    def __init__(self):
+        self.camera = None
+        self.sprites = set()
+        # screen rects drawn over since the last frame
+        self.touched = []
+        self.back_buffer = None
+        self.full = True
+        # what the last frame did, for the stats overlay and benchmarks
+        self.frames = {'skipped': 0, 'partial': 0, 'full': 0}
+
+    def invalidate(self):
+        """ Redraw everything next frame, after a resize or a change of map
+        """
+        self.full = True
+
+    def touch(self, rect):
+        """ Note a screen rect that was drawn over after the map, by the stats
+        overlay say: the map under it is redrawn next frame
+        """
+        self.touched.append(pygame.Rect(rect))
+
+    def draw(self, group, surface):
+        """ Draw the frame, return the list of rects to present
+        """
+        map_layer = group._map_layer
+        screen = surface.get_rect()
+        buffer = map_layer._zoom_buffer
+        if buffer is None:
+            # no zoom, render to a back buffer of our own so partial frames
+            # can still be copied out of a complete one
+            if self.back_buffer is None or self.back_buffer.get_size() != screen.size:
+                self.back_buffer = pygame.Surface(screen.size).convert()
+            buffer = self.back_buffer
+        view = buffer.get_rect()
+
+        camera = (tuple(map_layer.view_rect), map_layer._x_offset, map_layer._y_offset)
+        surfaces = group.surfaces()
+        # sprite rects can be smaller than their images, what gets drawn
+        # over is the image
+        sprites = set((image, rect.topleft) for image, rect, layer in surfaces)
+
+        full = self.full or camera != self.camera or tiles_due(map_layer.data)
+        changed = sprites.symmetric_difference(self.sprites)
+        if not full and not changed and not self.touched:
+            self.frames['skipped'] += 1
+            return []
+        if screen.w % view.w or screen.h % view.h:
+            # rects can't be scaled up pixel for pixel the way pyscroll
+            # scales the whole view
+            full = True
+
+        map_layer._render_map(buffer, view, surfaces)
+        if map_layer._tile_queue:
+            # a tile changed while rendering
+            full = True
+
+        self.camera = camera
+        self.sprites = sprites
+        touched = self.touched
+        self.touched = []
+        self.full = False
+
+        if full:
+            self.frames['full'] += 1
+            self._present(buffer, surface, view, screen)
+            return [screen]
+
+        self.frames['partial'] += 1
+        scale_x = screen.w // view.w
+        scale_y = screen.h // view.h
+        dirty = []
+        for image, position in changed:
+            rect = pygame.Rect(position, image.get_size()).clip(view)
+            if rect:
+                dirty.append(pygame.Rect(rect.x * scale_x, rect.y * scale_y,
+                                         rect.w * scale_x, rect.h * scale_y))
+        for rect in touched:
+            # back to buffer pixels, rounding outwards
+            left = rect.left // scale_x
+            top = rect.top // scale_y
+            right = -(-rect.right // scale_x)
+            bottom = -(-rect.bottom // scale_y)
+            rect = pygame.Rect(left, top, right - left, bottom - top).clip(view)
+            if rect:
+                dirty.append(pygame.Rect(rect.x * scale_x, rect.y * scale_y,
+                                         rect.w * scale_x, rect.h * scale_y))
+
+        for rect in dirty:
+            source = pygame.Rect(rect.x // scale_x, rect.y // scale_y, rect.w // scale_x, rect.h // scale_y)
+            self._present(buffer.subsurface(source), surface.subsurface(rect), source, rect)
+        return dirty
+
+    def _present(self, source, target, source_rect, target_rect):
+        if source_rect.size == target_rect.size:
+            target.blit(source, (0, 0))
+        else:
+            pygame.transform.scale(source, target_rect.size, target)
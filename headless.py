@@ -0,0 +1,63 @@
+""" Running the game without a window.
+
+SDL's dummy video driver gives pygame a display that never shows anything, so
+surfaces can still be converted and drawn to.  Input comes from a script
+instead of the keyboard.
+"""
+import os
+
+import pygame
+
+
+def init_headless(size=(800, 600)):
+    """ Start pygame on the dummy video driver and return the display surface
+
+    Must be called before anything else initialises the display.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.init()
+    return pygame.display.set_mode(size)
+
+
+class KeyState(object):
+    """ Stands in for the result of pygame.key.get_pressed()
+    """
+
+    def __init__(self, keys=()):
+        self.keys = frozenset(keys)
+
+    def __getitem__(self, key):
+        return key in self.keys
+
+
+class ScriptedInput(object):
+    """ Feeds held keys to the game from a script
+
+    The script is a list of (ticks, keys) steps: keys are held for that many
+    calls, one call per simulation tick.  Pass an instance to QuestGame as
+    get_pressed.  Once the script runs out nothing is held, unless loop is
+    set, in which case it starts over.
+    """
+
+    def __init__(self, script, loop=False):
+        self.script = [(ticks, KeyState(keys)) for ticks, keys in script]
+        self.loop = loop
+        self.released = KeyState()
+        self.step = 0
+        self.ticks_left = self.script[0][0] if self.script else 0
+
+    @property
+    def finished(self):
+        return self.step >= len(self.script)
+
+    def __call__(self):
+        while self.ticks_left <= 0:
+            self.step += 1
+            if self.step >= len(self.script):
+                if not self.loop or not self.script:
+                    return self.released
+                self.step = 0
+            self.ticks_left = self.script[self.step][0]
+        self.ticks_left -= 1
+        return self.script[self.step][1]
@@ -0,0 +1,438 @@
+""" The hero: how it moves, collides and is animated.
+
+Hero methods that need the level take the game as an argument and use its
+wall_index, stair_index and debug flag, so a sim.Simulation can stand in for
+QuestGame and run the same code without a window.
+"""
+import math
+
+import pygame
+from pygame.locals import K_DOWN, K_LEFT, K_RIGHT, K_SPACE, K_UP
+
+import assets
+import collision
+import instrument
+
+
+class Hero(pygame.sprite.Sprite):
+    """ Our Hero
+
+    The Hero has three collision rects, one for the whole sprite "rect" and
+    "old_rect", and another to check collisions with walls, called "feet".
+
+    The position list is used because pygame rects are inaccurate for
+    positioning sprites; because the values they get are 'rounded down'
+    as integers, the sprite would move faster moving left or up.
+
+    Feet is 1/2 as wide as the normal rect, and 8 pixels tall.  This size size
+    allows the top of the sprite to overlap walls.  The feet rect is used for
+    collisions, while the 'rect' rect is used for drawing.
+
+    There is also an old_rect that is used to reposition the sprite if it
+    collides with level walls.
+
+    The sensors are rects kept on the hero and moved with it at the end of
+    every move, so the checks made every tick don't allocate anything.  The
+    rects are shared; copy one to keep it past the next move.  position is
+    shared the same way.
+
+    What a tick reads and writes is in slots.  pygame's Sprite has a
+    __dict__ anyway, the images and rect stay in it.
+    """
+
+    __slots__ = (
+        'climbing_direction', 'time_spent_climbing', 'time_since_last_jump', 'time_in_state',
+        'current_frame', 'grounded', 'touching_ceiling', 'velocity', 'state', 'facing',
+        '_position', '_old_position', 'stair_sensor', 'body_sensor', 'nearby_index',
+        'nearby_generation', 'nearby_walls', 'nearby_area', 'sweep_area', 'contact',
+    )
+
+    # CONSTANTS
+    HERO_JUMP_HEIGHT = 180
+    HERO_MOVE_SPEED = 200  # pixels per second
+    GRAVITY = 1000
+
+    # STATE DEFINITIONS
+    STATE_STANDING = 0
+    STATE_WALKING = 1
+    STATE_JUMPING = 2
+    STATE_ON_STAIRS = 3
+    STATE_CROUCHED = 4
+
+    # only used to pick an animation, the hero is never in this state
+    CLIP_DESCENDING_STAIRS = 5
+
+    FRAME_DELAY_STANDING = 1
+    FRAME_DELAY_WALKING = 1
+    FRAME_DELAY_JUMPING = 1
+
+    # ANIMATION - Lower is slower, in frames per millisecond
+    ANIMATION_SPEED_WALKING = .25
+    ANIMATION_SPEED_STANDING = .002
+    ANIMATION_SPEED_JUMPING = 1
+    ANIMATION_SPEED_CLIMBING_UP = 1
+    ANIMATION_SPEED_CLIMBING_DOWN = .1
+
+    JUMP_DELAY = .3
+
+    CLIMBING_DELAY = .3
+    CLIMBING_RATE = 1
+    CLIMBING_SPEED = 200
+
+    CLIMBING_UP = 0
+    CLIMBING_DOWN = 1
+
+    FACING_RIGHT = 0
+    FACING_LEFT = 1
+
+    MILLISECONDS_TO_SECONDS = 1000.0
+
+    COLLISION_BOX_OFFSET = 8
+
+    # walls are looked up this many pixels wider and taller than a move
+    # needs, and reused while the moves stay inside that.  streamed maps load
+    # 32 pixels around the hero, so the lookup has to stay within that
+    NEARBY_MARGIN = 32
+
+    # every animation frame is this big
+    FRAME_SIZE = (32, 32)
+
+    def __init__(self, map_data_object, sprites=True):
+        """ sprites=False leaves out the images, for simulating the hero
+        without a display (see sim.py): it is never animated then
+        """
+        pygame.sprite.Sprite.__init__(self)
+
+        self.climbing_direction = 0
+        self.time_spent_climbing = 0.0
+        self.time_since_last_jump = 0
+        self.time_in_state = 0.0
+        self.current_frame = 0
+        # walls right under and right over the hero, as of the last move
+        self.grounded = False
+        self.touching_ceiling = False
+        if sprites:
+            self.load_sprites()
+        else:
+            self.animations = {}
+            self.image = None
+        self.velocity = [0, 0]
+        self.state = self.STATE_STANDING
+        self.facing = self.FACING_RIGHT
+        self._position = [map_data_object.x, map_data_object.y]
+        self._old_position = list(self._position)
+        self.rect = pygame.Rect(8, 0, self.FRAME_SIZE[0] - 8, self.FRAME_SIZE[1])
+
+        # sensors, see update_sensors
+        self.stair_sensor = pygame.Rect(0, 0, 0, 0)
+        self.body_sensor = pygame.Rect(0, 0, 0, 0)
+        # the walls around the last move, and the area and index generation
+        # they were looked up for: moves inside it reuse them until the index
+        # changes, like when chunks stream in
+        self.nearby_index = None
+        self.nearby_generation = -1
+        self.nearby_walls = []
+        self.nearby_area = pygame.Rect(0, 0, 0, 0)
+        self.sweep_area = pygame.Rect(0, 0, 0, 0)
+        self.contact = collision.Contact()
+
+    def set_state(self, state):
+        if self.state != state:
+            self.state = state
+            self.time_in_state = 0.0
+
+    def snap_to_stair(self, dt, game):
+        stair_sensor = self.get_stair_sensor()
+        stair = game.stair_index.collide_any(stair_sensor)
+        if stair is not None:
+            self.rect.bottom = stair.rect.top
+            self.set_state(self.STATE_ON_STAIRS)
+            self._position[1] = self.rect.top
+            self.update_contacts(game)
+
+    def detects_stairs(self, game):
+        stair_sensor = self.get_stair_sensor()
+        return game.stair_index.collide_any(stair_sensor) is not None
+
+
+    def load_sprites(self):
+        """ Cut every animation out of the spritesheet once
+
+        Builds self.animations, keyed by (clip, facing).  Each clip holds
+        its frames already flipped for that facing, so animate only has to
+        pick a frame.
+        """
+        self.spritesheet = Spritesheet('data/art/platformer_template_g.png')
+        # Each frame is FRAME_SIZE, their transparent colour is (0, 255, 81).
+        # The spritesheet hands back frames that are already converted.
+        clips = (
+            # clip, frame positions on the sheet, animation speed, uses climbing time
+            (self.STATE_STANDING, ((0, 0), (32, 0), (64, 0), (96, 0)),
+             self.ANIMATION_SPEED_STANDING, False),
+            (self.STATE_WALKING, ((192, 0), (96, 0), (64, 32), (96, 0)),
+             self.ANIMATION_SPEED_WALKING, False),
+            (self.STATE_JUMPING, ((160, 160),),
+             self.ANIMATION_SPEED_JUMPING, False),
+            (self.STATE_ON_STAIRS, ((32, 192), (128, 192)),
+             self.ANIMATION_SPEED_CLIMBING_UP, True),
+            (self.CLIP_DESCENDING_STAIRS, ((32, 224), (128, 224)),
+             self.ANIMATION_SPEED_CLIMBING_DOWN, True),
+        )
+
+        self.animations = {}
+        for clip, positions, speed, climbing in clips:
+            rects = [pygame.Rect((x, y), self.FRAME_SIZE) for x, y in positions]
+            frame_duration = 1 / (speed * self.MILLISECONDS_TO_SECONDS)
+            self.animations[(clip, self.FACING_RIGHT)] = AnimationClip(
+                self.spritesheet.images_at(rects, colorkey=(0, 255, 81)), frame_duration, climbing)
+            self.animations[(clip, self.FACING_LEFT)] = AnimationClip(
+                self.spritesheet.images_at(rects, colorkey=(0, 255, 81), flip=True), frame_duration, climbing)
+
+        self.image = self.animations[(self.STATE_STANDING, self.FACING_RIGHT)].frames[self.current_frame]
+
+    @property
+    def position(self):
+        """ The hero's [x, y] itself, not a copy
+        """
+        return self._position
+
+    @position.setter
+    def position(self, value):
+        self._position[0], self._position[1] = value
+
+    def update_sensors(self):
+        """ Move the sensor rects to where the hero is
+        """
+        x = self._position[0] + self.COLLISION_BOX_OFFSET
+        y = self._position[1]
+        width = self.rect.width - self.COLLISION_BOX_OFFSET
+        self.stair_sensor.update(x, y + self.rect.height - 2, width, 4)
+        self.body_sensor.update(x, y, width, self.rect.height)
+
+    def get_stair_sensor(self):
+        return self.stair_sensor
+
+    def get_body_sensor(self):
+        return self.body_sensor
+
+    def get_collision_box(self):
+        """ The body sensor as (x, y, width, height), without rounding
+        """
+        return (self._position[0] + self.COLLISION_BOX_OFFSET, self._position[1],
+                self.rect.width - self.COLLISION_BOX_OFFSET, self.rect.height)
+
+
+    def calc_grav(self, game, dt):
+        """ Calculate effect of gravity. """
+        if not self.grounded:
+            if self.velocity[1] == 0:
+                self.velocity[1] = self.GRAVITY * dt
+            else:
+                self.velocity[1] += self.GRAVITY * dt
+            if __debug__ and game.debug:
+                instrument.trace('gravity', velocity=self.velocity[1])
+
+    def animate(self, dt, game):
+        if self.state == self.STATE_ON_STAIRS and self.velocity[1] > 0:
+            clip = self.CLIP_DESCENDING_STAIRS
+        else:
+            clip = self.state
+
+        animation = self.animations.get((clip, self.facing))
+        if animation is None:
+            if __debug__ and game.debug:
+                instrument.trace('animate', state=self.state, clip=None)
+            return
+
+        if animation.climbing:
+            clock = self.time_spent_climbing
+        else:
+            clock = self.time_in_state
+        self.current_frame = int(clock / animation.frame_duration) % animation.frame_count
+        self.image = animation.frames[self.current_frame]
+
+        if __debug__ and game.debug:
+            instrument.trace('animate', state=self.state, frame=self.current_frame, dt=dt)
+
+    def control(self, pressed, dt, game):
+        """ Walk, jump and climb by the held keys
+
+        pressed is indexed by key like the result of pygame.key.get_pressed().
+        """
+        # as of the last move, snapping to a stair doesn't count
+        grounded = self.grounded
+
+        if self.detects_stairs(game) != True and self.state == self.STATE_ON_STAIRS:
+            self.state = self.STATE_STANDING
+
+        # Ascend Stairs
+        if pressed[K_UP] and not pressed[K_DOWN]:
+            if self.state == self.STATE_ON_STAIRS:
+                if self.facing == self.FACING_RIGHT:
+                    self.velocity[0] = self.CLIMBING_SPEED
+                else:
+                    self.velocity[0] = -self.CLIMBING_SPEED
+                self.velocity[1] = -self.CLIMBING_SPEED
+            else:
+                self.snap_to_stair(dt, game)
+        # Descend stairs
+        if pressed[K_DOWN] and not pressed[K_UP]:
+            if self.state == self.STATE_ON_STAIRS:
+                if self.facing == self.FACING_RIGHT:
+                    self.velocity[0] = self.CLIMBING_SPEED
+                else:
+                    self.velocity[0] = -self.CLIMBING_SPEED
+                self.velocity[1] = self.CLIMBING_SPEED
+            else:
+                self.snap_to_stair(dt, game)
+        if grounded and self.state != self.STATE_ON_STAIRS:
+
+            #JUMP
+            if pressed[K_SPACE] and self.time_since_last_jump >= self.JUMP_DELAY:
+                self.set_state(self.STATE_JUMPING)
+
+                # stop the player animation
+                if pressed[K_LEFT] and pressed[K_RIGHT] == False:
+                    # play the jump left animations
+                    self.velocity[0] = -self.HERO_MOVE_SPEED
+                    self.facing = self.FACING_LEFT
+                elif pressed[K_RIGHT] and pressed[K_LEFT] == False:
+                    self.velocity[0] = self.HERO_MOVE_SPEED
+                    self.facing = self.FACING_RIGHT
+                self.velocity[1]= -self.HERO_JUMP_HEIGHT
+                self.time_since_last_jump = 0
+            elif pressed[K_LEFT] and pressed[K_RIGHT] == False:
+                self.set_state(self.STATE_WALKING)
+                self.facing = self.FACING_LEFT
+                self.velocity[0] = -self.HERO_MOVE_SPEED
+            elif pressed[K_RIGHT] and pressed[K_LEFT] == False:
+                self.set_state(self.STATE_WALKING)
+                self.facing = self.FACING_RIGHT
+                self.velocity[0] = self.HERO_MOVE_SPEED
+            else:
+                self.state = self.STATE_STANDING
+                self.velocity[0] = 0
+
+    def update(self, dt, game):
+        self.time_since_last_jump += dt
+        self.calc_grav(game, dt)
+        if self.image is not None:
+            self.animate(dt, game)
+        self.time_in_state += dt
+
+        self._old_position[0] = self._position[0]
+        self._old_position[1] = self._position[1]
+        self.move(dt, game)
+
+
+    def move(self, dt, game):
+        # Move each axis separately. Note that this checks for collisions both times.
+        if self.state == self.STATE_ON_STAIRS:
+            if self.time_in_state > self.CLIMBING_DELAY:
+                if self.time_spent_climbing >= self.CLIMBING_RATE:
+                    positions_to_move = math.floor(self.time_spent_climbing / self.CLIMBING_RATE)
+                    self.time_spent_climbing = self.time_spent_climbing % self.CLIMBING_RATE
+                    self._position[0] += dt * positions_to_move * self.velocity[0]
+                    self._position[1] += dt * positions_to_move * self.velocity[1]
+                    if __debug__ and game.debug:
+                        instrument.trace('stairs', positions_to_move=positions_to_move)
+                else:
+                    self.time_spent_climbing += dt
+            self.update_contacts(game)
+        else:
+            self.sweep_move(self.velocity[0] * dt, self.velocity[1] * dt, game)
+        self.rect.topleft = self._position
+
+    def interpolate(self, alpha):
+        """ Place the drawing rect between the last two simulated positions
+
+        alpha is how far into the next tick the frame is drawn, 1 puts the
+        rect on the current position.
+        """
+        old = self._old_position
+        new = self._position
+        self.rect.topleft = (old[0] + (new[0] - old[0]) * alpha,
+                             old[1] + (new[1] - old[1]) * alpha)
+
+    def sweep_move(self, dx, dy, game):
+        """ Move by (dx, dy), stopping at walls and sliding along them
+
+        The move is swept, so the hero can't pass through a wall however big
+        the step.  Returns the collision.Contact.
+        """
+        box = self.get_collision_box()
+        area = collision.sweep_area(box, dx, dy, self.sweep_area)
+        walls = self.nearby_walls
+        index = game.wall_index
+        if (index is not self.nearby_index or index.generation != self.nearby_generation
+                or not self.nearby_area.contains(area)):
+            # look up a bit more than needed, so the next few moves don't have to
+            self.nearby_index = index
+            self.nearby_generation = index.generation
+            self.nearby_area = area.inflate(self.NEARBY_MARGIN, self.NEARBY_MARGIN)
+            walls[:] = [wall.rect for wall in index.query(self.nearby_area)]
+        contact = collision.slide(box, dx, dy, walls, contact=self.contact)
+        # an axis that wasn't blocked moved exactly (dx, dy), don't round it
+        # through the box
+        if contact.blocked_x:
+            self._position[0] = contact.x - self.COLLISION_BOX_OFFSET
+        else:
+            self._position[0] += dx
+        if contact.blocked_y:
+            self._position[1] = contact.y
+        else:
+            self._position[1] += dy
+        self.grounded = contact.grounded
+        self.touching_ceiling = contact.ceiling
+        self.update_sensors()
+        if __debug__ and game.debug and contact.normal is not None:
+            instrument.trace('impact', time=contact.time, normal=contact.normal)
+        return contact
+
+    def update_contacts(self, game):
+        """ Work out grounded and touching_ceiling after moving some other way
+        """
+        self.sweep_move(0, 0, game)
+
+
+class AnimationClip(object):
+    """ The frames of one animation, facing one way
+
+    frame_duration is in seconds.  Climbing clips are timed by the time
+    spent climbing instead of the time in the current state.
+    """
+
+    def __init__(self, frames, frame_duration, climbing=False):
+        self.frames = tuple(frames)
+        self.frame_count = len(self.frames)
+        self.frame_duration = frame_duration
+        self.climbing = climbing
+
+
+class Spritesheet(object):
+    """ Cuts images out of a spritesheet
+
+    Sheets and the images cut from them live in the shared asset cache, so
+    any number of Spritesheets for the same file cost one load.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.sheet = assets.cache.sheet(filename)
+        except (pygame.error, IOError):
+            print('Unable to load spritesheet image: {}'.format(filename))
+            raise SystemExit
+    # Load a specific image from a specific rectangle
+    def image_at(self, rectangle, colorkey = None, flip = False):
+        "Loads image from x,y,x+offset,y+offset, mirrored if flip"
+        return assets.cache.image_at(self.filename, rectangle, colorkey, flip)
+    # Load a whole bunch of images and return them as a list
+    def images_at(self, rects, colorkey = None, flip = False):
+        "Loads multiple images, supply a list of coordinates"
+        return [self.image_at(rect, colorkey, flip) for rect in rects]
+    # Load a whole strip of images
+    def load_strip(self, rect, image_count, colorkey = None):
+        "Loads a strip of images and returns them as a list"
+        tups = [(rect[0]+rect[2]*x, rect[1], rect[2], rect[3])
+                for x in range(image_count)]
+        return self.images_at(tups, colorkey)
@@ -0,0 +1,213 @@
+""" Tracing, frame timing and profiling.
+
+Trace points in the hot path are written as
+
+    if __debug__ and game.debug:
+        instrument.trace('event', key=value)
+
+so they cost one attribute check normally, and nothing at all when python
+runs with -O: the compiler drops the whole block.
+
+FrameTimer keeps how long each phase of the last few hundred frames took in a
+ring buffer, and works out percentiles from it on demand.
+
+StackSampler captures what a thread is doing by sampling its stack from a
+background thread, and writes the result as collapsed stacks, the input
+format of flamegraph.pl, speedscope and similar tools.  Nothing runs while no
+capture is active.
+"""
+import json
+import os.path
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+import numpy
+import pygame
+
+# the most recent trace records, (time, event, fields)
+recent_traces = deque(maxlen=1000)
+
+# where traces are echoed as they happen, None to only keep them in memory
+trace_file = sys.stdout
+
+
+def trace(event, **fields):
+    """ Record a trace point
+    """
+    recent_traces.append((time.perf_counter(), event, fields))
+    if trace_file is not None:
+        trace_file.write("{} {}\n".format(event, " ".join(
+            "{}={}".format(key, value) for key, value in sorted(fields.items()))))
+
+
+class FrameTimer(object):
+    """ Per phase timings of recent frames
+
+    Call add() with the seconds spent in a phase as often as needed during a
+    frame, then end_frame() with the whole frame time.  Only the last
+    capacity frames are kept.
+    """
+
+    PHASES = ('input', 'update', 'draw', 'flip')
+    INPUT, UPDATE, DRAW, FLIP = range(4)
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, capacity=600):
+        self.capacity = capacity
+        # one row per frame: each phase, then the whole frame
+        self.samples = numpy.zeros((capacity, len(self.PHASES) + 1))
+        self.current = [0.0] * len(self.PHASES)
+        self.frames = 0
+
+    def add(self, phase, seconds):
+        self.current[phase] += seconds
+
+    def end_frame(self, frame_time):
+        row = self.samples[self.frames % self.capacity]
+        row[:-1] = self.current
+        row[-1] = frame_time
+        self.current = [0.0] * len(self.PHASES)
+        self.frames += 1
+
+    def recent(self):
+        """ The kept frames, oldest first
+        """
+        if self.frames <= self.capacity:
+            return self.samples[:self.frames]
+        start = self.frames % self.capacity
+        return numpy.concatenate((self.samples[start:], self.samples[:start]))
+
+    def stats(self):
+        """ p50/p95/p99 of each phase and of the whole frame, in milliseconds
+        """
+        samples = self.recent()
+        if len(samples) == 0:
+            return {}
+        values = numpy.percentile(samples, self.PERCENTILES, axis=0) * 1000
+        names = self.PHASES + ('frame',)
+        return dict((name, dict(('p{}'.format(p), round(float(values[i][column]), 3))
+                                for i, p in enumerate(self.PERCENTILES)))
+                    for column, name in enumerate(names))
+
+    def jitter(self, period):
+        """ How far frame times stray from period seconds: the mean and p99
+        of the difference and its standard deviation, in milliseconds
+        """
+        frame_times = self.recent()[:, -1]
+        if len(frame_times) == 0:
+            return {}
+        off = numpy.abs(frame_times - period) * 1000
+        return {
+            'mean': round(float(off.mean()), 3),
+            'p99': round(float(numpy.percentile(off, 99)), 3),
+            'std': round(float(frame_times.std() * 1000), 3),
+        }
+
+    def summary(self):
+        """ The stats and the kept frames, in milliseconds, as what export()
+        writes
+        """
+        return {
+            'frames': self.frames,
+            'phases': list(self.PHASES) + ['frame'],
+            'stats': self.stats(),
+            'recent': (self.recent() * 1000).round(3).tolist(),
+        }
+
+    def export(self, path):
+        """ Write the stats and the kept frames, in milliseconds, as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+class StatsOverlay(object):
+    """ Draws the frame timer's percentiles in the corner of the screen
+
+    The numbers are only worked out again every refresh frames.
+    """
+
+    def __init__(self, timer, refresh=30):
+        self.timer = timer
+        self.refresh = refresh
+        self.font = pygame.font.Font(None, 18)
+        self.lines = []
+        self.last_refresh = -refresh
+
+    def draw(self, surface):
+        """ Draw the stats, return the rect drawn over
+        """
+        if self.timer.frames - self.last_refresh >= self.refresh:
+            self.last_refresh = self.timer.frames
+            self.lines = [self.font.render(
+                "{:<7} p50 {p50:6.2f}  p95 {p95:6.2f}  p99 {p99:6.2f} ms".format(name, **values),
+                True, (255, 255, 255), (0, 0, 0))
+                for name, values in sorted(self.timer.stats().items())]
+        area = pygame.Rect(4, 4, 0, 0)
+        y = 4
+        for line in self.lines:
+            area.union_ip(surface.blit(line, (4, y)))
+            y += line.get_height()
+        return area
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    """ Samples the stack of one thread every interval seconds
+
+    Stacks are counted by their collapsed form, root first.  tags is called
+    on every sample and its result, a list of strings, goes in front of the
+    stack so samples can be told apart by what the game was doing.
+    """
+
+    def __init__(self, thread_id=None, interval=.001, tags=None):
+        if thread_id is None:
+            thread_id = threading.get_ident()
+        self.thread_id = thread_id
+        self.interval = interval
+        self.tags = tags
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        frames = sys._current_frames
+        while not self._stop.wait(self.interval):
+            frame = frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            if self.tags is not None:
+                stack = self.tags() + stack
+            self.counts[";".join(stack)] += 1
+            self.samples += 1
+
+    def write(self, path):
+        """ Write the samples as collapsed stacks, one "frame;frame count" per line
+        """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write("{} {}\n".format(stack, count))
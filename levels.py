@@ -0,0 +1,345 @@
+""" Switching between maps without stalling the game.
+
+A Level is everything the game needs from one map that doesn't change while
+it is played: the parsed map with its tile images decoded, the walls, stairs
+and doors with their collision indices, and the spawn points.  Building one
+is the slow part of changing maps, so the LevelManager builds them on a
+thread pool ahead of time: when the hero enters a map, every map its doors
+lead to starts loading in the background.  By the time the hero reaches a
+door the next level is usually ready, and the switch only has to make a new
+renderer.
+
+The last few levels visited are kept, so walking back through a door is
+instant too.
+
+load_level() is what builds a Level from a map, set up by the settings
+below.  It is the loader the game gives the LevelManager, and sim.py and
+navigation.py use it too, with graphics=False.
+
+Doors are objects of type 'door' on the map, with the properties
+
+    map     the map the door leads to, relative to this map's directory
+    spawn   the name of the object on that map to arrive at, by default
+            the map's hero spawn
+"""
+import os.path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+import pytmx
+from pytmx.util_pygame import load_pygame
+
+import pyscroll.data
+
+import mapcache
+import navigation
+import streaming
+from collision import SpatialHash, merge_rects
+from tilegrid import TileGrid
+
+# load maps through the compiled map cache, see mapcache.py.  when False the
+# TMX is parsed on every launch
+USE_MAP_CACHE = True
+
+# stream the map in chunks around the camera instead of loading all of it, for
+# maps too big to keep in memory: see streaming.py.  chunks are square, this
+# many tiles a side, and the chunks within STREAM_RADIUS of the camera are
+# kept loaded.  more are kept while they fit in STREAM_BUDGET bytes
+STREAMING = False
+STREAM_CHUNK_SIZE = 32
+STREAM_RADIUS = 1
+STREAM_BUDGET = 16 * 1024 * 1024
+
+# where walls and stairs come from.  'objects' uses the wall and stair objects
+# drawn on the map, 'tiles' uses the tiles themselves: see tilegrid.py
+COLLISION_MODE = 'objects'
+
+# in 'objects' mode, merge the wall objects into as few rects as cover the
+# same area when the map is loaded, see collision.merge_rects()
+MERGE_WALLS = True
+
+# in 'tiles' mode, tiles with these properties set are walls / stairs, and so
+# is every tile on the layers with these names
+WALL_TILE_PROPERTY = 'solid'
+WALL_TILE_LAYER = 'collision'
+STAIR_TILE_PROPERTY = 'stair'
+STAIR_TILE_LAYER = 'stairs'
+
+# pick up the graph of where a hero sized body can get to on each map when it
+# loads, for NPCs to find their way.  graphs are built ahead of time with
+# python navigation.py, see navigation.py.  not done when streaming
+NAVIGATION = False
+
+
+class Level(object):
+    """ The static parts of one map
+
+    The game fills in what it needs; close() is called when the level is
+    dropped from the manager.
+    """
+
+    def __init__(self, filename, tmx_data):
+        self.filename = filename
+        self.tmx_data = tmx_data
+        self.walls = []
+        self.stairs = []
+        self.doors = []
+        # (x, y) of the guards' feet
+        self.guards = []
+        self.hero_spawn = None
+        # named objects, for doors to arrive at
+        self.named = {}
+        self.wall_index = None
+        self.stair_index = None
+        self.door_index = None
+        # the tilegrid.TileGrid the guards walk on
+        self.grid = None
+        # navigation.NavGraph of where the hero can get to, if worked out
+        self.navigation = None
+        self.map_data = None
+        # rendercache.RendererCache for map_data, made when first played
+        self.renderers = None
+        # the streaming.ChunkedWorld behind the map, when streaming
+        self.world = None
+
+    def spawn_point(self, name=None):
+        """ Where the hero arrives: ((x, y), standing)
+
+        At the object called name the hero stands on its bottom, standing is
+        True and (x, y) is where their feet go.  Otherwise (x, y) is the top
+        left of the hero, at the map's hero spawn or else the map centre.
+        """
+        arrival = self.named.get(name) if name else None
+        if arrival is not None:
+            return (arrival.x, arrival.y + arrival.height), True
+        if self.hero_spawn is not None:
+            return self.hero_spawn, False
+        print("map has no hero spawn: placing hero at the map centre")
+        tmx_data = self.tmx_data
+        return (tmx_data.width * tmx_data.tilewidth // 2,
+                tmx_data.height * tmx_data.tileheight // 2), False
+
+    def close(self):
+        if self.world is not None:
+            self.world.close()
+
+
+def door_target(filename, map_object):
+    """ The map a door object leads to, and the name of the object to arrive at
+    """
+    target = map_object.properties.get('map')
+    if not target:
+        return None, None
+    return os.path.join(os.path.dirname(filename), target), map_object.properties.get('spawn')
+
+
+class Wall(pygame.sprite.Sprite):
+    """
+        A sprite extension for all the walls in the game
+    """
+
+    def __init__(self, map_data_object):
+        pygame.sprite.Sprite.__init__(self)
+        self._position = [map_data_object.x, map_data_object.y]
+        self.rect = pygame.Rect(
+            map_data_object.x, map_data_object.y,
+            map_data_object.width, map_data_object.height)
+
+    @property
+    def position(self):
+        return list(self._position)
+
+    @position.setter
+    def position(self, value):
+        self._position = list(value)
+
+
+class Door(Wall):
+    """
+        Walking into a door takes the hero to another map, see LevelManager
+    """
+
+    def __init__(self, map_data_object, target, spawn):
+        Wall.__init__(self, map_data_object)
+        self.target = target
+        self.spawn = spawn
+
+
+def load_level(filename, graphics=True):
+    """ Load a map and build everything static the game needs from it
+
+    Runs on the level loader threads.  The tile images are loaded and
+    converted to the display format there too, by pytmx's image loader:
+    converting only reads the pixel format of the display, which is set
+    before any level loads, and nothing here draws to it.  With
+    graphics=False only the collision and spawn points are loaded, the
+    map is never streamed and the level has no map_data to draw.
+    """
+    # load data from the compiled map cache, or straight from pytmx.  when
+    # streaming only the spawn points are loaded here, the rest of the map
+    # follows the camera
+    world = None
+    if STREAMING and graphics:
+        world = streaming.ChunkedWorld(filename, STREAM_CHUNK_SIZE, STREAM_RADIUS, STREAM_BUDGET)
+        tmx_data = world
+    elif USE_MAP_CACHE:
+        tmx_data = mapcache.load_map(filename, load_images=graphics)
+    elif graphics:
+        tmx_data = load_pygame(filename)
+    else:
+        tmx_data = pytmx.TiledMap(filename)
+    level = Level(filename, tmx_data)
+    level.world = world
+
+    # setup level geometry with simple pygame rects, loaded from pytmx
+    for map_object in tmx_data.objects:
+        if map_object.name:
+            level.named[map_object.name] = map_object
+        if map_object.type == "wall":
+            level.walls.append(Wall(map_object))
+        elif map_object.type == "stair":
+            level.stairs.append(Wall(map_object))
+        elif map_object.type == "guard":
+            # stand the guard on the bottom of its object
+            level.guards.append((map_object.x, map_object.y + map_object.height))
+        elif map_object.type == "hero":
+            level.hero_spawn = map_object.x, map_object.y
+        elif map_object.type == "door":
+            target, spawn = door_target(filename, map_object)
+            if target is not None:
+                level.doors.append(Door(map_object, target, spawn))
+
+    if MERGE_WALLS and level.walls:
+        # the compiled map cache has them merged already
+        rects = getattr(tmx_data, 'merged_walls', None)
+        if rects is None:
+            rects = merge_rects(wall.rect for wall in level.walls)
+        level.walls = [Wall(pygame.Rect(rect)) for rect in rects]
+
+    # index the static geometry so sensors only test nearby rects
+    if world is not None:
+        level.wall_index = world.walls
+        level.stair_index = world.stairs
+    elif COLLISION_MODE == 'tiles':
+        level.wall_index = TileGrid.from_map(tmx_data, WALL_TILE_PROPERTY, WALL_TILE_LAYER)
+        level.stair_index = TileGrid.from_map(tmx_data, STAIR_TILE_PROPERTY, STAIR_TILE_LAYER)
+    else:
+        level.wall_index = SpatialHash(level.walls)
+        level.stair_index = SpatialHash(level.stairs)
+    level.door_index = SpatialHash(level.doors)
+
+    # guards see the walls one tile at a time
+    if isinstance(level.wall_index, TileGrid):
+        level.grid = level.wall_index
+    else:
+        level.grid = TileGrid.from_rects(
+            [wall.rect for wall in level.walls], tmx_data.tilewidth, tmx_data.tileheight,
+            tmx_data.width, tmx_data.height)
+        if world is not None:
+            world.track_grid(level.grid)
+
+    if NAVIGATION and world is None:
+        level.navigation = navigation.cached(level)
+        if level.navigation is None:
+            print("no navigation graph for {0}, build it with: python navigation.py {0}".format(filename))
+
+    if not graphics:
+        return level
+
+    # create new data source for pyscroll
+    if world is not None:
+        level.map_data = streaming.StreamingMapData(world)
+    elif USE_MAP_CACHE:
+        level.map_data = mapcache.CompiledMapData(tmx_data)
+    else:
+        level.map_data = pyscroll.data.TiledMapData(tmx_data)
+
+    return level
+
+
+class LevelManager(object):
+    """ Loads levels on a thread pool, and keeps the most recent ones
+
+    load is called with a map filename on a worker thread and returns the
+    Level.  At most capacity levels are kept, counting ones still loading;
+    the least recently used go first, but never the current one.
+    """
+
+    def __init__(self, load, capacity=4, workers=2):
+        self.load = load
+        self.capacity = capacity
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='level loader')
+        # filename -> Future of the Level, least recently used first
+        self.levels = OrderedDict()
+        self.current = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def prefetch(self, filename):
+        """ Start loading filename in the background, if it isn't already
+        """
+        if filename not in self.levels:
+            self.levels[filename] = self.executor.submit(self.load, filename)
+            self._trim()
+
+    def ready(self, filename):
+        """ True if get(filename) would return without waiting
+
+        A level that failed to load counts as ready: get() raises the error.
+        """
+        future = self.levels.get(filename)
+        return future is not None and future.done()
+
+    def get(self, filename):
+        """ Return the level for filename, loading it now if it wasn't prefetched,
+        and make it the current level
+        """
+        future = self.levels.get(filename)
+        if future is not None and future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.prefetch(filename)
+            future = self.levels[filename]
+        self.levels.move_to_end(filename)
+        try:
+            level = future.result()
+        except Exception:
+            # don't keep the failure around, the next try loads it again
+            del self.levels[filename]
+            raise
+        self.current = filename
+        return level
+
+    def _trim(self):
+        for filename in list(self.levels):
+            if len(self.levels) <= self.capacity:
+                break
+            if filename == self.current:
+                continue
+            future = self.levels.pop(filename)
+            self.evictions += 1
+            if not future.cancel():
+                future.add_done_callback(close_level)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for future in self.levels.values():
+            if not future.cancel():
+                future.add_done_callback(close_level)
+        self.levels.clear()
+
+    def stats(self):
+        return {
+            'levels': len(self.levels),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def close_level(future):
+    if future.exception() is None:
+        future.result().close()
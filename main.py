@@ -2,22 +2,31 @@
 
 Simple demo that demonstrates PyTMX and pyscroll.
 
-requires pygame and pytmx.
+Arrow keys move, space jumps, + and - zoom.  F3 shows frame times and F9
+profiles the next few seconds.
+
+requires pygame, pytmx, pyscroll and numpy.
 
 https://github.com/bitcraft/pytmx
 
 pip install pytmx
 """
 import os.path
+import time
 
 import pygame
-import math
 from pygame.locals import *
-from pytmx.util_pygame import load_pygame
 
-import pyscroll
-import pyscroll.data
-from pyscroll.group import PyscrollGroup
+import assets
+import dirty
+import instrument
+import levels
+import quality
+import rendercache
+import snapshot
+from hero import Hero
+from levels import load_level
+from npcs import Crowd, CrowdGroup
 
 # define configuration variables here
 RESOURCES_DIR = 'data'
@@ -25,384 +34,73 @@ RESOURCES_DIR = 'data'
 
 MAP_FILENAME = 'maps/dungeon_0.tmx'
 
+# how maps are loaded, streamed and collided against is set at the top of
+# levels.py
 
-# simple wrapper to keep the screen resizeable
-def init_screen(width, height):
-    screen = pygame.display.set_mode((width, height), pygame.RESIZABLE)
-    return screen
-
-
-# make loading maps a little easier
-def get_map(filename):
-    return os.path.join(RESOURCES_DIR, filename)
-
+# how many levels are kept loaded, counting the current one and the ones
+# being loaded ahead of time, and how many threads load them
+LEVEL_CACHE_SIZE = 4
+LEVEL_LOAD_WORKERS = 2
 
-# make loading images a little easier
-def load_image(filename):
-    return pygame.image.load(os.path.join(RESOURCES_DIR, filename))
+# only redraw and present the parts of the screen that changed, and skip
+# frames where nothing did.  saves fill rate with software rendering at
+# large window sizes, see dirty.py
+DIRTY_RECTS = False
 
+# zoom levels + and - step through, and how many renderers are kept for the
+# zoom levels and window sizes used recently, see rendercache.py
+ZOOM_LEVELS = (1, 2, 3, 4)
+RENDERER_CACHE_SIZE = 4
 
+# frames drawn per second, 0 draws as fast as possible
+FRAME_RATE = 60
 
-class Hero(pygame.sprite.Sprite):
-    """ Our Hero
-
-    The Hero has three collision rects, one for the whole sprite "rect" and
-    "old_rect", and another to check collisions with walls, called "feet".
-
-    The position list is used because pygame rects are inaccurate for
-    positioning sprites; because the values they get are 'rounded down'
-    as integers, the sprite would move faster moving left or up.
-
-    Feet is 1/2 as wide as the normal rect, and 8 pixels tall.  This size size
-    allows the top of the sprite to overlap walls.  The feet rect is used for
-    collisions, while the 'rect' rect is used for drawing.
-
-    There is also an old_rect that is used to reposition the sprite if it
-    collides with level walls.
-    """
-
-
-
-    def __init__(self, map_data_object):
-        pygame.sprite.Sprite.__init__(self)
-
-        # CONSTANTS
-        self.HERO_JUMP_HEIGHT = 180
-        self.HERO_MOVE_SPEED = 200  # pixels per second
-        self.GRAVITY = 1000
-
-        # STATE DEFINITIONS
-        self.STATE_STANDING = 0
-        self.STATE_WALKING = 1
-        self.STATE_JUMPING = 2
-        self.STATE_ON_STAIRS = 3
-        self.STATE_CROUCHED = 4
-
-        self.FRAME_DELAY_STANDING = 1
-        self.FRAME_DELAY_WALKING = 1
-        self.FRAME_DELAY_JUMPING = 1
-
-        # ANIMATION - Lower is slower
-        self.ANIMATION_SPEED_WALKING = .25
-        self.ANIMATION_SPEED_STANDING = .002
-
-        self.JUMP_DELAY =.3
-
-        self.CLIMBING_DELAY = .3
-        self.CLIMBING_RATE = 1
-        self.CLIMBING_SPEED = 200
-
-        self.CLIMBING_UP = 0
-        self.CLIMBING_DOWN = 1
-
-        self.FACING_RIGHT = 0
-        self.FACING_LEFT = 1
-
-        self.MILLISECONDS_TO_SECONDS = 1000.0
-
-        self.COLLISION_BOX_OFFSET = 8
-
-
-        self.climbing_direction = 0
-        self.time_spent_climbing = 0.0
-        self.time_since_last_jump = 0
-        self.time_in_state = 0.0
-        self.current_walking_frame = 0
-        self.current_standing_frame = 0
-        self.current_jumping_frame = 0
-        self.load_sprites()
-        self.velocity = [0, 0]
-        self.state = self.STATE_STANDING
-        self.facing = self.FACING_RIGHT
-        self._position = [map_data_object.x, map_data_object.y]
-        self._old_position = self.position
-        self.rect = pygame.Rect(8, 0, self.image.get_rect().width - 8, self.image.get_rect().height)
-
-    def set_state(self, state):
-        if self.state != state:
-            self.state = state
-            self.time_in_state = 0.0
-
-    def snap_to_stair(self, dt, game):
-        stair_sensor = self.get_stair_sensor()
-        found_stair = False
-        for stair in game.stairs:
-            if stair_sensor.colliderect(stair.rect):
-                self.rect.bottom = stair.rect.top
-                self.set_state(self.STATE_ON_STAIRS)
-                self._position[1] = self.rect.top
-                found_stair = True
-                break
-
-    def detects_stairs(self, game):
-        stair_sensor = self.get_stair_sensor()
-        found_stair = False
-        for stair in game.stairs:
-            if stair_sensor.colliderect(stair.rect):
-                found_stair = True
-                break
-        return found_stair
-
-
-    def load_sprites(self):
-        self.spritesheet = Spritesheet('data/art/platformer_template_g.png')
-        # Sprite is 16x16 pixels at location 0,0 in the file...
-        #image = ss.image_at((0, 0, 32, 32))
-        #images = []
-        # Load two images into an array, their transparent bit is (255, 255, 255)
-        standing_images = self.spritesheet.images_at((
-            pygame.Rect(0, 0, 32, 32),pygame.Rect(32, 0, 32, 32),
-            pygame.Rect(64, 0, 32, 32),pygame.Rect(96, 0, 32, 32)
-            ), colorkey= (0,255,81))
+# draw less, and then less often, while frames take longer than FRAME_RATE
+# allows, and go back up when they have room again.  see quality.py
+ADAPTIVE_QUALITY = False
 
-        walk_images = self.spritesheet.images_at((
+# physics ticks per second, 0 runs one tick per drawn frame with its real dt
+SIMULATION_RATE = 120
 
-            pygame.Rect(192, 0, 32, 32),
-            pygame.Rect(96, 0, 32, 32),
-            pygame.Rect(64, 32, 32, 32),
-            pygame.Rect(96, 0, 32, 32),
+# seconds of play kept to rewind through, 0 keeps none.  backspace goes back
+# REWIND_STEP seconds, F5 quick-saves and F8 goes back to the quick-save.
+# see snapshot.py
+REWIND_SECONDS = 10
+REWIND_STEP = 1.0
 
-        ), colorkey= (0,255,81))
+# run the game loop on asyncio, see asyncloop.py.  frame stats and the
+# recording are then also written every BACKGROUND_INTERVAL seconds, off the
+# main thread, and background work gets at most BACKGROUND_BUDGET seconds
+# between two frames
+ASYNC_LOOP = False
+BACKGROUND_BUDGET = .004
+BACKGROUND_INTERVAL = 5.0
 
-        jumping_images = self.spritesheet.images_at((
-            pygame.Rect(160, 160, 32, 32),
-            ), colorkey= (0,255,81))
+# how many frames F9 profiles for, and where the captures are written
+PROFILE_FRAMES = 300
+PROFILE_DIR = 'profiles'
 
-        stairs_descending_images = self.spritesheet.images_at((
-            pygame.Rect(32, 224, 32, 32),
-            pygame.Rect(128, 224, 32, 32),
-            ), colorkey= (0,255,81))
+# longest frame the fixed step loop will catch up on, in seconds.  anything
+# longer is dropped so a stall can't snowball into more and more ticks
+MAX_FRAME_TIME = .25
 
-        stairs_ascending_images = self.spritesheet.images_at((
-            pygame.Rect(32, 192, 32, 32),
-            pygame.Rect(128, 192, 32, 32),
-        ), colorkey=(0, 255, 81))
 
-        self.walk_images = []
-        for walk_image in walk_images:
-            self.walk_images.append(walk_image.convert_alpha())
-
-
-        self.standing_images = []
-        for standing_image in standing_images:
-            self.standing_images.append(standing_image.convert_alpha())
-
-        self.jumping_images = []
-        for jumping_image in jumping_images:
-            self.jumping_images.append(jumping_image.convert_alpha())
-
-        self.stairs_descending_images = []
-        for stairs_descending_image in stairs_descending_images:
-            self.stairs_descending_images.append(stairs_descending_image.convert_alpha())
-
-        self.stairs_ascending_images = []
-        for stairs_ascending_image in stairs_ascending_images:
-            self.stairs_ascending_images.append(stairs_ascending_image.convert_alpha())
-
-        self.image = self.standing_images[self.current_standing_frame]
-
-    @property
-    def position(self):
-        return list(self._position)
-
-    @position.setter
-    def position(self, value):
-        self._position = list(value)
-
-    def get_floor_sensor(self):
-        return pygame.Rect(self.position[0]+self.COLLISION_BOX_OFFSET, self.position[1]+2, self.rect.width -self.COLLISION_BOX_OFFSET, self.rect.height)
-
-    def get_stair_sensor(self):
-        return pygame.Rect(self.position[0]+self.COLLISION_BOX_OFFSET, self.position[1]+self.rect.height-2, self.rect.width -self.COLLISION_BOX_OFFSET, 4)
-
-
-    def get_ceiling_sensor(self):
-        return pygame.Rect(self.position[0]+self.COLLISION_BOX_OFFSET, self.position[1]-self.rect.height, self.rect.width, 2)
-
-    def get_body_sensor(self):
-        return pygame.Rect(self.position[0]+self.COLLISION_BOX_OFFSET, self.position[1], self.rect.width -self.COLLISION_BOX_OFFSET, self.rect.height)
-
-
-    def calc_grav(self, game, dt):
-        """ Calculate effect of gravity. """
-        floor_sensor = self.get_floor_sensor()
-        collidelist = floor_sensor.collidelist(game.walls)
-
-        hero_is_airborne = collidelist == -1
-
-
-        if hero_is_airborne:
-            if self.velocity[1] == 0:
-                self.velocity[1] = self.GRAVITY * dt
-            else:
-                if game.debug:
-                    print("increasing downward velocity: {}".format(self.velocity[1]))
-                self.velocity[1] += self.GRAVITY * dt
-                if game.debug:
-                    print("is now: {}".format(self.velocity[1]))
-
-    def animate(self, dt, game):
-        if self.state == self.STATE_WALKING:
-            self.current_walking_frame  = int(self.time_in_state * self.MILLISECONDS_TO_SECONDS * self.ANIMATION_SPEED_WALKING % len(self.walk_images))
-            self.image = self.walk_images[self.current_walking_frame]
-            self.time_in_state += dt
-
-            if game.debug:
-                print("Walking frame: {}".format(self.current_walking_frame))
-        elif self.state == self.STATE_STANDING:
-            self.current_standing_frame  = int(self.time_in_state * self.MILLISECONDS_TO_SECONDS * self.ANIMATION_SPEED_STANDING % len(self.standing_images))
-            self.image = self.standing_images[self.current_standing_frame]
-            self.time_in_state += dt
-            if game.debug:
-                print("time_standing: {}".format(self.time_in_state))
-                print("len(walk_images){}".format(len(self.walk_images)))
-                print("Standing frame: {}".format(self.current_standing_frame))
-        elif self.state == self.STATE_JUMPING:
-            self.current_jump_frame = int(self.time_in_state * self.MILLISECONDS_TO_SECONDS % len(self.jumping_images))
-            self.image = self.jumping_images[self.current_jump_frame]
-            self.time_in_state += dt
-            if game.debug:
-                print("time_standing: {}".format(self.time_in_state))
-                print("len(jump_images){}".format(len(self.jumping_images)))
-                print("Jumping")
-        elif self.state == self.STATE_ON_STAIRS:
-            if self.velocity[1] > 0:
-                self.current_desc_frame = int(self.time_spent_climbing * self.MILLISECONDS_TO_SECONDS / 10   % len(self.stairs_descending_images))
-
-                self.image = self.stairs_descending_images[self.current_desc_frame]
-                self.time_in_state += dt
-                if game.debug:
-                    print("time_spent_climbing: {}".format(self.time_spent_climbing))
-                    print("len(jump_images){}".format(len(self.jumping_images)))
-                    print("Jumping")
-            else:
-                self.current_asc_frame = int(self.time_spent_climbing * self.MILLISECONDS_TO_SECONDS % len(self.stairs_ascending_images))
-
-                self.image = self.stairs_ascending_images[self.current_asc_frame]
-                self.time_in_state += dt
-                if game.debug:
-                    print("time_spent_climbing: {}".format(self.time_spent_climbing))
-                    print("len(jump_images){}".format(len(self.jumping_images)))
-                    print("Jumping")
-        else:
-            if game.debug:
-                print("state is {}".format(self.state))
-        if game.debug:
-            print("delta_time: {}".format(dt))
-
-        if self.facing == self.FACING_LEFT:
-            self.image = pygame.transform.flip(self.image,True,False)
-
-    def update(self, dt, game):
-        self.time_since_last_jump += dt
-        self.calc_grav(game, dt)
-        self.animate(dt, game)
-
-        self._old_position = self._position[:]
-        self.move(dt, game)
-
-
-    def move(self, dt, game):
-        # Move each axis separately. Note that this checks for collisions both times.
-        if self.state == self.STATE_ON_STAIRS:
-            if self.time_in_state > self.CLIMBING_DELAY:
-                if self.time_spent_climbing >= self.CLIMBING_RATE:
-                    print("advances on stairs")
-                    positions_to_move = math.floor(self.time_spent_climbing / self.CLIMBING_RATE)
-                    self.time_spent_climbing = self.time_spent_climbing % self.CLIMBING_RATE
-                    self._position[0] += dt * positions_to_move * self.velocity[0]
-                    self._position[1] += dt * positions_to_move * self.velocity[1]
-                    print("positions_to_move: {}".format(positions_to_move))
-                else:
-                    self.time_spent_climbing += dt
-        else:
-            dx = self.velocity[0]
-            dy = self.velocity[1]
-            if dx != 0:
-                self.move_single_axis(dx, 0, dt)
-            if dy != 0:
-                self.move_single_axis(0, dy, dt)
-        self.rect.topleft = self._position
-    def move_single_axis(self, dx, dy, dt):
-        #print("hero_destination: ({}, {})".format(dx *dt, dy *dt))
-        self._position[0] += dx * dt
-        self._position[1] += dy * dt
-
-        #print("Game walls: {}".format(game.walls))
-        self.rect.topleft = self._position
-
-
-        body_sensor = self.get_body_sensor()
-        for wall in game.walls:
-            if body_sensor.colliderect(wall.rect):
-                if dx > 0:  # Moving right; Hit the left side of the wall
-                    self.rect.right = wall.rect.left
-                    self._position[0] = self.rect.left
-                if dx < 0:  # Moving left; Hit the right side of the wall
-                    self.rect.left = wall.rect.right - self.COLLISION_BOX_OFFSET
-                    self._position[0] = self.rect.left
-                if dy > 0:  # Moving down; Hit the top side of the wall
-                    self.rect.bottom = wall.rect.top
-                    self._position[1] = self.rect.top
-                if dy < 0:  # Moving up; Hit the bottom side of the wall
-                    self.rect.top = wall.rect.bottom
-                    self._position[1] = self.rect.top
-
-
-
-
-class Wall(pygame.sprite.Sprite):
-    """
-        A sprite extension for all the walls in the game
-    """
-
-    def __init__(self, map_data_object):
-        pygame.sprite.Sprite.__init__(self)
-        self._position = [map_data_object.x, map_data_object.y]
-        self.rect = pygame.Rect(
-            map_data_object.x, map_data_object.y,
-            map_data_object.width, map_data_object.height)
-
-    @property
-    def position(self):
-        return list(self._position)
+# simple wrapper to keep the screen resizeable
+def init_screen(width, height):
+    screen = pygame.display.set_mode((width, height), pygame.RESIZABLE)
+    return screen
 
-    @position.setter
-    def position(self, value):
-        self._position = list(value)
 
+# make loading maps a little easier
+def get_map(filename):
+    return os.path.join(RESOURCES_DIR, filename)
 
 
+# make loading images a little easier
+def load_image(filename):
+    return pygame.image.load(os.path.join(RESOURCES_DIR, filename))
 
 
-class Spritesheet(object):
-    def __init__(self, filename):
-        try:
-            self.sheet = pygame.image.load(filename).convert()
-        except pygame.error:
-            print ('Unable to load spritesheet image: {}').format(filename)
-            raise SystemExit
-    # Load a specific image from a specific rectangle
-    def image_at(self, rectangle, colorkey = None):
-        "Loads image from x,y,x+offset,y+offset"
-        rect = pygame.Rect(rectangle)
-        image = pygame.Surface(rect.size).convert()
-        image.blit(self.sheet, (0, 0), rect)
-        if colorkey is not None:
-            if colorkey is -1:
-                colorkey = image.get_at((0,0))
-            image.set_colorkey(colorkey, pygame.RLEACCEL)
-        return image
-    # Load a whole bunch of images and return them as a list
-    def images_at(self, rects, colorkey = None):
-        "Loads multiple images, supply a list of coordinates"
-        return [self.image_at(rect, colorkey) for rect in rects]
-    # Load a whole strip of images
-    def load_strip(self, rect, image_count, colorkey = None):
-        "Loads a strip of images and returns them as a list"
-        tups = [(rect[0]+rect[2]*x, rect[1], rect[2], rect[3])
-                for x in range(image_count)]
-        return self.images_at(tups, colorkey)
 
 class QuestGame(object):
     """ This class is a basic game.
@@ -413,61 +111,267 @@ class QuestGame(object):
     """
     filename = get_map(MAP_FILENAME)
 
-    def __init__(self):
+    def __init__(self, surface=None, filename=None, get_pressed=None):
+        """ surface is what the game draws to, by default the display.
+        filename overrides the map to load, and get_pressed replaces
+        pygame.key.get_pressed so input can come from a script.
+        """
+        if surface is None:
+            surface = pygame.display.get_surface()
+        self.surface = surface
+        if filename is not None:
+            self.filename = filename
+        if get_pressed is None:
+            get_pressed = pygame.key.get_pressed
+        self.get_pressed = get_pressed
 
         # true while running
         self.running = False
 
         self.debug = False
 
-        # load data from pytmx
-        self.tmx_data = load_pygame(self.filename)
-
-        # setup level geometry with simple pygame rects, loaded from pytmx
-        self.walls = list()
-        self.npcs = list()
-        self.stairs = list()
-        for map_object in self.tmx_data.objects:
-            if map_object.type == "wall":
-                self.walls.append(Wall(map_object))
-            elif map_object.type == "stair":
-                self.stairs.append(Wall(map_object))
-            elif map_object.type == "guard":
-                print("npc load failed: reimplement npc")
-                #self.npcs.append(Npc(map_object))
-            elif map_object.type == "hero":
-                self.hero = Hero(map_object)
-
-        # create new data source for pyscroll
-        map_data = pyscroll.data.TiledMapData(self.tmx_data)
-
-        # create new renderer (camera)
-        self.map_layer = pyscroll.BufferedRenderer(map_data, screen.get_size(), clamp_camera=True, tall_sprites=1)
-        self.map_layer.zoom = 2
+        # how long each phase of recent frames took, and the optional overlay
+        # showing it
+        self.frame_timer = instrument.FrameTimer()
+        self.overlay = None
+
+        # works out what changed on screen when drawing with dirty rects
+        self.dirty = dirty.DirtyRects() if DIRTY_RECTS else None
+
+        # the running profile capture, if any, and the frames it has left
+        self.profiler = None
+        self.profile_frames_left = 0
+
+        # a replay.Recording to add every tick's input to, if recording
+        self.recording = None
+
+        # length of a simulation tick in seconds, 0 ties it to the frame time
+        self.timestep = 1. / SIMULATION_RATE if SIMULATION_RATE else 0
+
+        # simulated seconds per real second, raise it to run the simulation
+        # faster than real time
+        self.time_scale = 1.0
+
+        # seconds played but not simulated yet, less than a tick
+        self.accumulator = 0.0
+
+        # frames drawn per second, the quality governor lowers it when the
+        # machine can't keep up
+        self.frame_rate = FRAME_RATE
+        self.governor = None
+
+        # when True, walking into a door whose map is still loading waits for
+        # it instead of carrying on until it is ready.  replays need this to
+        # change maps on the same tick every time
+        self.wait_for_levels = False
+
+        # map pixels are drawn this many screen pixels wide
+        self.zoom = 2
         if(self.debug):
-            self.map_layer.zoom = 1
+            self.zoom = 1
+
+        self.hero = None
+        self.levels = levels.LevelManager(load_level, LEVEL_CACHE_SIZE, LEVEL_LOAD_WORKERS)
+        self.enter_level(self.levels.get(self.filename))
+
+        if ADAPTIVE_QUALITY and FRAME_RATE:
+            self.governor = quality.QualityGovernor(FRAME_RATE)
+            self.governor.apply(self)
+
+        # a snapshot of every recent tick to rewind through, starting with
+        # how the game is now, and the quick-save as (tick, map, snapshot)
+        self.history = None
+        if REWIND_SECONDS:
+            self.history = snapshot.History(int(REWIND_SECONDS * self.ticks_per_second))
+            self.history.capture(self)
+        self.quick_save = None
+
+        if self.debug:
+            print("assets: {}".format(assets.cache.stats()))
+
+    def enter_level(self, level, spawn=None):
+        """ Make level the one being played, with the hero at the object named
+        spawn, or at the map's hero spawn
+        """
+        self.level = level
+        self.filename = level.filename
+        self.tmx_data = level.tmx_data
+        self.world = level.world
+        self.walls = level.walls
+        self.stairs = level.stairs
+        self.wall_index = level.wall_index
+        self.stair_index = level.stair_index
+        self.door_index = level.door_index
+
+        # a door the hero arrives in doesn't open until they step out of it
+        self.doors_armed = False
+
+        position, standing = level.spawn_point(spawn)
+        if self.hero is None:
+            self.hero = Hero(pygame.Rect(position[0], position[1], 0, 0))
+        if standing:
+            # stand the hero on the bottom of the object
+            position = position[0], position[1] - self.hero.rect.height
+        self.hero.position = position
+        self.hero._old_position[:] = self.hero._position
+        self.hero.velocity = [0, 0]
+        if self.world is not None:
+            # the walls under the spawn have to be there to stand on
+            self.hero.update_sensors()
+            self.world.ensure_loaded(self.hero.get_body_sensor().inflate(64, 64))
+        self.hero.update_contacts(self)
+
+        self.npcs = Crowd()
+        for x, y in level.guards:
+            self.npcs.add(x, y - Crowd.HEIGHT)
+        self.npcs.grid = level.grid
+        self.npcs.load_clips(self.hero.spritesheet)
+
+        # create new renderer (camera), or reuse the one from the last visit
+        level.map_data.reload_animations()
+        if level.renderers is None:
+            level.renderers = rendercache.RendererCache(level.map_data, RENDERER_CACHE_SIZE)
+        self.map_layer = level.renderers.get(self.surface.get_size(), self.zoom)
 
         # pyscroll supports layered rendering.  our map has 3 'under' layers
         # layers begin with 0, so the layers are 0, 1, and 2.
         # since we want the sprite to be on top of layer 1, we set the default
         # layer for sprites as 2
-        self.group = PyscrollGroup(map_layer=self.map_layer, default_layer=3)
+        self.group = CrowdGroup(map_layer=self.map_layer, default_layer=3)
 
 
-        # add our hero to the group
+        # add our hero and the guards to the group
         self.group.add(self.hero)
-        for npc in self.npcs:
-            self.group.add(npc)
+        self.group.crowds.append(self.npcs)
+        if self.dirty is not None:
+            self.dirty.invalidate()
+
+        # start loading wherever the doors go, so they open without a wait
+        for door in level.doors:
+            self.levels.prefetch(door.target)
+
+        if self.governor is not None:
+            self.governor.apply(self)
+            self.governor.settle()
 
+    @property
+    def ticks_per_second(self):
+        return 1. / self.timestep if self.timestep else FRAME_RATE
+
+    def rewind(self, seconds):
+        """ Go back seconds of play, or as far as the history goes
+        """
+        if self.history is None:
+            return
+        tick = self.history.rewind(self, int(round(seconds * self.ticks_per_second)))
+        if tick is not None and self.recording is not None:
+            # the ticks rewound over never happened
+            self.recording.truncate(tick)
+        if self.dirty is not None:
+            self.dirty.invalidate()
+
+    def save_quick(self):
+        """ Keep how the game is now, to go back to with load_quick()
+        """
+        tick = self.history.last if self.history is not None else None
+        self.quick_save = tick, self.filename, snapshot.pack(self)
 
-    def draw(self, surface):
+    def load_quick(self):
+        """ Go back to the quick-save.  Not while recording: a recording
+        can only go on from where it was
+        """
+        if self.quick_save is None:
+            return
+        if self.recording is not None:
+            print("quick-save: can't load while recording")
+            return
+        tick, filename, blob = self.quick_save
+        snapshot.load(self, filename, blob)
+        if self.history is not None:
+            # the ticks since the save are gone, and those kept from before
+            # it may have been rewound over
+            self.history.clear(tick if tick is not None else 0)
+            self.history.capture(self)
+        if self.dirty is not None:
+            self.dirty.invalidate()
+
+    def set_view(self, size=None, zoom=None):
+        """ Change the window size or zoom the map is drawn at
+        """
+        if size is not None:
+            self.surface = init_screen(*size)
+        if zoom is not None:
+            self.zoom = zoom
+        self.map_layer = self.level.renderers.get(self.surface.get_size(), self.zoom)
+        self.group.set_map_layer(self.map_layer)
+        if self.dirty is not None:
+            self.dirty.invalidate()
+        if self.governor is not None:
+            self.governor.settle()
+        if self.debug:
+            print("renderers: {}".format(self.level.renderers.stats()))
+
+    def step_zoom(self, steps):
+        """ Zoom in or out by steps of ZOOM_LEVELS
+        """
+        if self.zoom in ZOOM_LEVELS:
+            index = ZOOM_LEVELS.index(self.zoom) + steps
+        else:
+            index = 0
+        index = min(max(index, 0), len(ZOOM_LEVELS) - 1)
+        if ZOOM_LEVELS[index] != self.zoom:
+            self.set_view(zoom=ZOOM_LEVELS[index])
+
+    def use_door(self, door):
+        """ Go through door if its map is loaded, return True if the hero did
+
+        Until the map is ready the hero carries on playing here, this is
+        called again every tick they stay in the door.
+        """
+        if not self.wait_for_levels and not self.levels.ready(door.target):
+            self.levels.prefetch(door.target)
+            return False
+        try:
+            level = self.levels.get(door.target)
+        except Exception as e:
+            print("door to {} can't be opened: {}".format(door.target, e))
+            self.doors_armed = False
+            return False
+        if __debug__ and self.debug:
+            instrument.trace('level', map=door.target, spawn=door.spawn)
+        self.enter_level(level, door.spawn)
+        return True
+
+    def draw(self, surface, alpha=1.0):
+        """ Draw the map and sprites
+
+        alpha is the fraction of a simulation tick that has passed since the
+        last update, the hero is drawn that far between its old and new
+        positions so motion stays smooth when ticks and frames don't line up.
+
+        Returns the rects of the surface that changed, or None if all of it
+        may have.
+        """
+        self.hero.interpolate(alpha)
+        self.group.alpha = alpha
 
         # center the map/screen on our Hero
         self.group.center(self.hero.rect.center)
         # draw the map and all sprites
+        if self.dirty is not None:
+            rects = self.dirty.draw(self.group, surface)
+        else:
+            rects = None
+            self.group.draw(surface)
 
+        # put the rect back where the simulation expects it
+        self.hero.interpolate(1.0)
 
-        self.group.draw(surface)
+        if self.overlay is not None:
+            area = self.overlay.draw(surface)
+            if rects is not None:
+                self.dirty.touch(area)
+                rects.append(area)
 
 
         if(self.debug):
@@ -477,6 +381,11 @@ class QuestGame(object):
             new_rect = floor_sensor_rect.move(ox, oy)
 
             pygame.draw.rect(surface, (255,0,0), new_rect)
+            if rects is not None:
+                self.dirty.invalidate()
+                rects = [surface.get_rect()]
+
+        return rects
 
     def handle_input(self, dt):
         """ Handle pygame input events
@@ -493,30 +402,41 @@ class QuestGame(object):
                 if event.key == K_ESCAPE:
                     self.running = False
                     break
+                elif event.key == K_F3:
+                    if self.overlay is None:
+                        self.overlay = instrument.StatsOverlay(self.frame_timer)
+                    else:
+                        self.overlay = None
+                elif event.key == K_F9:
+                    if self.profiler is None:
+                        self.start_profile()
+                    else:
+                        self.stop_profile()
+                elif event.key == K_BACKSPACE:
+                    self.rewind(REWIND_STEP)
+                elif event.key == K_F5:
+                    self.save_quick()
+                elif event.key == K_F8:
+                    self.load_quick()
+                elif event.key in (K_EQUALS, K_PLUS, K_KP_PLUS):
+                    self.step_zoom(1)
+                elif event.key in (K_MINUS, K_KP_MINUS):
+                    self.step_zoom(-1)
             # this will be handled if the window is resized
             elif event.type == VIDEORESIZE:
-                init_screen(event.w, event.h)
-                self.map_layer.set_size((event.w, event.h))
+                self.set_view(size=(event.w, event.h))
 
             event = poll()
 
         # using get_pressed is slightly less accurate than testing for events
         # but is much easier to use.
-        pressed = pygame.key.get_pressed()
-
-
-        floor_sensor = self.hero.get_floor_sensor()
-        floor_wall_collidelist = floor_sensor.collidelist(self.walls)
-        hero_is_airborne = floor_wall_collidelist == -1
+        pressed = self.get_pressed()
+        if self.recording is not None:
+            self.recording.record(dt, pressed)
 
 
-        ceiling_sensor = self.hero.get_ceiling_sensor()
-        ceiling_collidelist = ceiling_sensor.collidelist(self.walls)
-        hero_touches_ceiling = ceiling_collidelist != -1
-
-
-        if  self.hero.detects_stairs(self) != True and self.hero.state == self.hero.STATE_ON_STAIRS:
-            self.hero.state = self.hero.STATE_STANDING
+        hero_is_airborne = not self.hero.grounded
+        hero_touches_ceiling = self.hero.touching_ceiling
 
         if pressed[K_l]:
             print("airborne: {}".format(hero_is_airborne))
@@ -524,94 +444,196 @@ class QuestGame(object):
             print("hero_touches_ceiling: {}".format(hero_touches_ceiling))
             print("hero_is_airborne: {}".format(hero_is_airborne))
             print("hero_state: {}".format(self.hero.state))
-        # Ascend Stairs
-        if pressed[K_UP] and not pressed[K_DOWN]:
-            if self.hero.state == self.hero.STATE_ON_STAIRS:
-                if self.hero.facing == self.hero.FACING_RIGHT:
-                    self.hero.velocity[0] = self.hero.CLIMBING_SPEED
-                else:
-                    self.hero.velocity[0] = -self.hero.CLIMBING_SPEED
-                self.hero.velocity[1] = -self.hero.CLIMBING_SPEED
-            else:
-                self.hero.snap_to_stair(dt, self)
-        # Descend stairs
-        if pressed[K_DOWN] and not pressed[K_UP]:
-            if self.hero.state == self.hero.STATE_ON_STAIRS:
-                if self.hero.facing == self.hero.FACING_RIGHT:
-                    self.hero.velocity[0] = self.hero.CLIMBING_SPEED
-                else:
-                    self.hero.velocity[0] = -self.hero.CLIMBING_SPEED
-                self.hero.velocity[1] = self.hero.CLIMBING_SPEED
-            else:
-                self.hero.snap_to_stair(dt, self)
-        if hero_is_airborne == False and self.hero.state != self.hero.STATE_ON_STAIRS:
-
-            #JUMP
-            if pressed[K_SPACE] and self.hero.time_since_last_jump >= self.hero.JUMP_DELAY:
-                self.hero.set_state(self.hero.STATE_JUMPING)
-
-                # stop the player animation
-                if pressed[K_LEFT] and pressed[K_RIGHT] == False:
-                    # play the jump left animations
-                    self.hero.velocity[0] = -self.hero.HERO_MOVE_SPEED
-                    self.hero.facing = self.hero.FACING_LEFT
-                    jumped_direction = 0
-                elif pressed[K_RIGHT] and pressed[K_LEFT] == False:
-                    self.hero.velocity[0] = self.hero.HERO_MOVE_SPEED
-                    self.hero.facing = self.hero.FACING_RIGHT
-                    jumped_direction = 1
-                self.hero.velocity[1]= -self.hero.HERO_JUMP_HEIGHT
-                self.hero.time_since_last_jump = 0
-            elif pressed[K_LEFT] and pressed[K_RIGHT] == False:
-                self.hero.set_state(self.hero.STATE_WALKING)
-                self.hero.facing = self.hero.FACING_LEFT
-                self.hero.velocity[0] = -self.hero.HERO_MOVE_SPEED
-            elif pressed[K_RIGHT] and pressed[K_LEFT] == False:
-                self.hero.set_state(self.hero.STATE_WALKING)
-                self.hero.facing = self.hero.FACING_RIGHT
-                self.hero.velocity[0] = self.hero.HERO_MOVE_SPEED
-            else:
-                self.hero.state = self.hero.STATE_STANDING
-                self.hero.velocity[0] = 0
+        self.hero.control(pressed, dt, self)
 
 
     def update(self, dt):
         """ Tasks that occur over time should be handled here
         """
+        if self.world is not None:
+            # the camera follows the hero, so stream around it
+            self.world.update(self.hero.rect.center)
         self.group.update(dt, self)
+        self.npcs.update(dt)
+
+        door = self.door_index.collide_any(self.hero.get_body_sensor())
+        if door is None:
+            self.doors_armed = True
+        elif self.doors_armed:
+            self.use_door(door)
+
+    def profile_tags(self):
+        """ What the game is doing, put at the root of every profile sample
+        """
+        return [os.path.basename(self.filename), 'state={}'.format(self.hero.state)]
+
+    def start_profile(self, frames=PROFILE_FRAMES):
+        """ Sample what the main loop is doing for the next frames frames
+        """
+        self.profiler = instrument.StackSampler(tags=self.profile_tags)
+        self.profile_frames_left = frames
+        self.profiler.start()
+
+    def stop_profile(self):
+        """ Stop the capture and write it as collapsed stacks, return the path
+        """
+        profiler = self.profiler
+        self.profiler = None
+        profiler.stop()
+        if not os.path.isdir(PROFILE_DIR):
+            os.makedirs(PROFILE_DIR)
+        path = os.path.join(PROFILE_DIR, '{}-{}.folded'.format(
+            os.path.splitext(os.path.basename(self.filename))[0], time.strftime('%Y%m%d-%H%M%S')))
+        profiler.write(path)
+        print("profile: {} samples written to {}".format(profiler.samples, path))
+        return path
+
+    def step(self, dt):
+        """ Advance the simulation by one tick of dt seconds
+        """
+        if self.world is not None:
+            # never let the hero walk into a part of the map that isn't there
+            self.world.ensure_loaded(self.hero.get_body_sensor().inflate(64, 64))
+
+        timer = self.frame_timer
+        start = time.perf_counter()
+        self.handle_input(dt)
+        middle = time.perf_counter()
+        self.update(dt)
+        if self.history is not None:
+            self.history.capture(self)
+        end = time.perf_counter()
+        timer.add(timer.INPUT, middle - start)
+        timer.add(timer.UPDATE, end - middle)
+
+    def frame(self, dt):
+        """ Play dt seconds: the ticks that fit in them, then draw and present
+        """
+        timer = self.frame_timer
+        if self.timestep:
+            # fixed step: the simulation always advances in ticks of
+            # the same length, however long the frame took to draw
+            self.accumulator += min(dt, MAX_FRAME_TIME) * self.time_scale
+            while self.accumulator >= self.timestep and self.running:
+                self.step(self.timestep)
+                self.accumulator -= self.timestep
+            alpha = self.accumulator / self.timestep
+        else:
+            self.step(dt * self.time_scale)
+            alpha = 1.0
+
+        start = time.perf_counter()
+        rects = self.draw(self.surface, alpha)
+        middle = time.perf_counter()
+        if self.surface is pygame.display.get_surface():
+            if rects is None:
+                pygame.display.flip()
+            elif rects:
+                pygame.display.update(rects)
+        end = time.perf_counter()
+        timer.add(timer.DRAW, middle - start)
+        timer.add(timer.FLIP, end - middle)
+
+        if self.profiler is not None:
+            self.profile_frames_left -= 1
+            if self.profile_frames_left <= 0:
+                self.stop_profile()
+
+        if self.governor is not None:
+            self.governor.update(self)
+
+    def run(self, max_frames=None):
+        """ Run the game loop, for at most max_frames frames if given
 
-    def run(self):
-        """ Run the game loop
+        See asyncloop.py for the same loop on asyncio.
         """
         clock = pygame.time.Clock()
         self.running = True
-
-        from collections import deque
-        times = deque(maxlen=30)
+        self.accumulator = 0.0
+        frames = 0
 
         try:
             while self.running:
-                dt = clock.tick(60) / 1000.
-                times.append(clock.get_fps())
-
-                self.handle_input(dt)
-                self.update(dt)
-                self.draw(screen)
-                pygame.display.flip()
+                if max_frames is not None and frames >= max_frames:
+                    break
+                frames += 1
+                dt = clock.tick(self.frame_rate) / 1000.
+                if frames > 1:
+                    self.frame_timer.end_frame(dt)
+                self.frame(dt)
 
         except KeyboardInterrupt:
             self.running = False
 
+        if self.profiler is not None:
+            self.stop_profile()
+
 
 if __name__ == "__main__":
-    pygame.init()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Quest - An epic journey.')
+    parser.add_argument('--map', help='map to load, relative to {}'.format(RESOURCES_DIR))
+    parser.add_argument('--headless', action='store_true',
+                        help='run on the SDL dummy video driver, without a window')
+    parser.add_argument('--frames', type=int, help='quit after this many frames')
+    parser.add_argument('--frame-stats', metavar='PATH',
+                        help='write frame time percentiles and recent frames here on exit')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record the input of the session here, play it back with replay.py')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='only redraw and present what changed on screen')
+    parser.add_argument('--profile-frames', type=int, metavar='N',
+                        help='profile the first N frames, as if F9 was pressed')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='lower drawing quality and frame rate while frames run long, see quality.py')
+    parser.add_argument('--async-loop', action='store_true',
+                        help='run the game loop on asyncio, writing stats and the recording in the background')
+    args = parser.parse_args()
+
+    if args.headless:
+        from headless import init_headless
+        init_headless((800, 600))
+    else:
+        pygame.init()
+        init_screen(800, 600)
     pygame.font.init()
-    screen = init_screen(800, 600)
     pygame.display.set_caption('Test Game.')
 
     try:
-        game = QuestGame()
-        game.run()
+        if args.dirty_rects:
+            DIRTY_RECTS = True
+        if args.adaptive:
+            ADAPTIVE_QUALITY = True
+        game = QuestGame(filename=get_map(args.map) if args.map else None)
+        if args.profile_frames:
+            game.start_profile(args.profile_frames)
+        if args.record:
+            from replay import Recording
+            game.recording = Recording(game.filename)
+            # replays wait for maps to load, so the recording has to as well
+            game.wait_for_levels = True
+        if ASYNC_LOOP or args.async_loop:
+            import asyncio
+            import asyncloop
+
+            async def play():
+                background = asyncloop.Background(BACKGROUND_BUDGET)
+                if args.frame_stats:
+                    background.start(asyncloop.write_frame_stats(
+                        game, background, args.frame_stats, BACKGROUND_INTERVAL))
+                if args.record:
+                    background.start(asyncloop.save_recording(
+                        game, background, args.record, BACKGROUND_INTERVAL))
+                await asyncloop.run(game, background, args.frames)
+
+            asyncio.run(play())
+        else:
+            game.run(args.frames)
+        if args.record:
+            game.recording.save(args.record)
+        if args.frame_stats:
+            game.frame_timer.export(args.frame_stats)
     except:
         pygame.quit()
         raise
@@ -0,0 +1,379 @@
+""" Compiled map cache.
+
+Parsing a TMX file means reading the XML, decoding every tile layer from csv
+or base64+gzip and walking all of the objects.  None of that changes between
+launches, so the parsed map is written next to the TMX as a compact binary
+file (dungeon_0.tmx -> dungeon_0.tmxc), compressed with zlib, holding:
+
+- the tile layers as packed arrays of gids
+- where every gid's image lives on its tileset image
+- tile animations and tile properties
+- the map objects (walls, stairs, hero, guards, doors...) as plain tuples,
+  with their properties
+- the walls merged into as few rects as cover them, see collision.merge_rects()
+
+The cache remembers the size, modification time and hash of the TMX and of
+every tileset and image it uses.  It is rebuilt the next time the map is
+loaded if any of them changed.
+
+Build the caches for every map ahead of time with:
+
+    python mapcache.py [map.tmx ...]
+"""
+import glob
+import hashlib
+import marshal
+import os.path
+import struct
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+import zlib
+from array import array
+
+import pytmx
+from pytmx.util_pygame import pygame_image_loader
+
+from pyscroll.common import rect_to_bb
+from pyscroll.data import PyscrollDataAdapter
+
+from collision import merge_rects
+
+MAGIC = b'QMAP'
+
+# bump when the layout of the payload changes, old caches are then rebuilt
+VERSION = 3
+
+HEADER = struct.Struct('<4sHH')
+
+CACHE_SUFFIX = 'c'
+
+
+def cache_path(filename):
+    return filename + CACHE_SUFFIX
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def source_record(path):
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size, file_hash(path)
+
+
+def is_fresh(payload):
+    """ True if none of the files the map was compiled from have changed
+
+    Only files whose size or modification time changed get hashed.
+    """
+    for path, mtime, size, digest in payload['sources']:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_mtime_ns == mtime and stat.st_size == size:
+            continue
+        if stat.st_size != size or file_hash(path) != digest:
+            return False
+    return True
+
+
+def recording_image_loader(filename, colorkey, **kwargs):
+    """ pytmx image loader that records where each image is instead of loading it
+    """
+    def load_image(rect=None, flags=None):
+        return (filename,
+                colorkey if colorkey is None else str(colorkey),
+                tuple(rect) if rect else None,
+                tuple(flags) if flags else None)
+
+    return load_image
+
+
+def simple_properties(properties):
+    """ Keep the properties marshal can store, tile animations are kept elsewhere
+    """
+    return dict((key, value) for key, value in properties.items()
+                if key != 'frames' and isinstance(value, (bool, int, float, str)))
+
+
+def compile_map(filename):
+    """ Parse a TMX file and return the cache payload for it
+    """
+    tmx = pytmx.TiledMap(filename, image_loader=recording_image_loader)
+
+    # the map depends on its external tilesets, and on every image it uses
+    sources = [filename]
+    map_dir = os.path.dirname(filename)
+    for node in ElementTree.parse(filename).getroot().iter('tileset'):
+        source = node.get('source')
+        if source:
+            sources.append(os.path.join(map_dir, source))
+    for image in tmx.images:
+        if image and image[0] not in sources:
+            sources.append(image[0])
+
+    layers = []
+    for index, layer in enumerate(tmx.layers):
+        if not isinstance(layer, pytmx.TiledTileLayer):
+            continue
+        typecode = 'H' if tmx.maxgid < 0x10000 else 'I'
+        data = array(typecode)
+        for row in layer.data:
+            data.extend(row)
+        layers.append((index, layer.name, bool(layer.visible), typecode, data.tobytes()))
+
+    animations = []
+    tile_properties = {}
+    for gid, properties in tmx.tile_properties.items():
+        frames = properties.get('frames')
+        if frames:
+            animations.append((gid, [(frame.gid, frame.duration) for frame in frames]))
+        properties = simple_properties(properties)
+        if properties:
+            tile_properties[gid] = properties
+
+    objects = [(getattr(obj, 'type', None), obj.name,
+                obj.x, obj.y, obj.width, obj.height, simple_properties(obj.properties))
+               for obj in tmx.objects]
+    walls = [tuple(rect) for rect in merge_rects(
+        (obj[2], obj[3], obj[4], obj[5]) for obj in objects if obj[0] == 'wall')]
+
+    return {
+        'sources': [source_record(path) for path in sources],
+        'width': tmx.width,
+        'height': tmx.height,
+        'tilewidth': tmx.tilewidth,
+        'tileheight': tmx.tileheight,
+        'layers': layers,
+        'images': list(tmx.images),
+        'animations': animations,
+        'tile_properties': tile_properties,
+        'objects': objects,
+        'merged_walls': walls,
+    }
+
+
+def write_cache(path, payload):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, marshal.version))
+        f.write(zlib.compress(marshal.dumps(payload)))
+
+
+def read_cache(path):
+    """ Return the payload stored at path, or None if it is missing or unusable
+    """
+    try:
+        with open(path, 'rb') as f:
+            blob = f.read()
+    except OSError:
+        return None
+    if len(blob) < HEADER.size or HEADER.unpack_from(blob) != (MAGIC, VERSION, marshal.version):
+        return None
+    try:
+        return marshal.loads(zlib.decompress(blob[HEADER.size:]))
+    except (EOFError, ValueError, TypeError, zlib.error):
+        return None
+
+
+def build(filename):
+    """ Compile filename and write its cache, return the payload
+    """
+    payload = compile_map(filename)
+    try:
+        write_cache(cache_path(filename), payload)
+    except OSError as e:
+        print("map cache not written for {}: {}".format(filename, e))
+    return payload
+
+
+def load_payload(filename):
+    """ Return the cache payload for filename, rebuilding the cache if it is stale
+    """
+    payload = read_cache(cache_path(filename))
+    if payload is None or not is_fresh(payload):
+        payload = build(filename)
+    return payload
+
+
+def load_tile_images(image_sources):
+    """ Cut the tile images out of their tilesets, each tileset is read once
+
+    image_sources is the 'images' list of a payload, the result is a list of
+    surfaces indexed the same way.
+    """
+    images = [None] * len(image_sources)
+    loaders = {}
+    for gid, source in enumerate(image_sources):
+        if not source:
+            continue
+        path, colorkey, rect, flags = source
+        loader = loaders.get((path, colorkey))
+        if loader is None:
+            loader = loaders[(path, colorkey)] = pygame_image_loader(path, colorkey)
+        images[gid] = loader(rect, pytmx.TileFlags(*flags) if flags else None)
+    return images
+
+
+def load_map(filename, load_images=True):
+    """ Load a map through its cache, rebuilding the cache if it is stale
+
+    Images need a display to be converted for; pass load_images=False to
+    only get the map data.
+    """
+    compiled = CompiledMap(filename, load_payload(filename))
+    if load_images:
+        compiled.load_images()
+    return compiled
+
+
+class MapObject(object):
+    """ An object placed on the map, as found in the TMX object layers
+    """
+
+    def __init__(self, type, name, x, y, width, height, properties=None):
+        self.type = type
+        self.name = name
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.properties = properties if properties is not None else {}
+
+
+class CompiledMap(object):
+    """ A map loaded from its cache
+
+    Looks enough like a pytmx TiledMap for the game: it has the map and tile
+    sizes, the objects and the tile images indexed by gid.  Tile layers are
+    flat arrays of gids, one row after another, keyed by layer index.
+    """
+
+    def __init__(self, filename, payload):
+        self.filename = filename
+        self.width = payload['width']
+        self.height = payload['height']
+        self.tilewidth = payload['tilewidth']
+        self.tileheight = payload['tileheight']
+        self.image_sources = payload['images']
+        self.images = [None] * len(self.image_sources)
+        self.animations = payload['animations']
+        self.tile_properties = payload['tile_properties']
+        self.objects = [MapObject(*obj) for obj in payload['objects']]
+        # (x, y, width, height) of the walls, merged
+        self.merged_walls = payload['merged_walls']
+
+        self.layers = {}
+        self.layer_names = {}
+        self.visible_tile_layers = []
+        for index, name, visible, typecode, data in payload['layers']:
+            layer = array(typecode)
+            layer.frombytes(data)
+            self.layers[index] = layer
+            self.layer_names[index] = name
+            if visible:
+                self.visible_tile_layers.append(index)
+
+    def load_images(self):
+        self.images = load_tile_images(self.image_sources)
+
+    def get_tile_gid(self, x, y, layer):
+        return self.layers[layer][y * self.width + x]
+
+
+class CompiledMapData(PyscrollDataAdapter):
+    """ pyscroll data source for a CompiledMap
+    """
+
+    def __init__(self, compiled):
+        PyscrollDataAdapter.__init__(self)
+        self.compiled = compiled
+        self.tile_size = compiled.tilewidth, compiled.tileheight
+        self.map_size = compiled.width, compiled.height
+        self.visible_tile_layers = compiled.visible_tile_layers
+        self.reload_animations()
+
+    def reload_data(self):
+        self.compiled = load_map(self.compiled.filename)
+
+    def get_animations(self):
+        return iter(self.compiled.animations)
+
+    def convert_surfaces(self, parent, alpha=False):
+        images = list()
+        for image in self.compiled.images:
+            if image is None:
+                images.append(None)
+            elif alpha:
+                images.append(image.convert_alpha(parent))
+            else:
+                images.append(image.convert(parent))
+        self.compiled.images = images
+
+    def _get_tile_image(self, x, y, l):
+        compiled = self.compiled
+        if 0 <= x < compiled.width and 0 <= y < compiled.height:
+            gid = compiled.get_tile_gid(x, y, l)
+            if gid:
+                return compiled.images[gid]
+        return None
+
+    def _get_tile_image_by_id(self, id):
+        return self.compiled.images[id]
+
+    def get_tile_images_by_rect(self, rect):
+        compiled = self.compiled
+        width = compiled.width
+        x1, y1, x2, y2 = rect_to_bb(rect)
+        x1 = max(x1, 0)
+        y1 = max(y1, 0)
+        x2 = min(x2, width - 1)
+        y2 = min(y2, compiled.height - 1)
+        images = compiled.images
+        at = self._animated_tile
+        tracked_gids = self._tracked_gids
+        anim_map = self._animation_map
+        track = bool(self._animation_queue)
+
+        for l in self.visible_tile_layers:
+            layer = compiled.layers[l]
+            for y in range(y1, y2 + 1):
+                start = y * width
+                for x, gid in enumerate(layer[start + x1:start + x2 + 1], x1):
+                    if not gid:
+                        continue
+                    # since the tile has been queried, assume it wants
+                    # to be checked for animations sometime in the future
+                    if track and gid in tracked_gids:
+                        anim_map[gid].positions.add((x, y, l))
+                    try:
+                        # animated, so return the correct frame
+                        tile = at[(x, y, l)]
+                    except KeyError:
+                        # not animated, so return surface from data, if any
+                        tile = images[gid]
+                    if tile:
+                        yield x, y, l, tile
+
+
+def main(filenames):
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join('data', 'maps', '*.tmx')))
+    for filename in filenames:
+        start = time.perf_counter()
+        try:
+            payload = build(filename)
+        except Exception as e:
+            print("{:<32} failed: {}".format(filename, e))
+            continue
+        elapsed = time.perf_counter() - start
+        walls = sum(1 for obj in payload['objects'] if obj[0] == 'wall')
+        print("{:<32} {:>8.1f} ms {:>10} bytes {:>5} -> {:<5} walls".format(
+            filename, elapsed * 1000, os.path.getsize(cache_path(filename)),
+            walls, len(payload['merged_walls'])))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
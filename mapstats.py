@@ -0,0 +1,161 @@
+""" What every map costs to load, and what is wrong with it.
+
+Goes over the TMX files, all of data/maps by default, one per process of a
+pool, and for each one reports:
+
+- how long reading the XML, and decoding it with pytmx, takes
+- how the tile layers are encoded: csv, base64 with or without gzip or zlib,
+  or plain XML
+- the objects by type, the hero spawn, and any type load_level() doesn't
+  know, which the game quietly ignores
+- an estimate of the memory the map takes: the Python objects pytmx builds,
+  measured, and the tileset images at 32 bits a pixel
+
+    python mapstats.py [map.tmx ...] [--workers N] [--json]
+
+With --json every map is a line of JSON instead of a row of the table, with
+the time it was measured and the map's hash, to append to a file and follow
+how load costs change as the maps do.  Exits with an error if a map can't be
+loaded.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os.path
+import time
+import tracemalloc
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
+
+# pytmx imports pygame, keep its banner out of the JSON
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pytmx
+
+# the object types load_level() does something with
+OBJECT_TYPES = ('wall', 'stair', 'hero', 'guard', 'door')
+
+
+def layer_encodings(root):
+    """ The encoding of each tile layer of a parsed TMX, by layer name
+    """
+    encodings = []
+    for layer in root.iter('layer'):
+        data = layer.find('data')
+        encoding = data.get('encoding') if data is not None else None
+        if encoding is None:
+            encoding = 'xml'
+        compression = data.get('compression') if data is not None else None
+        if compression:
+            encoding = '{}+{}'.format(encoding, compression)
+        encodings.append((layer.get('name'), encoding))
+    return encodings
+
+
+def analyze(filename):
+    """ Everything mapstats reports about one map, as a dict
+    """
+    with open(filename, 'rb') as f:
+        blob = f.read()
+    stats = {
+        'map': filename,
+        'sha1': hashlib.sha1(blob).hexdigest(),
+        'bytes': len(blob),
+    }
+    try:
+        start = time.perf_counter()
+        root = ElementTree.fromstring(blob)
+        stats['parse_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        start = time.perf_counter()
+        tmx_data = pytmx.TiledMap(filename)
+        stats['decode_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    except Exception as e:
+        stats['error'] = "{}: {}".format(type(e).__name__, e)
+        return stats
+
+    # again to measure what it keeps, tracemalloc would slow the timing
+    tracemalloc.start()
+    kept = pytmx.TiledMap(filename)
+    python_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    image_bytes = sum(tileset.width * tileset.height * 4 for tileset in tmx_data.tilesets
+                      if tileset.width and tileset.height)
+
+    objects = {}
+    unknown = set()
+    for map_object in tmx_data.objects:
+        kind = map_object.type or 'untyped'
+        objects[kind] = objects.get(kind, 0) + 1
+        if map_object.type and map_object.type not in OBJECT_TYPES:
+            unknown.add(map_object.type)
+
+    encodings = layer_encodings(root)
+    stats.update({
+        'width': tmx_data.width,
+        'height': tmx_data.height,
+        'tilewidth': tmx_data.tilewidth,
+        'tileheight': tmx_data.tileheight,
+        'layers': dict(encodings),
+        'encodings': sorted(set(encoding for name, encoding in encodings)),
+        'objects': objects,
+        'hero_spawns': objects.get('hero', 0),
+        'missing_hero_spawn': not objects.get('hero'),
+        'unknown_types': sorted(unknown),
+        'memory': {
+            'python': python_bytes,
+            'images': image_bytes,
+            'total': python_bytes + image_bytes,
+        },
+    })
+    return stats
+
+
+def analyze_all(filenames, workers=None):
+    """ analyze() every map on a pool of workers processes, in order
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(analyze, filenames))
+
+
+def print_table(results):
+    print("{:<34} {:>8} {:>10} {:>10} {:>9} {:<16} {}".format(
+        "map", "KB", "parse ms", "decode ms", "memory MB", "encoding", "objects"))
+    for stats in results:
+        if 'error' in stats:
+            print("{:<34} failed: {}".format(stats['map'], stats['error']))
+            continue
+        print("{:<34} {:>8.1f} {:>10.1f} {:>10.1f} {:>9.1f} {:<16} {}".format(
+            stats['map'], stats['bytes'] / 1024., stats['parse_ms'], stats['decode_ms'],
+            stats['memory']['total'] / 1024. / 1024., ",".join(stats['encodings']),
+            ", ".join("{} {}".format(count, kind) for kind, count in sorted(stats['objects'].items()))))
+        if stats['missing_hero_spawn']:
+            print("    no hero spawn, the hero starts in the middle of the map")
+        if stats['hero_spawns'] > 1:
+            print("    {} hero spawns, the last one is used".format(stats['hero_spawns']))
+        if stats['unknown_types']:
+            print("    objects of unknown type: {}".format(", ".join(stats['unknown_types'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the load cost and problems of every map.')
+    parser.add_argument('maps', nargs='*', help='maps to check, default all of data/maps')
+    parser.add_argument('--workers', type=int, help='processes to use, default one per core')
+    parser.add_argument('--json', action='store_true', help='write a line of JSON per map instead of a table')
+    args = parser.parse_args()
+
+    filenames = args.maps or sorted(glob.glob(os.path.join('data', 'maps', '*.tmx')))
+    measured = time.strftime('%Y-%m-%dT%H:%M:%S')
+    results = analyze_all(filenames, args.workers)
+    if args.json:
+        for stats in results:
+            stats['measured'] = measured
+            print(json.dumps(stats, sort_keys=True))
+    else:
+        print_table(results)
+    if any('error' in stats for stats in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+""" Where a hero sized body can get to on a map, and how.
+
+A NavGraph is worked out from a level's walls and stairs once and cached on
+disk next to the map (dungeon_0.tmx -> dungeon_0.tmx.nav):
+
+- nodes are the places a body can stand: on top of a wall, one tile
+  wide, with nothing in the way above.  A node is (x, y), the middle of the
+  feet
+- edges are how to get from one to another: 'walk' to the next tile,
+  'fall' off a ledge, 'jump' left, right or straight up, and 'stair' up or
+  down a flight of stairs.  Each costs the seconds it takes
+
+Walks, falls and jumps are found by running the hero's own physics from
+every node (see sim.py), ticking at TICK, so the arcs are exactly the ones
+HERO_JUMP_HEIGHT, GRAVITY and HERO_MOVE_SPEED give in the game.  That takes
+a while, so graphs are built ahead of time with this script, not when a
+level loads: load_level() only picks up a cached graph that is still good,
+see cached().  It stops being good when the walls, the stairs or those
+numbers change.
+
+path() is A* between two nodes and flow_field() is the way to one node from
+all of them, for any number of NPCs heading the same way.
+
+Run it over maps to build their graphs and list what can't be reached from
+the hero spawn:
+
+    python navigation.py [map.tmx ...]
+"""
+import glob
+import hashlib
+import heapq
+import marshal
+import math
+import os.path
+import sys
+import time
+import zlib
+
+import pygame
+
+NAV_SUFFIX = '.nav'
+
+# bump when the layout of the cache changes
+VERSION = 1
+
+# longest a fall or jump is followed, in seconds.  one that hasn't landed
+# by then leaves the map
+MAX_AIR_TIME = 4.0
+
+EDGE_KINDS = ('walk', 'fall', 'jump', 'stair')
+
+# seconds per tick of the hero's physics when finding arcs.  fixed, so a
+# graph doesn't depend on how the game is set to run
+TICK = 1 / 120.
+
+
+def nav_path(filename):
+    return filename + NAV_SUFFIX
+
+
+class NavGraph(object):
+    """ Nodes are indices into nodes, a list of (x, y); edges[node] is a list
+    of (target, kind, cost)
+    """
+
+    def __init__(self, nodes, edges, tilewidth, speed):
+        self.nodes = nodes
+        self.edges = edges
+        self.tilewidth = tilewidth
+        # the fastest a body moves sideways, for the A* estimate
+        self.speed = speed
+        # (column, y) -> node
+        self.spots = dict(((int(x // tilewidth), y), node) for node, (x, y) in enumerate(nodes))
+        # edges into each node, for flow fields
+        self.reverse = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def edge_count(self):
+        return sum(len(edges) for edges in self.edges)
+
+    def nearest(self, x, y):
+        """ The node nearest a body with the middle of its feet at (x, y), or None
+        """
+        node = self.spots.get((int(x // self.tilewidth), y))
+        if node is not None or not self.nodes:
+            return node
+        return min(range(len(self.nodes)),
+                   key=lambda node: (self.nodes[node][0] - x) ** 2 + (self.nodes[node][1] - y) ** 2)
+
+    def path(self, start, goal):
+        """ The cheapest way from node start to node goal, as a list of
+        (node, kind) with the kind of edge taken to get to each node, or None
+        if there's no way
+        """
+        nodes = self.nodes
+        goal_x = nodes[goal][0]
+        speed = self.speed
+        came_from = {start: None}
+        cost = {start: 0.0}
+        queue = [(abs(goal_x - nodes[start][0]) / speed, start)]
+        while queue:
+            estimate, node = heapq.heappop(queue)
+            if node == goal:
+                break
+            base = cost[node]
+            if estimate > base + abs(goal_x - nodes[node][0]) / speed:
+                # a cheaper way here was found after this was queued
+                continue
+            for target, kind, edge_cost in self.edges[node]:
+                new_cost = base + edge_cost
+                if new_cost < cost.get(target, math.inf):
+                    cost[target] = new_cost
+                    came_from[target] = (node, kind)
+                    heapq.heappush(queue, (new_cost + abs(goal_x - nodes[target][0]) / speed, target))
+        else:
+            return None
+
+        route = []
+        node = goal
+        while came_from[node] is not None:
+            previous, kind = came_from[node]
+            route.append((node, kind))
+            node = previous
+        route.reverse()
+        return route
+
+    def flow_field(self, goal):
+        """ The way to goal from every node: two lists, the next node to go to
+        (None where goal can't be reached, and at goal) and the seconds left
+        """
+        if self.reverse is None:
+            self.reverse = [[] for _ in self.nodes]
+            for node, edges in enumerate(self.edges):
+                for target, kind, cost in edges:
+                    self.reverse[target].append((node, cost))
+        costs = [math.inf] * len(self.nodes)
+        following = [None] * len(self.nodes)
+        costs[goal] = 0.0
+        queue = [(0.0, goal)]
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if cost > costs[node]:
+                continue
+            for source, edge_cost in self.reverse[node]:
+                new_cost = cost + edge_cost
+                if new_cost < costs[source]:
+                    costs[source] = new_cost
+                    following[source] = node
+                    heapq.heappush(queue, (new_cost, source))
+        return following, costs
+
+    def reachable(self, start):
+        """ The set of nodes that can be got to from start
+        """
+        seen = {start}
+        stack = [start]
+        while stack:
+            for target, kind, cost in self.edges[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return seen
+
+    def areas(self, nodes):
+        """ Group nodes into runs side by side, return them as pygame rects of
+        the floor they stand on
+        """
+        tw = self.tilewidth
+        spots = sorted((self.nodes[node][1], int(self.nodes[node][0] // tw)) for node in nodes)
+        rects = []
+        for y, column in spots:
+            last = rects[-1] if rects else None
+            if last is not None and last.y == int(y) and last.right == column * tw:
+                last.width += tw
+            else:
+                rects.append(pygame.Rect(column * tw, int(y), tw, 0))
+        return rects
+
+
+def geometry_key(walls, stairs, hero, dt):
+    """ A digest of everything the graph depends on
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((sorted(tuple(rect) for rect in walls), sorted(tuple(rect) for rect in stairs),
+                        hero.HERO_JUMP_HEIGHT, hero.HERO_MOVE_SPEED, hero.GRAVITY, hero.JUMP_DELAY,
+                        hero.CLIMBING_SPEED, tuple(hero.rect.size), hero.COLLISION_BOX_OFFSET, dt)).encode())
+    return digest.hexdigest()
+
+
+def level_rects(index, tmx_data):
+    """ The rects of everything in a wall or stair index
+    """
+    area = pygame.Rect(0, 0, tmx_data.width * tmx_data.tilewidth, tmx_data.height * tmx_data.tileheight)
+    return [sprite.rect for sprite in index.query(area)]
+
+
+def flights(stairs):
+    """ Group stair rects that touch corner to corner into flights, return
+    (bottom step, top step) of each
+    """
+    groups = []
+    for rect in sorted(stairs, key=lambda rect: (rect.x, rect.y)):
+        touching = [group for group in groups if rect.inflate(2, 2).collidelist(group) != -1]
+        merged = [rect]
+        for group in touching:
+            merged.extend(group)
+            groups.remove(group)
+        groups.append(merged)
+    return [(max(group, key=lambda rect: rect.bottom), min(group, key=lambda rect: rect.top))
+            for group in groups]
+
+
+def build(level, simulation):
+    """ Work out the NavGraph of level, running simulation's hero around it
+    """
+    tmx_data = level.tmx_data
+    tw = tmx_data.tilewidth
+    hero = simulation.hero
+    box_width = hero.rect.width - hero.COLLISION_BOX_OFFSET
+    box_height = hero.rect.height
+    walls = level_rects(level.wall_index, tmx_data)
+    stairs = level_rects(level.stair_index, tmx_data)
+
+    def clear(x, y):
+        # nothing in the way of a body standing with its feet at y
+        for wall in level.wall_index.query(pygame.Rect(int(x) - 1, int(y - box_height) - 1, box_width + 2, box_height + 2)):
+            rect = wall.rect
+            if (x < rect.right and x + box_width > rect.left
+                    and y - box_height < rect.bottom and y > rect.top):
+                return False
+        return True
+
+    # a node for every tile along the top of every wall with room above it
+    nodes = []
+    spots = {}
+    for rect in sorted(walls, key=lambda rect: (rect.top, rect.left)):
+        for column in range(rect.left // tw, (rect.right + tw - 1) // tw):
+            key = (column, rect.top)
+            if key not in spots and clear(column * tw, rect.top):
+                spots[key] = len(nodes)
+                nodes.append((column * tw + box_width / 2., rect.top))
+    graph = NavGraph(nodes, [[] for _ in nodes], tw, float(max(hero.HERO_MOVE_SPEED, hero.CLIMBING_SPEED)))
+
+    def land(x, feet):
+        column = int((x + box_width / 2.) // tw)
+        for offset in (0, -1, 1):
+            node = spots.get((column + offset, feet))
+            if node is not None:
+                return node
+        return None
+
+    from sim import JUMP, LEFT, RIGHT
+    dt = simulation.dt
+    walk_ticks = int(math.ceil(tw / float(hero.HERO_MOVE_SPEED) / dt))
+    air_ticks = int(MAX_AIR_TIME / dt)
+
+    def run(x, y, first, held, hold, jump):
+        # do first for a tick and held until hold ticks, then let go, until
+        # the hero comes down.  return (node, airborne, seconds) or None
+        simulation.place(x, y)
+        hero = simulation.hero
+        airborne = False
+        for tick in range(hold + air_ticks):
+            simulation.step(first if tick == 0 else held if tick < hold else 0)
+            if not hero.grounded:
+                airborne = True
+            elif airborne:
+                # grounded counts from a little above the floor
+                if hero._position[1] == hero._old_position[1]:
+                    break
+            elif tick >= walk_ticks:
+                # walked all the way without falling, or never got off the
+                # ground: a ceiling right above
+                if jump:
+                    return None
+                break
+        else:
+            return None
+        node = land(hero._position[0] + hero.COLLISION_BOX_OFFSET, hero._position[1] + box_height)
+        if node is None:
+            return None
+        return node, airborne, (tick + 1) * dt
+
+    for node, (x, y) in enumerate(nodes):
+        edges = graph.edges[node]
+        for direction in (LEFT, RIGHT):
+            found = run(x, y, direction, direction, walk_ticks, False)
+            if found is not None and found[0] != node:
+                target, airborne, cost = found
+                edges.append((target, 'fall' if airborne else 'walk', cost))
+        for direction in (0, LEFT, RIGHT):
+            found = run(x, y, JUMP | direction, direction, air_ticks, True)
+            if found is not None and found[0] != node:
+                target, airborne, cost = found
+                edges.append((target, 'jump', cost))
+
+    for bottom, top in flights(stairs):
+        lower = land(bottom.left, bottom.bottom)
+        upper = land(top.left, top.top)
+        if lower is not None and upper is not None and lower != upper:
+            cost = (bottom.bottom - top.top) / float(hero.CLIMBING_SPEED)
+            graph.edges[lower].append((upper, 'stair', cost))
+            graph.edges[upper].append((lower, 'stair', cost))
+    return graph
+
+
+def cached(level, dt=TICK):
+    """ Return the NavGraph of a level loaded by levels.load_level from the
+    cache next to the map, or None if there is none or it is out of date
+    """
+    graph, simulation, key = _cached(level, dt)
+    return graph
+
+
+def _cached(level, dt):
+    from sim import Simulation
+
+    simulation = Simulation(level, dt, reset=False)
+    key = geometry_key(level_rects(level.wall_index, level.tmx_data),
+                       level_rects(level.stair_index, level.tmx_data), simulation.hero, dt)
+    try:
+        with open(nav_path(level.filename), 'rb') as f:
+            payload = marshal.loads(zlib.decompress(f.read()))
+    except (OSError, EOFError, ValueError, TypeError, zlib.error):
+        payload = None
+    if payload is None or payload['version'] != VERSION or payload['key'] != key:
+        return None, simulation, key
+    return NavGraph(payload['nodes'], payload['edges'], payload['tilewidth'], payload['speed']), simulation, key
+
+
+def load(level, dt=TICK):
+    """ Return the NavGraph of a level loaded by levels.load_level, from the
+    cache next to the map if it's still good, otherwise building and caching
+    it, which can take a while
+    """
+    graph, simulation, key = _cached(level, dt)
+    if graph is not None:
+        return graph
+
+    graph = build(level, simulation)
+    path = nav_path(level.filename)
+    try:
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(marshal.dumps({
+                'version': VERSION,
+                'key': key,
+                'tilewidth': graph.tilewidth,
+                'speed': graph.speed,
+                'nodes': graph.nodes,
+                'edges': graph.edges,
+            })))
+    except OSError as e:
+        print("navigation graph not written for {}: {}".format(level.filename, e))
+    return graph
+
+
+def report(level, graph):
+    """ Lines about what can't be reached from the hero spawn of level
+    """
+    from sim import Simulation
+
+    if level.hero_spawn is None:
+        return ["no hero spawn to measure from"]
+    hero = Simulation(level).hero
+    start = graph.nearest(hero._position[0] + hero.rect.width / 2. + hero.COLLISION_BOX_OFFSET / 2.,
+                          hero._position[1] + hero.rect.height)
+    if start is None:
+        return ["no standing room anywhere"]
+    reachable = graph.reachable(start)
+    lines = []
+    for rect in graph.areas(set(range(len(graph))) - reachable):
+        lines.append("unreachable floor x {}-{} at y {}".format(rect.left, rect.right, rect.top))
+    for kind, things in (('guard', level.guards),
+                         ('door', [(door.rect.centerx, door.rect.bottom) for door in level.doors])):
+        for x, y in things:
+            node = graph.nearest(x, y)
+            if node is None or node not in reachable:
+                lines.append("unreachable {} at {}, {}".format(kind, x, y))
+    return lines
+
+
+def main(filenames):
+    from headless import init_headless
+    init_headless((1, 1))
+    import levels
+
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join('data', 'maps', '*.tmx')))
+    for filename in filenames:
+        start = time.perf_counter()
+        try:
+            level = levels.load_level(filename, graphics=False)
+            graph = load(level)
+        except Exception as e:
+            print("{:<32} failed: {}".format(filename, e))
+            continue
+        elapsed = time.perf_counter() - start
+        kinds = dict((kind, 0) for kind in EDGE_KINDS)
+        for edges in graph.edges:
+            for target, kind, cost in edges:
+                kinds[kind] += 1
+        print("{:<32} {:>8.1f} ms {:>5} nodes {:>5} edges ({})".format(
+            filename, elapsed * 1000, len(graph), graph.edge_count(),
+            ", ".join("{} {}".format(kinds[kind], kind) for kind in EDGE_KINDS)))
+        for line in report(level, graph):
+            print("    " + line)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,269 @@
+""" Guards, kept as arrays instead of one sprite each.
+
+A Crowd stores every guard's position, velocity, state, facing and animation
+timer in numpy arrays, and updates all of them at once each tick: gravity,
+patrolling, landing on floors and picking animation frames are each a handful
+of array operations however many guards there are.
+
+Guards collide against a TileGrid, so they see the level one tile at a time.
+They patrol: walk for a while, stop for a while, and turn around when they
+meet a wall or the edge of a platform.
+
+Requires numpy.
+"""
+import numpy
+import pygame
+
+from pyscroll.group import PyscrollGroup
+
+
+class Crowd(object):
+    """ Every guard on the map
+    """
+
+    GRAVITY = 1000
+    MAX_FALL_SPEED = 600
+    WALK_SPEED = 60  # pixels per second
+
+    # seconds spent walking and then standing, each guard starts at a random
+    # point of the cycle so they don't all move in step
+    PATROL_TIME = 3.0
+    PAUSE_TIME = 1.5
+
+    STATE_STANDING = 0
+    STATE_WALKING = 1
+    STATE_FALLING = 2
+
+    FACING_RIGHT = 0
+    FACING_LEFT = 1
+
+    # size of the body used for collisions, the image is drawn centered on it
+    WIDTH = 16
+    HEIGHT = 32
+
+    def __init__(self, grid=None, capacity=64, seed=0):
+        self.grid = grid
+        self.count = 0
+        self.random = numpy.random.default_rng(seed)
+        self.clips = None
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        def grow(old, dtype):
+            new = numpy.zeros(capacity, dtype=dtype)
+            if old is not None:
+                new[:self.count] = old[:self.count]
+            return new
+
+        self.x = grow(getattr(self, 'x', None), numpy.float64)
+        self.y = grow(getattr(self, 'y', None), numpy.float64)
+        self.old_x = grow(getattr(self, 'old_x', None), numpy.float64)
+        self.old_y = grow(getattr(self, 'old_y', None), numpy.float64)
+        self.vx = grow(getattr(self, 'vx', None), numpy.float64)
+        self.vy = grow(getattr(self, 'vy', None), numpy.float64)
+        self.state = grow(getattr(self, 'state', None), numpy.int8)
+        self.facing = grow(getattr(self, 'facing', None), numpy.int8)
+        self.time_in_state = grow(getattr(self, 'time_in_state', None), numpy.float64)
+        self.patrol_timer = grow(getattr(self, 'patrol_timer', None), numpy.float64)
+        self.walking = grow(getattr(self, 'walking', None), bool)
+        self.frame = grow(getattr(self, 'frame', None), numpy.int16)
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.count
+
+    def add(self, x, y, facing=FACING_RIGHT):
+        """ Add a guard with its body's top left at x, y and return its index
+        """
+        if self.count == self.capacity:
+            self._allocate(self.capacity * 2)
+        i = self.count
+        self.x[i] = self.old_x[i] = x
+        self.y[i] = self.old_y[i] = y
+        self.vx[i] = self.vy[i] = 0
+        self.state[i] = self.STATE_STANDING
+        self.facing[i] = facing
+        self.time_in_state[i] = 0
+        self.walking[i] = self.random.random() < .5
+        self.patrol_timer[i] = self.random.random() * self.PATROL_TIME
+        self.frame[i] = 0
+        self.count += 1
+        return i
+
+    def load_clips(self, spritesheet):
+        """ Cut the guard animations from a Spritesheet
+
+        self.clips is indexed by state, then facing, and holds a tuple of
+        frames.  Frame durations are in self.frame_durations, by state.  The
+        frames, flipped ones too, come from the asset cache, so a level
+        entered again reuses them.
+        """
+        colorkey = (0, 255, 81)
+        clips = (
+            # state, frame positions on the sheet, seconds per frame
+            (self.STATE_STANDING, ((0, 0), (32, 0), (64, 0), (96, 0)), .5),
+            (self.STATE_WALKING, ((192, 0), (96, 0), (64, 32), (96, 0)), .15),
+            (self.STATE_FALLING, ((160, 160),), 1.0),
+        )
+        self.clips = [None] * len(clips)
+        self.frame_durations = numpy.zeros(len(clips))
+        self.frame_counts = numpy.zeros(len(clips), dtype=numpy.int16)
+        for state, positions, duration in clips:
+            rects = [pygame.Rect(x, y, 32, 32) for x, y in positions]
+            images = spritesheet.images_at(rects, colorkey)
+            flipped = spritesheet.images_at(rects, colorkey, flip=True)
+            self.clips[state] = (tuple(images), tuple(flipped))
+            self.frame_durations[state] = duration
+            self.frame_counts[state] = len(images)
+
+    def _solid_at(self, tx, ty):
+        """ For arrays of tile coordinates, which are solid
+
+        Below the map is solid, so nobody falls forever, the rest of the
+        outside of the map is empty.
+        """
+        solid = self.grid.solid
+        height, width = solid.shape
+        inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < height)
+        result = ty >= height
+        result[inside] = solid[ty[inside], tx[inside]]
+        return result
+
+    def update(self, dt):
+        """ Advance every guard by dt seconds
+        """
+        n = self.count
+        if n == 0 or self.grid is None:
+            return
+        tw = self.grid.tilewidth
+        th = self.grid.tileheight
+        x = self.x[:n]
+        y = self.y[:n]
+        vx = self.vx[:n]
+        vy = self.vy[:n]
+        facing = self.facing[:n]
+        walking = self.walking[:n]
+        self.old_x[:n] = x
+        self.old_y[:n] = y
+
+        # standing on something is having a solid tile just under the feet
+        center_tx = ((x + self.WIDTH / 2) // tw).astype(numpy.int64)
+        foot_ty = ((y + self.HEIGHT) // th).astype(numpy.int64)
+        grounded = self._solid_at(center_tx, foot_ty)
+
+        # patrol: alternate walking and standing
+        timer = self.patrol_timer[:n]
+        timer -= dt
+        done = timer <= 0
+        walking ^= done
+        timer[done] += numpy.where(walking[done], self.PATROL_TIME, self.PAUSE_TIME)
+
+        # turn around at walls and at the edges of platforms
+        direction = numpy.where(facing == self.FACING_LEFT, -1.0, 1.0)
+        ahead_tx = ((x + self.WIDTH / 2 + direction * (self.WIDTH / 2 + 1)) // tw).astype(numpy.int64)
+        body_ty = ((y + self.HEIGHT - 1) // th).astype(numpy.int64)
+        blocked = self._solid_at(ahead_tx, body_ty) | ~self._solid_at(ahead_tx, foot_ty)
+        turn = walking & grounded & blocked
+        facing[turn] ^= 1
+        direction[turn] *= -1
+
+        vx[:] = numpy.where(walking & grounded & ~turn, direction * self.WALK_SPEED, 0)
+        vy[:] = numpy.where(grounded, 0, numpy.minimum(vy + self.GRAVITY * dt, self.MAX_FALL_SPEED))
+        x += vx * dt
+        y += vy * dt
+
+        # land on the top of the tile the feet fell into
+        falling = vy > 0
+        new_foot_ty = ((y + self.HEIGHT) // th).astype(numpy.int64)
+        landed = falling & (new_foot_ty > foot_ty) & self._solid_at(center_tx, new_foot_ty)
+        y[landed] = new_foot_ty[landed] * th - self.HEIGHT
+        vy[landed] = 0
+
+        # states and animation frames
+        state = numpy.where(grounded | landed,
+                            numpy.where(vx != 0, self.STATE_WALKING, self.STATE_STANDING),
+                            self.STATE_FALLING).astype(numpy.int8)
+        time_in_state = self.time_in_state[:n]
+        time_in_state[state != self.state[:n]] = 0
+        time_in_state += dt
+        self.state[:n] = state
+        if self.clips is not None:
+            self.frame[:n] = (time_in_state // self.frame_durations[state]).astype(numpy.int64) % self.frame_counts[state]
+
+    def surfaces(self, view_rect, offset, layer, alpha=1.0):
+        """ Return (image, rect, layer) for every guard inside view_rect
+
+        Positions are interpolated alpha of the way from the previous tick,
+        and moved by offset to screen coordinates, as pyscroll expects.
+        """
+        n = self.count
+        if n == 0 or self.clips is None:
+            return []
+        x = self.old_x[:n] + (self.x[:n] - self.old_x[:n]) * alpha
+        y = self.old_y[:n] + (self.y[:n] - self.old_y[:n]) * alpha
+        visible = numpy.nonzero(
+            (x + self.WIDTH > view_rect.left) & (x < view_rect.right) &
+            (y + self.HEIGHT > view_rect.top) & (y < view_rect.bottom))[0]
+
+        ox, oy = offset
+        clips = self.clips
+        state = self.state
+        facing = self.facing
+        frame = self.frame
+        result = []
+        for i in visible.tolist():
+            image = clips[state[i]][facing[i]][frame[i]]
+            left = int(x[i]) + (self.WIDTH - image.get_width()) // 2 + ox
+            top = int(y[i]) + self.HEIGHT - image.get_height() + oy
+            result.append((image, pygame.Rect(left, top, image.get_width(), image.get_height()), layer))
+        return result
+
+
+class CrowdGroup(PyscrollGroup):
+    """ A PyscrollGroup that also draws Crowds
+
+    Crowd members are drawn on default_layer, sorted into the map like any
+    other sprite.  With over_layer set every sprite and crowd member is
+    drawn on that layer instead: above the top tile layer the renderer
+    doesn't have to draw tiles back over them.
+    """
+
+    def __init__(self, map_layer, *args, **kwargs):
+        PyscrollGroup.__init__(self, map_layer, *args, **kwargs)
+        self.crowds = []
+        self.alpha = 1.0
+        self.over_layer = None
+
+    def set_map_layer(self, map_layer):
+        """ Draw through a different renderer of the same map
+        """
+        self._map_layer = map_layer
+
+    def surfaces(self):
+        """ (image, rect, layer) of every sprite and crowd member in view, in
+        the screen coordinates the renderer wants
+        """
+        ox, oy = self._map_layer.get_center_offset()
+        view_rect = self.view
+
+        new_surfaces = list()
+        spritedict = self.spritedict
+        gl = self.get_layer_of_sprite
+        new_surfaces_append = new_surfaces.append
+        over_layer = self.over_layer
+
+        for spr in self.sprites():
+            new_rect = spr.rect.move(ox, oy)
+            if spr.rect.colliderect(view_rect):
+                new_surfaces_append((spr.image, new_rect, gl(spr) if over_layer is None else over_layer))
+                spritedict[spr] = new_rect
+
+        crowd_layer = self._default_layer if over_layer is None else over_layer
+        for crowd in self.crowds:
+            new_surfaces.extend(crowd.surfaces(view_rect, (ox, oy), crowd_layer, self.alpha))
+
+        self.lostsprites = []
+        return new_surfaces
+
+    def draw(self, surface):
+        return self._map_layer.draw(surface, surface.get_rect(), self.surfaces())
@@ -0,0 +1,170 @@
+""" Trading drawing detail for frame rate when frames run long.
+
+A QualityGovernor watches how long recent frames took to play and draw,
+without the wait for the next frame, against the frame budget of
+FRAME_RATE.  When they keep running over it drops a quality level, when
+there's been plenty of room for a while it goes back up one.  Going down
+takes a couple of bad windows, going up many good ones, with a pause after
+every change, so the level doesn't flip back and forth at the edge.
+
+The levels, best first:
+
+- high: everything
+- medium: tile animations stop, on the frame they are on.  Animated
+  tiles make the renderer redraw parts of its buffer, force full frames
+  when drawing dirty rects, and make renderers picked up again redraw
+  whole
+- low: sprites are drawn over every tile layer instead of between them, so
+  the renderer doesn't draw tiles back over sprites that are behind
+  them, and only the parts of the screen that changed are drawn and
+  presented (see dirty.py)
+- low, half rate: as low, and frames are paced at half FRAME_RATE, so
+  a machine that can't keep up shows frames evenly instead of missing
+  every other one
+
+Only drawing changes.  The simulation runs in fixed ticks however often
+frames are drawn, so the hero moves exactly the same at every level.
+
+Every change is printed with the frame times that caused it.
+"""
+import numpy
+
+import dirty
+
+
+class QualityLevel(object):
+    """ What is drawn, and how often, at one level
+    """
+
+    def __init__(self, name, animations, layered_sprites, dirty_rects, pace):
+        self.name = name
+        self.animations = animations
+        # sprites between tile layers, or over all of them
+        self.layered_sprites = layered_sprites
+        self.dirty_rects = dirty_rects
+        # frames are drawn at FRAME_RATE / pace
+        self.pace = pace
+
+
+LEVELS = (
+    QualityLevel('high', True, True, False, 1),
+    QualityLevel('medium', False, True, False, 1),
+    QualityLevel('low', False, False, True, 1),
+    QualityLevel('low, half rate', False, False, True, 2),
+)
+
+
+class QualityGovernor(object):
+    """ Picks the quality level of a QuestGame from its frame times
+
+    Call update() at the end of every frame and apply() whenever the game
+    changes level or view, so the current level's settings carry over.
+
+    Every window frames the frame times, the time spent on input, update,
+    draw and flip, are checked at their percentile: over down of the
+    budget counts towards going down a level, under up of it towards going
+    up.  It takes down_windows windows in a row to go down and up_windows
+    to go up.  The first window after a change isn't counted, it has the
+    cost of the change in it.
+    """
+
+    def __init__(self, frame_rate, window=30, percentile=90, down=.9, up=.5,
+                 down_windows=2, up_windows=8, levels=LEVELS):
+        self.frame_rate = frame_rate
+        self.budget = 1. / frame_rate
+        self.window = window
+        self.percentile = percentile
+        self.down = down
+        self.up = up
+        self.down_windows = down_windows
+        self.up_windows = up_windows
+        self.levels = levels
+        self.index = 0
+        self.slow = 0
+        self.fast = 0
+        self.frames = 0
+        self.settling = False
+        # the map data whose tile animations were stopped, and whether
+        # the game draws dirty rects only because of the level
+        self.paused_data = None
+        self.made_dirty = False
+        # (frame, old level name, new level name, frame time) of every change
+        self.changes = []
+
+    @property
+    def level(self):
+        return self.levels[self.index]
+
+    def settle(self):
+        """ Don't count the next window, after something slow like a resize
+        """
+        self.settling = True
+
+    def update(self, game):
+        """ Look at the frame times once a window, change level if needed
+        """
+        self.frames += 1
+        if self.frames % self.window:
+            return
+        samples = game.frame_timer.recent()[-self.window:, :-1]
+        if len(samples) < self.window:
+            return
+        if self.settling:
+            self.settling = False
+            return
+        busy = float(numpy.percentile(samples.sum(axis=1), self.percentile))
+        if busy > self.budget * self.down:
+            self.slow += 1
+            self.fast = 0
+        elif busy < self.budget * self.up:
+            self.fast += 1
+            self.slow = 0
+        else:
+            self.slow = self.fast = 0
+
+        if self.slow >= self.down_windows and self.index < len(self.levels) - 1:
+            self.change(game, self.index + 1, busy)
+        elif self.fast >= self.up_windows and self.index > 0:
+            self.change(game, self.index - 1, busy)
+
+    def change(self, game, index, busy):
+        old = self.level
+        self.index = index
+        self.slow = self.fast = 0
+        self.settling = True
+        self.changes.append((game.frame_timer.frames, old.name, self.level.name, busy))
+        print("quality: {} -> {}, p{} frame time {:.2f} ms of {:.2f} ms".format(
+            old.name, self.level.name, self.percentile, busy * 1000, self.budget * 1000))
+        self.apply(game)
+
+    def apply(self, game):
+        """ Set up game's group, map and frame rate for the current level
+        """
+        level = self.level
+        game.frame_rate = self.frame_rate // level.pace
+
+        data = game.level.map_data
+        if level.animations:
+            if self.paused_data is data:
+                # start them over, and have the renderer note where the
+                # animated tiles are again
+                data.reload_animations()
+                game.map_layer.redraw_tiles(game.map_layer._buffer)
+            self.paused_data = None
+        else:
+            data._animation_queue = []
+            self.paused_data = data
+
+        if level.layered_sprites:
+            game.group.over_layer = None
+        else:
+            game.group.over_layer = max(data.visible_tile_layers) + 1
+
+        if level.dirty_rects and game.dirty is None:
+            game.dirty = dirty.DirtyRects()
+            self.made_dirty = True
+        elif not level.dirty_rects and self.made_dirty:
+            game.dirty = None
+            self.made_dirty = False
+        if game.dirty is not None:
+            game.dirty.invalidate()
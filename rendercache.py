@@ -0,0 +1,84 @@
+""" Renderers kept per zoom level and window size.
+
+Changing a pyscroll BufferedRenderer's zoom or size throws away its buffers
+and draws every tile of the view into new ones.  Instead the game keeps a
+renderer for each (zoom, size) it has used recently, each with its tile
+layers already drawn, and switching zoom or going back to an earlier window
+size just picks the matching one.  Scrolling keeps a renderer's buffer up to
+date a row or column at a time as usual; one that was put aside while the
+camera moved far away redraws once when it is picked again.
+
+Tile animations and streamed chunks are handed to whichever renderer draws
+next, so on maps with either a renderer is redrawn when it is picked again,
+like after a resize.  That still saves making its buffers.
+
+The cache is bounded by count and by the bytes of the buffers, and the
+least recently used renderers go first.
+"""
+from collections import OrderedDict
+
+import pyscroll
+
+from assets import surface_bytes
+
+# the renderer options the game uses, besides the size and zoom
+RENDERER_OPTIONS = {'clamp_camera': True, 'tall_sprites': 1}
+
+
+def renderer_bytes(renderer):
+    total = surface_bytes(renderer._buffer)
+    if renderer._zoom_buffer is not None:
+        total += surface_bytes(renderer._zoom_buffer)
+    return total
+
+
+class RendererCache(object):
+    """ BufferedRenderers of one map, keyed by (size, zoom)
+    """
+
+    def __init__(self, map_data, capacity=4, max_bytes=64 * 1024 * 1024):
+        self.map_data = map_data
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.renderers = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, size, zoom):
+        """ Return the renderer for a view of size pixels at zoom, making it if
+        there isn't one
+        """
+        key = (tuple(size), zoom)
+        renderer = self.renderers.get(key)
+        if renderer is not None:
+            self.hits += 1
+            self.renderers.move_to_end(key)
+            if self.map_data._animation_queue or hasattr(self.map_data, 'tiles_pending'):
+                # it missed the tile changes the other renderers were given
+                renderer.redraw_tiles(renderer._buffer)
+            return renderer
+
+        self.misses += 1
+        renderer = pyscroll.BufferedRenderer(self.map_data, key[0], zoom=zoom, **RENDERER_OPTIONS)
+        self.renderers[key] = renderer
+        self.bytes += renderer_bytes(renderer)
+        while len(self.renderers) > 1 and (len(self.renderers) > self.capacity or self.bytes > self.max_bytes):
+            old_key, old = self.renderers.popitem(last=False)
+            self.bytes -= renderer_bytes(old)
+            self.evictions += 1
+        return renderer
+
+    def clear(self):
+        self.renderers.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.renderers),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,238 @@
+""" Recording the input of a play session, and playing it back.
+
+A recording holds the map, and for every simulation tick the tick's dt and
+which of the game's keys were held, one byte per tick.  Feeding it back into
+a fresh game reproduces the session tick for tick, so a collision bug or a
+slow stretch of a level can be replayed as often as needed, as fast as the
+machine can simulate it.
+
+Record with:
+
+    python main.py --record session.rec
+
+Play back, optionally in a window, writing the hero's position every tick:
+
+    python replay.py session.rec [--window] [--trace positions.txt]
+
+Compare the position traces of two runs:
+
+    python replay.py session.rec --compare positions.txt
+
+Jump back to a tick once the replay is over and play on from there, checking
+the hero goes the same way as the first time:
+
+    python replay.py session.rec --seek 600
+"""
+import argparse
+import struct
+import time
+import zlib
+from array import array
+
+import pygame
+from pygame.locals import K_DOWN, K_LEFT, K_RIGHT, K_SPACE, K_UP
+
+from headless import KeyState
+
+MAGIC = b'QREC'
+VERSION = 1
+
+# map name length, tick count
+HEADER = struct.Struct('<4sHHI')
+
+# the keys the simulation reads, each one is a bit of the per tick byte
+RECORDED_KEYS = (K_LEFT, K_RIGHT, K_UP, K_DOWN, K_SPACE)
+
+
+def key_mask(pressed):
+    mask = 0
+    for bit, key in enumerate(RECORDED_KEYS):
+        if pressed[key]:
+            mask |= 1 << bit
+    return mask
+
+
+def mask_keys(mask):
+    return [key for bit, key in enumerate(RECORDED_KEYS) if mask & (1 << bit)]
+
+
+class Recording(object):
+    """ The input of a session: the map, and the dt and held keys of every tick
+    """
+
+    def __init__(self, map_filename, dts=None, masks=None):
+        self.map_filename = map_filename
+        self.dts = dts if dts is not None else array('d')
+        self.masks = masks if masks is not None else array('B')
+
+    def __len__(self):
+        return len(self.masks)
+
+    def record(self, dt, pressed):
+        self.dts.append(dt)
+        self.masks.append(key_mask(pressed))
+
+    def truncate(self, ticks):
+        """ Forget every tick after the first ticks
+        """
+        del self.dts[ticks:]
+        del self.masks[ticks:]
+
+    def save(self, path):
+        name = self.map_filename.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(name), len(self)))
+            f.write(name)
+            f.write(zlib.compress(self.dts.tobytes() + self.masks.tobytes()))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            blob = f.read()
+        magic, version, name_length, ticks = HEADER.unpack_from(blob)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a version {} recording".format(path, VERSION))
+        offset = HEADER.size
+        name = blob[offset:offset + name_length].decode('utf-8')
+        body = zlib.decompress(blob[offset + name_length:])
+        dts = array('d')
+        dts.frombytes(body[:ticks * dts.itemsize])
+        masks = array('B')
+        masks.frombytes(body[ticks * dts.itemsize:])
+        return cls(name, dts, masks)
+
+
+class ReplayInput(object):
+    """ Hands the game the recorded keys, one tick per call
+
+    Pass it to QuestGame as get_pressed.
+    """
+
+    def __init__(self, recording):
+        self.states = [KeyState(mask_keys(mask)) for mask in range(1 << len(RECORDED_KEYS))]
+        self.masks = recording.masks
+        self.tick = 0
+
+    def __call__(self):
+        pressed = self.states[self.masks[self.tick]]
+        self.tick += 1
+        return pressed
+
+
+def replay_game(recording, surface):
+    """ A new game playing recording, keeping a snapshot of every tick so it
+    can seek() to any of them
+    """
+    import main
+    import snapshot
+
+    game = main.QuestGame(surface, recording.map_filename, ReplayInput(recording))
+    game.wait_for_levels = True
+    game.history = snapshot.History(len(recording) + 1)
+    game.history.capture(game)
+    return game
+
+
+def seek(game, tick):
+    """ Put a replay_game() back to just after tick, to play on from there
+    """
+    game.history.restore(game, tick)
+    game.get_pressed.tick = tick
+
+
+def play(recording, surface, window=False, game=None):
+    """ Run a recording through a new game, or on with a game from
+    replay_game(), as fast as possible
+
+    Returns the hero's position after every tick played.  With window set
+    every tick is also drawn and shown.
+    """
+    if game is None:
+        game = replay_game(recording, surface)
+    game.running = True
+    positions = []
+    for dt in recording.dts[game.get_pressed.tick:]:
+        game.step(dt)
+        positions.append(tuple(game.hero.position))
+        if window:
+            game.draw(surface)
+            pygame.display.flip()
+        if not game.running:
+            break
+    return positions
+
+
+def write_trace(path, positions):
+    with open(path, 'w') as f:
+        for x, y in positions:
+            f.write("{!r} {!r}\n".format(x, y))
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [tuple(float(value) for value in line.split()) for line in f]
+
+
+def first_difference(a, b):
+    """ The first tick where two position traces differ, or None if they match
+    """
+    for tick, (pa, pb) in enumerate(zip(a, b)):
+        if pa != pb:
+            return tick
+    if len(a) != len(b):
+        return min(len(a), len(b))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play back a recorded session.')
+    parser.add_argument('recording')
+    parser.add_argument('--window', action='store_true', help='draw the replay in a window')
+    parser.add_argument('--trace', metavar='PATH', help="write the hero's position every tick here")
+    parser.add_argument('--compare', metavar='PATH', help='compare the positions with a trace written earlier')
+    parser.add_argument('--seek', type=int, metavar='TICK',
+                        help='then jump back to just after TICK and check the rest plays the same again')
+    args = parser.parse_args()
+
+    recording = Recording.load(args.recording)
+    if args.window:
+        pygame.init()
+        surface = pygame.display.set_mode((800, 600))
+    else:
+        from headless import init_headless
+        surface = init_headless((800, 600))
+
+    game = replay_game(recording, surface)
+    start = time.perf_counter()
+    positions = play(recording, surface, args.window, game)
+    elapsed = time.perf_counter() - start
+    simulated = sum(recording.dts[:len(positions)])
+    print("{}: {} ticks, {:.1f} s of play in {:.2f} s ({:.0f} ticks/sec)".format(
+        recording.map_filename, len(positions), simulated, elapsed, len(positions) / elapsed))
+
+    if args.trace:
+        write_trace(args.trace, positions)
+    if args.compare:
+        tick = first_difference(positions, read_trace(args.compare))
+        if tick is None:
+            print("positions match {}".format(args.compare))
+        else:
+            print("positions differ from {} at tick {}".format(args.compare, tick))
+            raise SystemExit(1)
+
+    if args.seek is not None:
+        start = time.perf_counter()
+        seek(game, args.seek)
+        elapsed = time.perf_counter() - start
+        again = play(recording, surface, args.window, game)
+        tick = first_difference(again, positions[args.seek:])
+        if tick is None:
+            print("jumped to tick {} in {:.0f} us, the {} ticks after it play the same".format(
+                args.seek, elapsed * 1e6, len(again)))
+        else:
+            print("jumped to tick {}, positions differ {} ticks later".format(args.seek, tick))
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+""" Running the hero's physics without the game, for batch playthroughs.
+
+A Simulation is one hero on one map and nothing else: no window, no
+renderer, no clock.  It is driven a tick at a time by the same Hero code the
+game runs (control, update, move, calc_grav), so a run matches the game
+tick for tick given the same keys.
+
+Actions are the held keys of a tick as a bit mask, encoded like the ticks of
+a replay: LEFT, RIGHT, UP, DOWN and JUMP below, or'ed together.
+
+A BatchSimulation runs many independent instances of one map and steps them
+all at once: actions go in and observations come out as numpy arrays, one
+row per instance.  The instances share the map's static level, and with
+workers set they are spread over that many processes.
+
+    batch = BatchSimulation('data/maps/dungeon_0.tmx', 64, workers=4)
+    observations = batch.reset()
+    observations = batch.step(actions, ticks=4)
+    batch.close()
+
+Doors are not followed and guards are not simulated.
+"""
+import multiprocessing
+
+import numpy
+import pygame
+
+import levels
+from headless import KeyState
+from hero import Hero
+from replay import RECORDED_KEYS, mask_keys
+
+LEFT, RIGHT, UP, DOWN, JUMP = (1 << bit for bit in range(len(RECORDED_KEYS)))
+ACTION_COUNT = 1 << len(RECORDED_KEYS)
+
+# the columns of an observation
+OBSERVATION_FIELDS = ('x', 'y', 'velocity_x', 'velocity_y', 'state', 'facing', 'grounded')
+
+# held keys for every action
+ACTION_KEYS = [KeyState(mask_keys(action)) for action in range(ACTION_COUNT)]
+
+# ticks per second when no dt is given, the game's default SIMULATION_RATE
+SIMULATION_RATE = 120
+
+
+class Simulation(object):
+    """ One hero on a level loaded with levels.load_level(graphics=False)
+
+    Hero methods take the game as an argument for its indices and debug
+    flag; the simulation stands in for it.  reset=False leaves the hero at
+    (0, 0) without looking for the spawn, for callers that place() it.
+    """
+
+    def __init__(self, level, dt=None, reset=True):
+        self.level = level
+        self.wall_index = level.wall_index
+        self.stair_index = level.stair_index
+        self.debug = False
+        self.dt = dt if dt is not None else 1. / SIMULATION_RATE
+        self.hero = None
+        self.ticks = 0
+        if reset:
+            self.reset()
+        else:
+            self._new_hero()
+
+    def reset(self, spawn=None):
+        """ Put a new hero at the object named spawn, or the map's hero spawn,
+        and return the observation
+        """
+        position, standing = self.level.spawn_point(spawn)
+        hero = self._new_hero()
+        if standing:
+            position = position[0], position[1] - hero.rect.height
+        hero.position = position
+        hero._old_position[:] = hero._position
+        hero.update_contacts(self)
+        return self.observe()
+
+    def _new_hero(self):
+        self.hero = Hero(pygame.Rect(0, 0, 0, 0), sprites=False)
+        self.ticks = 0
+        return self.hero
+
+    def place(self, x, y):
+        """ Stand a new hero with the middle of its feet at (x, y), ready to
+        jump, and return the observation
+        """
+        hero = self._new_hero()
+        box_width = hero.rect.width - hero.COLLISION_BOX_OFFSET
+        hero.position = (x - box_width / 2. - hero.COLLISION_BOX_OFFSET, y - hero.rect.height)
+        hero._old_position[:] = hero._position
+        hero.time_since_last_jump = hero.JUMP_DELAY
+        hero.update_contacts(self)
+        return self.observe()
+
+    def step(self, action, ticks=1):
+        """ Hold the keys of action for ticks ticks, return the observation
+        """
+        hero = self.hero
+        pressed = ACTION_KEYS[action]
+        dt = self.dt
+        for _ in range(ticks):
+            hero.control(pressed, dt, self)
+            hero.update(dt, self)
+        self.ticks += ticks
+        return self.observe()
+
+    def observe(self, out=None):
+        """ The hero's state as a row of OBSERVATION_FIELDS, written to out if given
+        """
+        hero = self.hero
+        if out is None:
+            out = numpy.empty(len(OBSERVATION_FIELDS))
+        out[0] = hero._position[0]
+        out[1] = hero._position[1]
+        out[2] = hero.velocity[0]
+        out[3] = hero.velocity[1]
+        out[4] = hero.state
+        out[5] = hero.facing
+        out[6] = hero.grounded
+        return out
+
+
+class LocalBatch(object):
+    """ count Simulations of filename in this process
+    """
+
+    def __init__(self, filename, count, dt=None):
+        level = levels.load_level(filename, graphics=False)
+        self.simulations = [Simulation(level, dt) for _ in range(count)]
+        self.observations = numpy.zeros((count, len(OBSERVATION_FIELDS)))
+
+    def reset(self, spawn=None):
+        for simulation, row in zip(self.simulations, self.observations):
+            simulation.reset(spawn)
+            simulation.observe(row)
+        return self.observations.copy()
+
+    def step(self, actions, ticks=1):
+        for simulation, action, row in zip(self.simulations, actions, self.observations):
+            simulation.step(int(action), ticks)
+            simulation.observe(row)
+        return self.observations.copy()
+
+    def observe(self):
+        return self.observations.copy()
+
+    def close(self):
+        pass
+
+
+def serve(connection, filename, count, dt):
+    """ Worker process: run a LocalBatch, doing what connection asks
+    """
+    batch = LocalBatch(filename, count, dt)
+    connection.send(batch.observe())
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+        connection.send(getattr(batch, command)(*args))
+    connection.close()
+
+
+class BatchSimulation(object):
+    """ count independent instances of filename, stepped together
+
+    With workers 0 they all run in this process.  Otherwise they are split
+    between that many worker processes, which step their share in parallel.
+    """
+
+    def __init__(self, filename, count, workers=0, dt=None):
+        self.count = count
+        self.local = None
+        self.workers = []
+        if not workers:
+            self.local = LocalBatch(filename, count, dt)
+            return
+
+        context = multiprocessing.get_context()
+        # split the instances as evenly as possible
+        self.splits = numpy.array_split(numpy.arange(count), min(workers, count))
+        for share in self.splits:
+            connection, child = context.Pipe()
+            process = context.Process(target=serve, args=(child, filename, len(share), dt), daemon=True)
+            process.start()
+            child.close()
+            self.workers.append((process, connection))
+        for process, connection in self.workers:
+            connection.recv()
+
+    def _call(self, command, *args_per_worker):
+        # send to every worker before waiting on any, so they run at once
+        for i, (process, connection) in enumerate(self.workers):
+            connection.send((command, tuple(args[i] for args in args_per_worker)))
+        return numpy.concatenate([connection.recv() for process, connection in self.workers])
+
+    def reset(self, spawn=None):
+        """ Start every instance over, return the observations
+        """
+        if self.local is not None:
+            return self.local.reset(spawn)
+        return self._call('reset', [spawn] * len(self.workers))
+
+    def step(self, actions, ticks=1):
+        """ Step instance i with actions[i] for ticks ticks, return the observations
+        """
+        actions = numpy.asarray(actions, dtype=numpy.uint8)
+        if self.local is not None:
+            return self.local.step(actions, ticks)
+        return self._call('step', [actions[share] for share in self.splits], [ticks] * len(self.workers))
+
+    def observe(self):
+        """ An array of count rows of OBSERVATION_FIELDS
+        """
+        if self.local is not None:
+            return self.local.observe()
+        return self._call('observe')
+
+    def close(self):
+        for process, connection in self.workers:
+            connection.send(('close', ()))
+            connection.close()
+        for process, connection in self.workers:
+            process.join()
+        self.workers = []
@@ -0,0 +1,172 @@
+""" Compact snapshots of the simulation, and a history of them for rewinding.
+
+Everything a tick changes is a handful of numbers: the hero's position,
+velocity, state and timers, whether doors are armed, and the guards' arrays.
+pack() writes them into a small bytes object with struct, and unpack() puts
+them back on the game, each in a few microseconds.  Nothing else is kept:
+the level's walls and stairs never change, and the hero's sensors and wall
+lookups are worked out again from its position.
+
+A snapshot is only the state within a level.  A History also remembers
+which map each one was taken on, so it can step back through a door.  It
+keeps the last capacity ticks, one snapshot a tick, in a ring:
+
+    history = History(10 * main.SIMULATION_RATE)
+    history.capture(game)       # after every tick
+    history.rewind(game, 120)   # back one second
+    history.restore(game, tick) # back to just after tick
+
+Restoring a snapshot and carrying on with the same input gives the same
+ticks as the first time, tick for tick.
+"""
+import struct
+
+import numpy
+
+VERSION = 1
+
+# version, doors armed, guard count
+HEADER = struct.Struct('<B?H')
+
+# position, old position, velocity, time in state, time spent climbing, time
+# since last jump, then state, facing, climbing direction, current frame,
+# grounded, touching ceiling
+HERO = struct.Struct('<9d3BH2?')
+
+# the arrays of a Crowd that a tick changes, first count entries of each
+CROWD_FIELDS = ('x', 'y', 'old_x', 'old_y', 'vx', 'vy', 'state', 'facing',
+                'time_in_state', 'patrol_timer', 'walking', 'frame')
+
+
+def pack(game):
+    """ The state of game's hero, doors and guards as bytes
+    """
+    hero = game.hero
+    position = hero._position
+    old_position = hero._old_position
+    velocity = hero.velocity
+    crowd = game.npcs
+    count = crowd.count
+    parts = [
+        HEADER.pack(VERSION, game.doors_armed, count),
+        HERO.pack(position[0], position[1], old_position[0], old_position[1],
+                  velocity[0], velocity[1], hero.time_in_state, hero.time_spent_climbing,
+                  hero.time_since_last_jump, hero.state, hero.facing, hero.climbing_direction,
+                  hero.current_frame, hero.grounded, hero.touching_ceiling),
+    ]
+    if count:
+        parts.extend(getattr(crowd, name)[:count].tobytes() for name in CROWD_FIELDS)
+    return b''.join(parts)
+
+
+def unpack(game, blob):
+    """ Put the state packed in blob back on game, which has to be playing
+    the level it was packed on
+    """
+    version, doors_armed, count = HEADER.unpack_from(blob)
+    if version != VERSION:
+        raise ValueError("not a version {} snapshot".format(VERSION))
+    crowd = game.npcs
+    if count != crowd.count:
+        raise ValueError("snapshot has {} guards, the level has {}".format(count, crowd.count))
+
+    hero = game.hero
+    (x, y, old_x, old_y, velocity_x, velocity_y, hero.time_in_state, hero.time_spent_climbing,
+     hero.time_since_last_jump, hero.state, hero.facing, hero.climbing_direction,
+     hero.current_frame, hero.grounded, hero.touching_ceiling) = HERO.unpack_from(blob, HEADER.size)
+    hero._position[0] = x
+    hero._position[1] = y
+    hero._old_position[0] = old_x
+    hero._old_position[1] = old_y
+    hero.velocity[0] = velocity_x
+    hero.velocity[1] = velocity_y
+    hero.rect.topleft = hero._position
+    hero.update_sensors()
+    # the walls looked up for the old position may not be the ones here
+    hero.nearby_index = None
+    if hero.image is not None:
+        hero.animate(0, game)
+    game.doors_armed = doors_armed
+
+    if not count:
+        return
+    offset = HEADER.size + HERO.size
+    for name in CROWD_FIELDS:
+        array = getattr(crowd, name)
+        array[:count] = numpy.frombuffer(blob, array.dtype, count, offset)
+        offset += count * array.itemsize
+
+
+def load(game, filename, blob):
+    """ Unpack blob, packed on the map filename, going to that map first if
+    the game has left it
+    """
+    if filename != game.filename:
+        game.enter_level(game.levels.get(filename))
+    unpack(game, blob)
+
+
+class History(object):
+    """ The last capacity snapshots of a game, one per tick
+
+    Ticks are counted from the first capture, which is tick 0.  Only ticks
+    still in the ring can be restored; restoring one forgets the ticks after
+    it, the game carries on from there.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.snapshots = [None] * capacity
+        # the map each snapshot was taken on
+        self.maps = [None] * capacity
+        # the oldest tick kept, and the next tick to capture
+        self.first = 0
+        self.ticks = 0
+
+    def __len__(self):
+        return self.ticks - self.first
+
+    @property
+    def last(self):
+        """ The newest tick, or -1 if nothing was captured
+        """
+        return self.ticks - 1
+
+    def capture(self, game):
+        slot = self.ticks % self.capacity
+        self.snapshots[slot] = pack(game)
+        self.maps[slot] = game.filename
+        self.ticks += 1
+        if self.ticks - self.first > self.capacity:
+            self.first += 1
+
+    def bytes(self):
+        """ The bytes held by the snapshots, not counting Python's overhead
+        """
+        return sum(len(snapshot) for snapshot in self.snapshots if snapshot is not None)
+
+    def restore(self, game, tick):
+        """ Put game back to how it was just after tick, going back to that
+        map if it has left it since
+        """
+        if not self.first <= tick <= self.last:
+            raise IndexError("tick {} isn't in the history, it has {} to {}".format(tick, self.first, self.last))
+        slot = tick % self.capacity
+        load(game, self.maps[slot], self.snapshots[slot])
+        self.ticks = tick + 1
+        return tick
+
+    def clear(self, tick=0):
+        """ Forget every snapshot, the next capture is tick
+        """
+        self.snapshots = [None] * self.capacity
+        self.maps = [None] * self.capacity
+        self.first = self.ticks = tick
+
+    def rewind(self, game, ticks):
+        """ Go back ticks ticks, or as far as the history goes, and return the
+        tick the game is at now
+        """
+        if not len(self):
+            return None
+        return self.restore(game, max(self.last - ticks, self.first))
@@ -0,0 +1,458 @@
+""" Streaming very large maps in chunks.
+
+The map is cut into square regions of chunk_size tiles, each stored in its own
+file under map.tmx.chunks/ together with the walls (merged, as in the compiled
+map cache) and stairs that touch it.  Only the regions around the camera are
+kept in memory: they are read on a background thread as the camera moves, and
+the regions furthest away are dropped again, tiles and collision alike, once
+the memory budget is used up.
+
+The tile images, tile animations and the spawn points (hero, guards, doors)
+are small whatever the size of the map, and are loaded up front.
+
+Chunk files are rebuilt from the compiled map cache (see mapcache.py) when
+the map changes.  Build them ahead of time with:
+
+    python streaming.py [map.tmx ...]
+"""
+import glob
+import marshal
+import os.path
+import sys
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from pyscroll.common import rect_to_bb
+from pyscroll.data import PyscrollDataAdapter
+
+import mapcache
+from collision import Block, SpatialHash
+
+CHUNK_DIR_SUFFIX = '.chunks'
+
+# bump when the layout of the chunk files changes
+VERSION = 3
+
+# objects of these types are collision, and go in the chunks they touch
+CHUNKED_TYPES = ('wall', 'stair')
+
+
+def chunk_dir(filename):
+    return filename + CHUNK_DIR_SUFFIX
+
+
+def chunk_filename(directory, key):
+    return os.path.join(directory, '{}_{}'.format(*key))
+
+
+def write_blob(path, value):
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(marshal.dumps(value)))
+
+
+def read_blob(path):
+    with open(path, 'rb') as f:
+        return marshal.loads(zlib.decompress(f.read()))
+
+
+def build_chunks(filename, chunk_size):
+    """ Cut filename into chunk files, return the index
+    """
+    payload = mapcache.load_payload(filename)
+    compiled = mapcache.CompiledMap(filename, payload)
+    width = compiled.width
+    height = compiled.height
+    tw = compiled.tilewidth
+    th = compiled.tileheight
+    directory = chunk_dir(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    chunks_x = (width + chunk_size - 1) // chunk_size
+    chunks_y = (height + chunk_size - 1) // chunk_size
+    collision = [('wall',) + tuple(rect) for rect in compiled.merged_walls]
+    collision.extend((obj.type, obj.x, obj.y, obj.width, obj.height)
+                     for obj in compiled.objects if obj.type == 'stair')
+    sizes = {}
+    for cy in range(chunks_y):
+        for cx in range(chunks_x):
+            left = cx * chunk_size
+            top = cy * chunk_size
+            right = min(left + chunk_size, width)
+            bottom = min(top + chunk_size, height)
+            layers = {}
+            for index, gids in compiled.layers.items():
+                region = array(gids.typecode)
+                for y in range(top, bottom):
+                    region.extend(gids[y * width + left:y * width + right])
+                layers[index] = region.tobytes()
+            area = pygame.Rect(left * tw, top * th, (right - left) * tw, (bottom - top) * th)
+            objects = [obj for obj in collision if area.colliderect(pygame.Rect(obj[1:]))]
+            write_blob(chunk_filename(directory, (cx, cy)), {
+                'rect': (left, top, right - left, bottom - top),
+                'layers': layers,
+                'objects': objects,
+            })
+            sizes[(cx, cy)] = sum(len(data) for data in layers.values()) + 64 * len(objects)
+
+    index = {
+        'version': VERSION,
+        'sources': payload['sources'],
+        'chunk_size': chunk_size,
+        'width': width,
+        'height': height,
+        'tilewidth': tw,
+        'tileheight': th,
+        'images': payload['images'],
+        'animations': payload['animations'],
+        'layers': [(index, name, visible, typecode) for index, name, visible, typecode, data in payload['layers']],
+        'spawns': [obj for obj in payload['objects'] if obj[0] not in CHUNKED_TYPES],
+        'sizes': sizes,
+    }
+    write_blob(os.path.join(directory, 'index'), index)
+    return index
+
+
+def load_index(filename, chunk_size):
+    """ Return the chunk index of filename, rebuilding the chunks if stale
+    """
+    try:
+        index = read_blob(os.path.join(chunk_dir(filename), 'index'))
+    except (OSError, EOFError, ValueError, TypeError, zlib.error):
+        index = None
+    if (index is None or index['version'] != VERSION or index['chunk_size'] != chunk_size
+            or not mapcache.is_fresh(index)):
+        index = build_chunks(filename, chunk_size)
+    return index
+
+
+class Chunk(object):
+    """ One loaded region: its tiles, walls and stairs
+
+    rect is in tiles.  Layers are flat arrays of gids, row after row.
+    """
+
+    def __init__(self, key, blob, typecodes, tilewidth, tileheight):
+        self.key = key
+        self.rect = pygame.Rect(blob['rect'])
+        self.layers = {}
+        for index, data in blob['layers'].items():
+            layer = array(typecodes[index])
+            layer.frombytes(data)
+            self.layers[index] = layer
+        self.walls = []
+        self.stairs = []
+        for type, x, y, width, height in blob['objects']:
+            block = Block(pygame.Rect(x, y, width, height))
+            if type == 'wall':
+                self.walls.append(block)
+            else:
+                self.stairs.append(block)
+        self.wall_index = SpatialHash(self.walls)
+        self.stair_index = SpatialHash(self.stairs)
+        self.pixel_rect = pygame.Rect(self.rect.x * tilewidth, self.rect.y * tileheight,
+                                      self.rect.width * tilewidth, self.rect.height * tileheight)
+        self.bytes = (sum(len(layer) * layer.itemsize for layer in self.layers.values())
+                      + 64 * (len(self.walls) + len(self.stairs)))
+
+
+class ChunkIndex(object):
+    """ Collision queries over whichever chunks are loaded
+
+    Has the same interface as collision.SpatialHash.  Chunks that aren't
+    loaded have no walls, so the game makes sure the hero's are loaded.
+    """
+
+    def __init__(self, world, attribute):
+        self.world = world
+        self.attribute = attribute
+
+    @property
+    def generation(self):
+        """ Changes whenever a chunk is loaded or dropped
+        """
+        return self.world.generation
+
+    def query(self, rect):
+        found = []
+        seen = set()
+        for chunk in self.world.chunks_under(rect):
+            for block in getattr(chunk, self.attribute).query(rect):
+                key = tuple(block.rect)
+                if key not in seen:
+                    seen.add(key)
+                    found.append(block)
+        return found
+
+    def collide_any(self, rect):
+        for chunk in self.world.chunks_under(rect):
+            block = getattr(chunk, self.attribute).collide_any(rect)
+            if block is not None:
+                return block
+        return None
+
+
+class ChunkedWorld(object):
+    """ The regions of a map that are in memory right now
+
+    Call update() with the camera position every frame: regions within
+    radius chunks of it are queued for loading on a background thread, and
+    finished loads are picked up.  When the loaded chunks use more than
+    budget bytes, the least recently needed chunks outside the radius are
+    dropped.
+    """
+
+    def __init__(self, filename, chunk_size=32, radius=1, budget=16 * 1024 * 1024, workers=1):
+        self.filename = filename
+        self.radius = radius
+        self.budget = budget
+        index = load_index(filename, chunk_size)
+        self.directory = chunk_dir(filename)
+        self.chunk_size = chunk_size
+        self.width = index['width']
+        self.height = index['height']
+        self.tilewidth = index['tilewidth']
+        self.tileheight = index['tileheight']
+        self.image_sources = index['images']
+        self.animations = index['animations']
+        self.typecodes = dict((layer[0], layer[3]) for layer in index['layers'])
+        self.visible_tile_layers = [layer[0] for layer in index['layers'] if layer[2]]
+        self.objects = [mapcache.MapObject(*obj) for obj in index['spawns']]
+        self.chunks_x = (self.width + chunk_size - 1) // chunk_size
+        self.chunks_y = (self.height + chunk_size - 1) // chunk_size
+
+        self.chunks = OrderedDict()
+        self.pending = {}
+        self.bytes = 0
+        # goes up every time a chunk is added or removed
+        self.generation = 0
+        # chunks loaded since the last call to take_arrived, for the renderer
+        self.arrived = []
+        # called with each chunk as it is added and removed
+        self.on_load = []
+        self.on_evict = []
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.walls = ChunkIndex(self, 'wall_index')
+        self.stairs = ChunkIndex(self, 'stair_index')
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _read(self, key):
+        blob = read_blob(chunk_filename(self.directory, key))
+        return Chunk(key, blob, self.typecodes, self.tilewidth, self.tileheight)
+
+    def _add(self, chunk):
+        self.chunks[chunk.key] = chunk
+        self.bytes += chunk.bytes
+        self.generation += 1
+        self.arrived.append(chunk)
+        for callback in self.on_load:
+            callback(chunk)
+
+    def _evict(self, key):
+        chunk = self.chunks.pop(key)
+        self.bytes -= chunk.bytes
+        self.generation += 1
+        for callback in self.on_evict:
+            callback(chunk)
+
+    def keys_under(self, rect):
+        """ The keys of the chunks a rect in pixels touches
+        """
+        span_x = self.chunk_size * self.tilewidth
+        span_y = self.chunk_size * self.tileheight
+        left = max(rect.left // span_x, 0)
+        top = max(rect.top // span_y, 0)
+        right = min(max(rect.right - 1, rect.left) // span_x, self.chunks_x - 1)
+        bottom = min(max(rect.bottom - 1, rect.top) // span_y, self.chunks_y - 1)
+        return [(cx, cy) for cy in range(top, bottom + 1) for cx in range(left, right + 1)]
+
+    def chunks_under(self, rect):
+        chunks = self.chunks
+        return [chunks[key] for key in self.keys_under(rect) if key in chunks]
+
+    def ensure_loaded(self, rect):
+        """ Load the chunks under rect now, waiting for them if need be
+        """
+        for key in self.keys_under(rect):
+            if key in self.chunks:
+                continue
+            future = self.pending.pop(key, None)
+            chunk = future.result() if future is not None else self._read(key)
+            self._add(chunk)
+
+    def update(self, center):
+        """ Stream chunks in and out around center, a point in pixels
+        """
+        cx = int(center[0]) // (self.chunk_size * self.tilewidth)
+        cy = int(center[1]) // (self.chunk_size * self.tileheight)
+        radius = self.radius
+        wanted = [(x, y)
+                  for y in range(max(cy - radius, 0), min(cy + radius, self.chunks_y - 1) + 1)
+                  for x in range(max(cx - radius, 0), min(cx + radius, self.chunks_x - 1) + 1)]
+
+        # pick up finished loads
+        for key, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[key]
+                self._add(future.result())
+
+        for key in wanted:
+            if key in self.chunks:
+                self.chunks.move_to_end(key)
+            elif key not in self.pending:
+                self.pending[key] = self.executor.submit(self._read, key)
+
+        # drop the least recently wanted chunks while over budget
+        if self.bytes > self.budget:
+            keep = set(wanted)
+            for key in list(self.chunks):
+                if self.bytes <= self.budget:
+                    break
+                if key not in keep:
+                    self._evict(key)
+
+    def track_grid(self, grid):
+        """ Keep the walls of a tilegrid.TileGrid in step with the loaded chunks
+        """
+        def load(chunk):
+            for wall in chunk.walls:
+                grid.fill(wall.rect.clip(chunk.pixel_rect))
+
+        def evict(chunk):
+            grid.fill(chunk.pixel_rect, False)
+
+        self.on_load.append(load)
+        self.on_evict.append(evict)
+        for chunk in self.chunks.values():
+            load(chunk)
+
+    def take_arrived(self):
+        arrived = self.arrived
+        self.arrived = []
+        return arrived
+
+    def get_tile_gid(self, x, y, layer):
+        chunk = self.chunks.get((x // self.chunk_size, y // self.chunk_size))
+        if chunk is None:
+            return 0
+        rect = chunk.rect
+        return chunk.layers[layer][(y - rect.top) * rect.width + x - rect.left]
+
+
+class StreamingMapData(PyscrollDataAdapter):
+    """ pyscroll data source for a ChunkedWorld
+
+    Tiles of chunks that aren't loaded are empty.  When a chunk arrives
+    while part of it is on screen, its tiles are handed to the renderer with
+    the next batch of animated tiles, so it appears without a full redraw.
+    """
+
+    def __init__(self, world):
+        PyscrollDataAdapter.__init__(self)
+        self.world = world
+        self.images = mapcache.load_tile_images(world.image_sources)
+        self.tile_size = world.tilewidth, world.tileheight
+        self.map_size = world.width, world.height
+        self.visible_tile_layers = world.visible_tile_layers
+        self.reload_animations()
+
+    def reload_data(self):
+        self.images = mapcache.load_tile_images(self.world.image_sources)
+
+    def tiles_pending(self):
+        """ True if chunks have arrived that the renderer hasn't been given
+        """
+        return bool(self.world.arrived)
+
+    def get_animations(self):
+        return iter(self.world.animations)
+
+    def convert_surfaces(self, parent, alpha=False):
+        images = list()
+        for image in self.images:
+            if image is None:
+                images.append(None)
+            elif alpha:
+                images.append(image.convert_alpha(parent))
+            else:
+                images.append(image.convert(parent))
+        self.images = images
+
+    def _get_tile_image(self, x, y, l):
+        world = self.world
+        if 0 <= x < world.width and 0 <= y < world.height:
+            gid = world.get_tile_gid(x, y, l)
+            if gid:
+                return self.images[gid]
+        return None
+
+    def _get_tile_image_by_id(self, id):
+        return self.images[id]
+
+    def process_animation_queue(self, tile_view):
+        new_tiles = PyscrollDataAdapter.process_animation_queue(self, tile_view)
+        for chunk in self.world.take_arrived():
+            visible = chunk.rect.clip(tile_view)
+            if visible.width and visible.height:
+                new_tiles.extend(self.get_tile_images_by_rect(visible))
+        return new_tiles
+
+    def get_tile_images_by_rect(self, rect):
+        world = self.world
+        x1, y1, x2, y2 = rect_to_bb(rect)
+        area = pygame.Rect(x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+        pixels = pygame.Rect(x1 * world.tilewidth, y1 * world.tileheight,
+                             area.width * world.tilewidth, area.height * world.tileheight)
+        chunks = world.chunks_under(pixels)
+        images = self.images
+        at = self._animated_tile
+        tracked_gids = self._tracked_gids
+        anim_map = self._animation_map
+        track = bool(self._animation_queue)
+
+        for l in self.visible_tile_layers:
+            for chunk in chunks:
+                part = chunk.rect.clip(area)
+                if not part.width or not part.height:
+                    continue
+                layer = chunk.layers[l]
+                rect = chunk.rect
+                for y in range(part.top, part.bottom):
+                    start = (y - rect.top) * rect.width - rect.left
+                    for x, gid in enumerate(layer[start + part.left:start + part.right], part.left):
+                        if not gid:
+                            continue
+                        if track and gid in tracked_gids:
+                            anim_map[gid].positions.add((x, y, l))
+                        try:
+                            tile = at[(x, y, l)]
+                        except KeyError:
+                            tile = images[gid]
+                        if tile:
+                            yield x, y, l, tile
+
+
+def main(filenames, chunk_size=32):
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join('data', 'maps', '*.tmx')))
+    for filename in filenames:
+        start = time.perf_counter()
+        try:
+            index = build_chunks(filename, chunk_size)
+        except Exception as e:
+            print("{:<32} failed: {}".format(filename, e))
+            continue
+        print("{:<32} {:>8.1f} ms {:>6} chunks".format(
+            filename, (time.perf_counter() - start) * 1000, len(index['sizes'])))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
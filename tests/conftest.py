@@ -0,0 +1,9 @@
+""" The tests run against the modules and data in the project root, as the
+game and the benchmarks do.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
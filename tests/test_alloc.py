@@ -0,0 +1,8 @@
+import bench
+
+
+def test_hero_ticks_stay_in_the_allocation_budget():
+    # in a fresh process, so nothing else running here can be counted
+    for name, ticks, lookups, peak, kept in bench.alloc_report():
+        assert peak <= bench.TICK_ALLOCATION_BUDGET, "{} peaked at {} bytes".format(name, peak)
+        assert kept <= bench.TICK_ALLOCATION_BUDGET, "{} kept {} bytes".format(name, kept)
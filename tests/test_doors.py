@@ -0,0 +1,38 @@
+import pygame
+from pygame.locals import K_RIGHT
+
+import headless
+from main import QuestGame, get_map
+
+TICK = 1 / 120.
+
+
+def test_dungeon_exit_lands_the_hero_on_ground_in_town():
+    surface = headless.init_headless((800, 600))
+    # walk right out of the dungeon and on along the town street
+    keys = headless.ScriptedInput([(600, [K_RIGHT]), (120, [])])
+    game = QuestGame(surface, get_map('maps/dungeon_0.tmx'), get_pressed=keys)
+    game.wait_for_levels = True
+    game.running = True
+    # on the step beside the exit, the way down the corridor needs the stairs
+    game.hero.position = 400, 432
+    game.hero._old_position[:] = game.hero._position
+    game.hero.update_contacts(game)
+    try:
+        for _ in range(600):
+            game.step(TICK)
+            if game.filename.endswith('first_town.tmx'):
+                break
+        assert game.filename.endswith('first_town.tmx'), "never got through the exit door"
+
+        ground = game.level.named['entry'].y + game.level.named['entry'].height
+        while not keys.finished:
+            game.step(TICK)
+            assert game.hero.rect.bottom <= ground, "fell through town at {}".format(game.hero.position)
+        for _ in range(120):
+            game.step(TICK)
+        assert game.hero.grounded
+        assert game.hero.rect.bottom == ground
+    finally:
+        game.levels.close()
+        pygame.quit()
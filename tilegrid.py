@@ -0,0 +1,131 @@
+""" Collision from the tile layers instead of hand drawn objects.
+
+A TileGrid is a numpy boolean array with one cell per map tile, True where the
+tile is solid.  Tiles are solid if they have the property being looked for
+set (for example a 'solid' property on the tile in Tiled's tileset editor) or
+if they are on the named collision layer, whatever tile is there.
+
+Checking a sensor is a slice of the array, so the cost doesn't depend on the
+size of the map or how much of it is solid.
+
+Requires numpy.
+"""
+import numpy
+import pygame
+import pytmx
+
+from collision import Block
+from mapcache import CompiledMap
+
+
+def tile_layers(tmx_data):
+    """ Yield (name, gids) for every tile layer, gids as a (height, width) array
+
+    Works for both pytmx maps and maps loaded from the map cache.
+    """
+    if isinstance(tmx_data, CompiledMap):
+        for index in sorted(tmx_data.layers):
+            gids = numpy.asarray(tmx_data.layers[index])
+            yield tmx_data.layer_names[index], gids.reshape(tmx_data.height, tmx_data.width)
+    else:
+        for layer in tmx_data.layers:
+            if isinstance(layer, pytmx.TiledTileLayer):
+                yield layer.name, numpy.array(layer.data, dtype=numpy.uint32)
+
+
+class TileGrid(object):
+    """ Which tiles of the map are solid
+
+    Has the same query interface as collision.SpatialHash, so the game can use
+    either for its walls and stairs.  Tiles are returned row by row.
+    """
+
+    def __init__(self, solid, tilewidth, tileheight):
+        self.solid = solid
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.height, self.width = solid.shape
+        # as SpatialHash.generation, the solid tiles don't change
+        self.generation = 0
+
+    @classmethod
+    def from_map(cls, tmx_data, prop=None, layer=None):
+        """ Build the grid from the tiles that have prop set, and from every
+        tile on the layer named layer
+        """
+        solid = numpy.zeros((tmx_data.height, tmx_data.width), dtype=bool)
+
+        solid_gids = None
+        if prop is not None:
+            gids = [gid for gid, properties in tmx_data.tile_properties.items() if properties.get(prop)]
+            if gids:
+                solid_gids = numpy.zeros(max(gids) + 1, dtype=bool)
+                solid_gids[gids] = True
+
+        for name, gids in tile_layers(tmx_data):
+            if name == layer:
+                solid |= gids != 0
+            elif solid_gids is not None:
+                known = gids < len(solid_gids)
+                solid[known] |= solid_gids[gids[known]]
+
+        return cls(solid, tmx_data.tilewidth, tmx_data.tileheight)
+
+    @classmethod
+    def from_rects(cls, rects, tilewidth, tileheight, width, height):
+        """ Build a width x height tile grid where every tile touched by one
+        of the rects is solid
+        """
+        grid = cls(numpy.zeros((height, width), dtype=bool), tilewidth, tileheight)
+        for rect in rects:
+            grid.fill(rect)
+        return grid
+
+    def __len__(self):
+        return int(self.solid.sum())
+
+    def _cells(self, rect):
+        """ The part of the grid under rect, and the tile it starts at
+        """
+        tw = self.tilewidth
+        th = self.tileheight
+        left = max(rect.left // tw, 0)
+        top = max(rect.top // th, 0)
+        right = min(max(rect.right - 1, rect.left) // tw, self.width - 1)
+        bottom = min(max(rect.bottom - 1, rect.top) // th, self.height - 1)
+        if right < left or bottom < top:
+            # entirely off the map
+            return self.solid[0:0, 0:0], left, top
+        return self.solid[top:bottom + 1, left:right + 1], left, top
+
+    def fill(self, rect, solid=True):
+        """ Mark every tile touched by rect as solid, or as empty
+        """
+        cells, left, top = self._cells(rect)
+        cells[...] = solid
+
+    def _tile(self, x, y):
+        return Block(pygame.Rect(x * self.tilewidth, y * self.tileheight, self.tilewidth, self.tileheight))
+
+    def collides(self, rect):
+        cells, left, top = self._cells(rect)
+        return bool(cells.any())
+
+    def query(self, rect):
+        """ Return a Block for every solid tile under rect
+        """
+        cells, left, top = self._cells(rect)
+        ys, xs = numpy.nonzero(cells)
+        return [self._tile(left + x, top + y) for y, x in zip(ys.tolist(), xs.tolist())]
+
+    def collide_any(self, rect):
+        """ Return the first solid tile under rect, or None
+        """
+        cells, left, top = self._cells(rect)
+        if cells.size == 0:
+            return None
+        first = int(cells.argmax())
+        y, x = divmod(first, cells.shape[1])
+        if not cells[y, x]:
+            return None
+        return self._tile(left + x, top + y)